@@ -0,0 +1,57 @@
+# Times formatting a large Markdown document again after a one-character
+# edit, with process_str() and with a DocumentIndex that has seen the
+# previous version. Both processors have formatted every block before, so
+# this is the time spent finding blocks rather than in the formatter:
+#
+#     python benchmarks/bench_incremental.py
+import timeit
+from collections.abc import Callable
+
+from ruffen_docs.incremental import DocumentIndex
+from ruffen_docs.processors import BlackFormatter
+
+DOCUMENTS = {
+    "100 blocks": 100,
+    "2,000 blocks": 2_000,
+    "20,000 blocks": 20_000,
+}
+
+
+def _document(blocks: int) -> str:
+    return "".join(
+        f"Paragraph {i}.\n\n```python\nx = {i}\nprint(x)\n```\n\n"
+        for i in range(blocks)
+    )
+
+
+def _time(process: Callable[[str], object], versions: list[str]) -> float:
+    # The best time over versions, each processed once, in turn.
+    times = iter(versions)
+    return min(
+        timeit.repeat(lambda: process(next(times)), number=1, repeat=len(versions))
+    )
+
+
+def main() -> None:
+    for name, blocks in DOCUMENTS.items():
+        src = _document(blocks)
+        middle = len(src) // 2
+        edited = f"{src[:middle]}x{src[middle:]}"
+
+        processor = BlackFormatter()
+        processor.process_str(src)
+        full = _time(processor.process_str, [edited] * 3)
+
+        index = DocumentIndex(BlackFormatter())
+        index.update(src)
+        incremental = _time(index.update, [edited, src] * 3)
+
+        print(
+            f"{name:<14} "
+            f"process_str {full * 1000:8.2f}ms  "
+            f"DocumentIndex {incremental * 1000:8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
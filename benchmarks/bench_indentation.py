@@ -0,0 +1,53 @@
+# Times dedenting and re-indenting large code blocks, as the rST handlers do,
+# with textwrap and the regular expressions they used before, and with the
+# indentation helpers:
+#
+#     python benchmarks/bench_indentation.py
+import re
+import textwrap
+import timeit
+from collections.abc import Callable
+
+from ruffen_docs.indentation import dedent, indent
+
+INDENT_RE = re.compile("^ +(?=[^ ])", re.MULTILINE)
+TRAILING_NL_RE = re.compile(r"\n+\Z", re.MULTILINE)
+
+BLOCKS = {
+    "100 lines": "    def f(x):\n        return x\n\n" * 33,
+    "10,000 lines": "    def f(x):\n        return x\n\n" * 3333,
+    "data literal": "    x = [\n" + "        1,\n" * 30_000 + "    ]\n",
+}
+
+
+def _textwrap(code: str) -> str:
+    min_indent = min(INDENT_RE.findall(code))
+    trailing_ws_match = TRAILING_NL_RE.search(code)
+    assert trailing_ws_match
+    trailing_ws = trailing_ws_match.group()
+    dedented = textwrap.dedent(code)
+    return textwrap.indent(dedented, min_indent).rstrip() + trailing_ws
+
+
+def _helpers(code: str) -> str:
+    min_indent, dedented = dedent(code)
+    trailing_ws = code[len(code.rstrip("\n")) :]
+    return indent(dedented, min_indent).rstrip() + trailing_ws
+
+
+def _time(reindent: Callable[[str], str], code: str) -> float:
+    return min(timeit.repeat(lambda: reindent(code), number=10, repeat=3)) / 10
+
+
+def main() -> None:
+    for name, code in BLOCKS.items():
+        assert _textwrap(code) == _helpers(code)
+        print(
+            f"{name:<14} "
+            f"textwrap {_time(_textwrap, code) * 1000:8.2f}ms  "
+            f"helpers {_time(_helpers, code) * 1000:8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# Times the Markdown fence scanners against the regular expression they
+# replaced, on documents with many unclosed fences:
+#
+#     python benchmarks/bench_md_scanner.py
+import re
+import timeit
+from typing import Any
+
+from ruffen_docs.constants import PYGMENTS_PY_LANGS
+from ruffen_docs.scanners import MD_SCANNER
+
+MD_RE = re.compile(
+    r"(?P<before>^(?P<indent> *)```[^\S\r\n]*"
+    + f"({'|'.join(PYGMENTS_PY_LANGS)})"
+    + r"( .*?)?\n)"
+    r"(?P<code>.*?)"
+    r"(?P<after>^(?P=indent)```[^\S\r\n]*$)",
+    re.DOTALL | re.MULTILINE,
+)
+
+INPUTS = {
+    "closed fences": "```python\nf(1,2,3)\n```\n\ntext\n\n" * 2000,
+    "unclosed fences": "```python\nf(1,2,3)\n\ntext\n\n" * 2000,
+    "indented unclosed fences": "".join(
+        f"{' ' * (i % 8)}```python\nf(1,2,3)\n\n" for i in range(2000)
+    ),
+}
+
+
+def _time(scanner: Any, src: str) -> float:
+    return min(timeit.repeat(lambda: list(scanner.finditer(src)), number=1, repeat=3))
+
+
+def main() -> None:
+    for name, src in INPUTS.items():
+        print(
+            f"{name:<26} "
+            f"regex {_time(MD_RE, src) * 1000:9.2f}ms  "
+            f"scanner {_time(MD_SCANNER, src) * 1000:9.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Times the patterns that match whole code blocks, with backreferences, as
+# compiled by the re module and by the regex module, on a LaTeX document, a
+# Markdown document without LaTeX blocks, and a LaTeX block that is never
+# closed:
+#
+#     python benchmarks/bench_regex_engines.py
+import re
+import timeit
+from typing import Any
+
+import regex
+
+from ruffen_docs import regex_patterns
+
+PATTERNS = (
+    "LATEX_RE",
+    "LATEX_PYCON_RE",
+    "PYTHONTEX_RE",
+    "MD_FENCED_BLOCK_RE",
+)
+
+LINES = "y = 1\n" * 20
+DOCUMENTS = {
+    "LaTeX": "".join(
+        f"Text {i}.\n\\begin{{minted}}{{python}}\nx = {i}\n{LINES}\\end{{minted}}\n\n"
+        for i in range(2_000)
+    ),
+    "Markdown": "".join(
+        f"Paragraph {i}.\n\n```python\nx = {i}\n{LINES}```\n\n" for i in range(2_000)
+    ),
+    "unclosed": "\\begin{minted}{python}\n" + "x = 1\n" * 50_000,
+}
+
+
+def _time(pattern: Any, src: str) -> float:
+    # A pattern of either module, which have no common type.
+    return min(timeit.repeat(lambda: list(pattern.finditer(src)), number=1, repeat=5))
+
+
+def main() -> None:
+    for name in PATTERNS:
+        pattern = getattr(regex_patterns, name)
+        flags = pattern.flags & (re.DOTALL | re.MULTILINE)
+        compiled = {
+            "re": re.compile(pattern.pattern, flags),
+            "regex": regex.compile(pattern.pattern, flags),
+        }
+
+        for document, src in DOCUMENTS.items():
+            re_time, regex_time = (_time(p, src) for p in compiled.values())
+            print(
+                f"{name:<19} {document:<9} "
+                f"re {re_time * 1000:8.2f}ms  regex {regex_time * 1000:8.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Times the rST scanners against the regular expressions they replaced, on
+# inputs that made those backtrack:
+#
+#     python benchmarks/bench_rst_scanner.py
+import re
+import timeit
+from typing import Any
+
+from ruffen_docs.scanners import (
+    RST_LITERAL_BLOCKS_SCANNER,
+    RST_PYCON_SCANNER,
+    RST_SCANNER,
+)
+
+BLOCK_TYPES = "(code|code-block|sourcecode|ipython)"
+DOCTEST_TYPES = "(testsetup|testcleanup|testcode)"
+RST_RE = re.compile(
+    rf"(?P<before>"
+    rf"^(?P<indent> *)\.\. ("
+    rf"jupyter-execute::|"
+    rf"{BLOCK_TYPES}:: (?P<lang>\w+)|"
+    rf"{DOCTEST_TYPES}::.*"
+    rf")\n"
+    rf"((?P=indent) +:.*\n)*"
+    rf"( *\n)*"
+    rf")"
+    rf"(?P<code>(^((?P=indent) +.*)?\n)+)",
+    re.MULTILINE,
+)
+RST_LITERAL_BLOCKS_RE = re.compile(
+    r"(?P<before>"
+    r"^(?! *\.\. )(?P<indent> *).*::\n"
+    r"((?P=indent) +:.*\n)*"
+    r"\n*"
+    r")"
+    r"(?P<code>(^((?P=indent) +.*)?\n)+)",
+    re.MULTILINE,
+)
+RST_PYCON_RE = re.compile(
+    r"(?P<before>"
+    r"(?P<indent> *)\.\. ((code|code-block):: pycon|doctest::.*)\n"
+    r"((?P=indent) +:.*\n)*"
+    r"\n*"
+    r")"
+    r"(?P<code>(^((?P=indent) +.*)?(\n|$))+)",
+    re.MULTILINE,
+)
+
+N = 1000
+INPUTS = {
+    "deep indent": "".join(
+        f"{' ' * i}.. code-block:: python\n{' ' * i}x::\n" for i in range(N)
+    ),
+    "many :: lines": "x::\n" * N + "y\n",
+    "blank runs": ".. code-block:: python\n" + "    \n" * N * 10 + "y\n",
+    "options": "x::\n" + "    :a:\n" * N * 10,
+    "long header": " " * N * 10 + "x::\nx\n",
+    "pycon headers": ".. doctest:: " * N + "\nx\n",
+}
+PAIRS = {
+    "RST": (RST_RE, RST_SCANNER),
+    "RST literal blocks": (RST_LITERAL_BLOCKS_RE, RST_LITERAL_BLOCKS_SCANNER),
+    "RST pycon": (RST_PYCON_RE, RST_PYCON_SCANNER),
+}
+
+
+def _time(scanner: Any, src: str) -> float:
+    return min(timeit.repeat(lambda: list(scanner.finditer(src)), number=1, repeat=3))
+
+
+def main() -> None:
+    for input_name, src in INPUTS.items():
+        for name, (regex, scanner) in PAIRS.items():
+            print(
+                f"{input_name:<16} {name:<20} "
+                f"regex {_time(regex, src) * 1000:9.2f}ms  "
+                f"scanner {_time(scanner, src) * 1000:9.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# Compares how many code blocks per second the ruff backends format when
+# running ruff once per block, once per document, and through a ruff server
+# kept running between documents:
+#
+#     python benchmarks/bench_ruff_server.py
+import time
+
+from ruffen_docs.backends import RuffChecker, RuffFormatter
+from ruffen_docs.processors import BaseProcessor
+
+DOCUMENTS = 10
+BLOCKS = 50
+
+
+def _documents() -> list[str]:
+    return [
+        "".join(
+            f"Paragraph {i}.\n\n```python\nimport os\nx = {{ {i}:[{d}, 2]}}\n```\n\n"
+            for i in range(BLOCKS)
+        )
+        for d in range(DOCUMENTS)
+    ]
+
+
+def _blocks_per_second(processor: BaseProcessor, documents: list[str]) -> float:
+    start = time.perf_counter()
+    for document in documents:
+        processor.process_str(document)
+    return DOCUMENTS * BLOCKS / (time.perf_counter() - start)
+
+
+def main() -> None:
+    documents = _documents()
+
+    for backend in (RuffFormatter, RuffChecker):
+        # Without batching, each block is a ruff run of its own.
+        per_block = backend(server=False)
+        per_block.supports_batching = False
+        per_document = backend(server=False)
+        server = backend()
+        # Started before timing, as it is once per run.
+        server.process_code_blocks(["pass\n"])
+
+        print(
+            f"{backend.__name__:<14} "
+            f"per block {_blocks_per_second(per_block, documents):8.0f}/s  "
+            f"per document {_blocks_per_second(per_document, documents):8.0f}/s  "
+            f"server {_blocks_per_second(server, documents):8.0f}/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Times starting a fresh interpreter that imports ruffen_docs, prints --help,
+# or formats a Markdown or a LaTeX document, to show what is paid before the
+# first block is formatted, and which patterns each run compiled:
+#
+#     python benchmarks/bench_startup.py
+import subprocess
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+REPEAT = 10
+
+DOCUMENTS = {
+    "markdown.md": "```python\nx = 1\n```\n",
+    "latex.tex": "\\begin{minted}{python}\nx = 1\n\\end{minted}\n",
+}
+
+REPORT = (
+    "import sys\n"
+    "from ruffen_docs import regex_patterns\n"
+    "compiled = [n for n in vars(regex_patterns) if n.endswith('_RE')]\n"
+    "print(len(compiled), 'regex' in sys.modules, file=sys.stderr)\n"
+)
+
+
+def _time(code: str) -> tuple[float, str]:
+    command = [sys.executable, "-c", code + REPORT]
+
+    def run() -> subprocess.CompletedProcess[str]:
+        return subprocess.run(command, capture_output=True, text=True)
+
+    report = run().stderr.strip().splitlines()[-1]
+    return min(timeit.repeat(run, number=1, repeat=REPEAT)), report
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {}
+        for name, src in DOCUMENTS.items():
+            paths[name] = Path(directory, name)
+            paths[name].write_text(src, encoding="UTF-8")
+
+        runs = {
+            "import": "import ruffen_docs\n",
+            "--help": (
+                "import contextlib\nimport ruffen_docs\n"
+                "with contextlib.suppress(SystemExit):\n"
+                "    ruffen_docs.run_black(['--help'])\n"
+            ),
+            **{
+                name: f"import ruffen_docs\nruffen_docs.run_black([{str(path)!r}])\n"
+                for name, path in paths.items()
+            },
+        }
+
+        for name, code in runs.items():
+            seconds, report = _time(code)
+            compiled, imported_regex = report.split()
+            print(
+                f"{name:<12} {seconds * 1000:8.1f}ms  "
+                f"{compiled} patterns compiled, regex imported: {imported_regex}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,209 @@
 import argparse
-from collections.abc import Sequence
+import contextlib
+import dataclasses
+import io
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from collections.abc import Iterable, Sequence
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from pathlib import Path
+from typing import Any
 
 from black.const import DEFAULT_LINE_LENGTH
 from black.mode import TargetVersion
 
-from .processors import BlackFormatter
+from .backends import BackendError, backend_names, create_processor, get_backend
+from .cache import (
+    CACHE_DIR_VARIABLE,
+    CacheError,
+    cache_stats,
+    merge_caches,
+    prune_cache,
+)
+from .config import Config, ConfigError, clear_config_cache, resolve_config
+from .discovery import stream_files
+from .git import GitError, changed_files, changed_lines
+from .processors import BaseProcessor
+from .reports import FileResult, Report, ReportError, merge_reports
+from .shards import ShardError, parse_shard, shard_files
+from .stats import Stats
+from .watch import open_watcher
 
+# Processors only keep fingerprints of stable blocks and statistics between
+# files, so one per backend and distinct configuration is enough, in each
+# worker thread or process. Each run has its own workers, and starts the main
+# thread's afresh.
+_worker = threading.local()
+
+
+def _processor(
+    backend_name: str,
+    config: Config,
+    cache_dir: str | None,
+) -> BaseProcessor:
+    processors: dict[tuple[str, Config], BaseProcessor] = _worker.__dict__.setdefault(
+        "processors", {}
+    )
+
+    if (backend_name, config) not in processors:
+        processors[backend_name, config] = create_processor(
+            backend_name, config, cache_dir
+        )
+
+    return processors[backend_name, config]
+
+
+def _warm_up(backend_name: str, config: Config, cache_dir: str | None) -> None:
+    # Formats a block, so that the formatter has loaded what it loads on
+    # first use, before any file is given to the worker.
+    with contextlib.suppress(Exception):
+        _processor(backend_name, config, cache_dir).process_code_block("pass\n")
+
+
+def _process_file(
+    backend_name: str,
+    config: Config,
+    cache_dir: str | None,
+    filename: str,
+    options: dict[str, Any],
+    capture: bool,
+) -> tuple[int, Stats, str, float]:
+    processor = _processor(backend_name, config, cache_dir)
+    processor.stats = Stats()
+    started = time.perf_counter()
+
+    # Workers hand back what they print, so that it is written in order, and
+    # where the main process writes.
+    output = io.StringIO() if capture else None
+    retv = processor.process_file(
+        filename,
+        skip_errors=config.skip_errors,
+        rst_literal_blocks=config.rst_literal_blocks,
+        output=output,
+        **options,
+    )
+
+    return (
+        retv,
+        processor.stats,
+        "" if output is None else output.getvalue(),
+        time.perf_counter() - started,
+    )
+
+
+def _shard(value: str) -> tuple[int, int]:
+    try:
+        return parse_shard(value)
+    except ShardError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
+
+
+def _cache(argv: Sequence[str], prog: str) -> int:
+    parser = argparse.ArgumentParser(prog=f"{prog} cache")
+    parser.add_argument(
+        "command",
+        choices=("stats", "prune", "merge"),
+        help="stats: describe the cache and check its integrity; "
+        "prune: delete code blocks not used for --max-age days; "
+        "merge: add the code blocks of other cache files",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get(CACHE_DIR_VARIABLE),
+        required=CACHE_DIR_VARIABLE not in os.environ,
+        help=f"the cache's directory, default: ${CACHE_DIR_VARIABLE}",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        metavar="DAYS",
+        default=30.0,
+        help="default: 30",
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="for merge, the cache files to add",
+    )
+    args = parser.parse_intermixed_args(argv)
+
+    if (args.command == "merge") != bool(args.files):
+        parser.error("only merge takes files, and it needs some")
+
+    try:
+        if args.command == "stats":
+            stats = cache_stats(args.cache_dir)
+            print(stats.summary())
+            return int(stats.integrity != "ok")
+
+        if args.command == "prune":
+            deleted = prune_cache(args.cache_dir, args.max_age * 24 * 60 * 60)
+            print(f"{deleted} code blocks deleted")
+        else:
+            added = merge_caches(args.cache_dir, args.files)
+            print(f"{added} code blocks added")
+    except CacheError as e:
+        parser.error(str(e))
+
+    return 0
+
+
+def _run(argv: Sequence[str] | None, default_backend: str) -> int:
+    # A first argument of "cache" is a command to manage the cache, rather
+    # than a file; ./cache is the file.
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "cache":
+        return _cache(argv[1:], Path(sys.argv[0]).name)
 
-def run_black(argv: Sequence[str] | None = None) -> int:
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--backend",
+        default=default_backend,
+        help=f"formatter for code blocks, or several separated by commas to run "
+        f"in turn, default: {default_backend}; choices: {backend_names()}",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="how many files to process at once, 0 for one per CPU; default: 1",
+    )
     parser.add_argument(
         "-l",
         "--line-length",
         type=int,
-        default=DEFAULT_LINE_LENGTH,
+        default=argparse.SUPPRESS,
+        help=f"default: {DEFAULT_LINE_LENGTH}",
     )
     parser.add_argument(
         "--preview",
         action="store_true",
+        default=argparse.SUPPRESS,
     )
     parser.add_argument(
         "-S",
         "--skip-string-normalization",
-        action="store_true",
+        action="store_false",
+        default=argparse.SUPPRESS,
+        dest="string_normalization",
     )
     parser.add_argument(
         "-t",
         "--target-version",
         action="append",
         type=lambda v: TargetVersion[v.upper()],
-        default=[],
+        default=argparse.SUPPRESS,
         help=f"choices: {[v.name.lower() for v in TargetVersion]}",
         dest="target_versions",
     )
@@ -37,54 +211,387 @@ def run_black(argv: Sequence[str] | None = None) -> int:
         "--check",
         action="store_true",
     )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--color",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+    )
     parser.add_argument(
         "-E",
         "--skip-errors",
         action="store_true",
+        default=argparse.SUPPRESS,
     )
     parser.add_argument(
         "--rst-literal-blocks",
         action="store_true",
+        default=argparse.SUPPRESS,
     )
     parser.add_argument(
         "--pyi",
         action="store_true",
+        default=argparse.SUPPRESS,
+        dest="is_pyi",
+    )
+    parser.add_argument(
+        "--since",
+        metavar="REV",
+        help="only process files changed since the given git revision",
+    )
+    parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        help="only format code blocks on lines changed since --since (default HEAD)",
+    )
+    parser.add_argument(
+        "--exclude",
+        default=argparse.SUPPRESS,
+        help="regular expression for paths to skip when walking directories",
+    )
+    parser.add_argument(
+        "--block-timeout",
+        type=float,
+        metavar="SECONDS",
+        default=argparse.SUPPRESS,
+        help="report code blocks that take longer to format as errors",
+    )
+    parser.add_argument(
+        "--max-block-lines",
+        type=int,
+        metavar="N",
+        default=argparse.SUPPRESS,
+        help="report code blocks of more lines as errors, without formatting them",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get(CACHE_DIR_VARIABLE),
+        help="keep formatted code blocks in a cache in this directory, across "
+        f"runs; default: ${CACHE_DIR_VARIABLE}, or no cache",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print how many code blocks were formatted, and how many skipped",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print how long starting up and processing files took",
+    )
+    parser.add_argument(
+        "--shard",
+        type=_shard,
+        metavar="I/N",
+        help="only process the I-th of N parts of the files, of about equal cost",
+    )
+    parser.add_argument(
+        "--shard-costs",
+        metavar="REPORT",
+        help="balance --shard by the time files took in the run of this --report",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="FILE",
+        help="write what happened to each file, and how long it took, as JSON",
+    )
+    parser.add_argument(
+        "--merge-reports",
+        nargs="+",
+        metavar="REPORT",
+        help="merge the --report of each --shard of a run into --report, "
+        "exiting nonzero if any file needed changes",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, and process files again whenever they are written",
     )
     parser.add_argument(
         "filenames",
         nargs="*",
+        help="files and directories to process",
     )
     args = parser.parse_args(argv)
+    # Mostly the time spent importing Black, ruff, and this package.
+    startup = time.process_time()
 
-    target_versions = set(args.target_versions)
-    line_length: int = args.line_length
-    string_normalization: bool = not args.skip_string_normalization
-    is_pyi: bool = args.pyi
-    preview: bool = args.preview
-
-    retv = 0
-    for filename in args.filenames:
-        processor = BlackFormatter(
-            target_versions=target_versions,
-            line_length=line_length,
-            string_normalization=string_normalization,
-            is_pyi=is_pyi,
-            preview=preview,
-        )
-        retv |= processor.process_file(
+    # Options given on the command line override configuration files. They
+    # default to SUPPRESS, so only the given ones are set on args.
+    overrides = {
+        field.name: getattr(args, field.name)
+        for field in dataclasses.fields(Config)
+        if hasattr(args, field.name)
+    }
+    if "target_versions" in overrides:
+        overrides["target_versions"] = frozenset(overrides["target_versions"])
+
+    try:
+        backend = get_backend(args.backend)
+    except BackendError as e:
+        parser.error(str(e))
+
+    # Configuration files are read again by each run.
+    clear_config_cache()
+
+    def get_config(directory: Path) -> Config:
+        try:
+            config = resolve_config(directory, ruff=backend.ruff_config)
+        except ConfigError as e:
+            parser.error(str(e))
+
+        return dataclasses.replace(config, **overrides)
+
+    if args.merge_reports:
+        if args.report is None or args.filenames:
+            parser.error("--merge-reports takes --report and no filenames")
+
+        try:
+            report = merge_reports([Report.load(Path(f)) for f in args.merge_reports])
+        except ReportError as e:
+            parser.error(str(e))
+
+        report.dump(Path(args.report))
+        if args.stats:
+            print(report.stats.summary(), file=sys.stderr)
+        return report.retv
+
+    filenames: Iterable[str] = args.filenames
+    since: str | None = args.since
+
+    if args.changed_only and since is None:
+        since = "HEAD"
+
+    if args.watch and since is not None:
+        parser.error("--watch can't be combined with --since or --changed-only")
+
+    if since is not None:
+        try:
+            changed = changed_files(since)
+        except GitError as e:
+            parser.error(str(e))
+
+        if args.filenames:
+            # Compare paths the way git reports them.
+            requested = {Path(filename) for filename in args.filenames}
+            changed = [
+                f
+                for f in changed
+                if not requested.isdisjoint((Path(f), *Path(f).parents))
+            ]
+
+        filenames = changed
+        exclude_re = None
+    else:
+        exclude = get_config(Path.cwd()).exclude
+        try:
+            exclude_re = None if exclude is None else re.compile(exclude)
+        except re.error as e:
+            parser.error(f"invalid --exclude pattern: {e}")
+
+        filenames = stream_files(args.filenames, exclude_re)
+
+    if args.shard is not None:
+        if args.watch:
+            parser.error("--watch can't be combined with --shard")
+
+        costs = None
+        if args.shard_costs is not None:
+            try:
+                costs = Report.load(Path(args.shard_costs)).costs()
+            except ReportError as e:
+                parser.error(str(e))
+
+        # Every file has to be found before any can be given a shard.
+        index, count = args.shard
+        filenames = shard_files(filenames, index, count, costs)
+    elif args.shard_costs is not None:
+        parser.error("--shard-costs needs --shard")
+
+    _worker.processors = {}
+
+    if args.cache_dir is not None:
+        # Opened here, so that a cache that can't be is reported as such,
+        # rather than as an error for every code block.
+        processor = _processor(args.backend, get_config(Path.cwd()), args.cache_dir)
+        try:
+            if processor.cache is not None:
+                processor.cache.open()
+        except CacheError as e:
+            parser.error(str(e))
+
+    if args.jobs < 0:
+        parser.error("--jobs must not be negative")
+    jobs = args.jobs or os.cpu_count() or 1
+
+    # Backends say whether their processors can be used from several threads
+    # at once, each with its own, or only in worker processes.
+    executor: Executor | None = None
+    warm_up = 0.0
+    if jobs > 1 and (backend.thread_safe or backend.process_safe):
+        warm_up_args = (args.backend, get_config(Path.cwd()), args.cache_dir)
+        started = time.perf_counter()
+
+        if backend.thread_safe:
+            # Threads each make their own processors, but share what the
+            # formatter has loaded, and a ruff server that has started.
+            _warm_up(*warm_up_args)
+            executor = ThreadPoolExecutor(jobs)
+        else:
+            # This process has threads running by now, like the one finding
+            # files, so worker processes aren't forked from it but from a
+            # server process that has only imported ruffen_docs, and each
+            # warms up its own processor.
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context("spawn")
+            executor = ProcessPoolExecutor(
+                jobs,
+                mp_context=context,
+                initializer=_warm_up,
+                initargs=warm_up_args,
+            )
+            # Waits for a worker to be ready, for the time to be measured.
+            executor.submit(int).result()
+
+        warm_up = time.perf_counter() - started
+
+    options = {"check_only": args.check, "diff": args.diff, "color": args.color}
+    stats = Stats()
+    processed = 0
+    report = Report(shard=args.shard)
+
+    def job(filename: str) -> tuple[Any, ...]:
+        line_ranges = None
+        if args.changed_only:
+            assert since is not None
+            try:
+                line_ranges = changed_lines(filename, since)
+            except GitError as e:
+                parser.error(str(e))
+
+        config = get_config(Path(filename).parent)
+        capture = executor is not None
+
+        return (
+            args.backend,
+            config,
+            args.cache_dir,
             filename,
-            skip_errors=args.skip_errors,
-            rst_literal_blocks=args.rst_literal_blocks,
-            check_only=args.check,
+            {**options, "line_ranges": line_ranges},
+            capture,
+        )
+
+    def finish(filename: str, result: tuple[int, Stats, str, float]) -> int:
+        nonlocal stats, processed
+        retv, file_stats, output, seconds = result
+        stats += file_stats
+        processed += 1
+        report.files[filename] = FileResult(retv, seconds)
+        if output:
+            print(output, end="")
+        return retv
+
+    def process(filenames: Iterable[str], fail_fast: bool) -> int:
+        retv = 0
+
+        if executor is None:
+            for filename in filenames:
+                retv |= finish(filename, _process_file(*job(filename)))
+                if retv and fail_fast:
+                    break
+            return retv
+
+        # Results are reported in the order of filenames, with a few files
+        # queued for each worker, so that filenames can be streamed.
+        pending: deque[tuple[str, Future[tuple[int, Stats, str, float]]]] = deque()
+
+        for filename in filenames:
+            pending.append((filename, executor.submit(_process_file, *job(filename))))
+            if len(pending) >= 2 * jobs:
+                filename, future = pending.popleft()
+                retv |= finish(filename, future.result())
+                if retv and fail_fast:
+                    break
+
+        if retv and fail_fast:
+            # Files already being processed are still reported.
+            for _, future in pending:
+                future.cancel()
+            pending = deque(
+                (f, future) for f, future in pending if not future.cancelled()
+            )
+
+        for filename, future in pending:
+            retv |= finish(filename, future.result())
+
+        return retv
+
+    # Watching starts before the first run, so that no change is missed.
+    # Files this rewrites are seen as changed too, and found formatted.
+    watcher = open_watcher(args.filenames, exclude_re) if args.watch else None
+
+    started = time.perf_counter()
+
+    try:
+        retv = process(filenames, args.fail_fast)
+        elapsed = time.perf_counter() - started
+        files = processed
+
+        if watcher is not None:
+            with watcher:
+                try:
+                    for batch in watcher.batches():
+                        clear_config_cache()
+                        retv |= process(batch, False)
+                except KeyboardInterrupt:
+                    pass
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if args.stats:
+        print(stats.summary(), file=sys.stderr)
+
+    if args.report is not None:
+        report.stats = stats
+        report.dump(Path(args.report))
+
+    if args.profile:
+        workers = (
+            "sequential"
+            if executor is None
+            else f"{jobs} {'threads' if backend.thread_safe else 'processes'}"
+        )
+        print(
+            f"startup {startup:.3f}s CPU, warm-up {warm_up:.3f}s, "
+            f"{files} files in {elapsed:.3f}s ({workers})",
+            file=sys.stderr,
         )
+
     return retv
 
 
+def run_black(argv: Sequence[str] | None = None) -> int:
+    return _run(argv, "black")
+
+
+def run_ruff(argv: Sequence[str] | None = None) -> int:
+    return _run(argv, "ruff-check,ruff-format")
+
+
 def run_check(argv: Sequence[str] | None = None) -> int:
-    ...
-    return 1
+    return _run(argv, "ruff-check")
 
 
 def run_format(argv: Sequence[str] | None = None) -> int:
-    ...
-    return 1
+    return _run(argv, "ruff-format")
@@ -0,0 +1,174 @@
+import asyncio
+import contextlib
+import copy
+import multiprocessing
+import os
+import threading
+from collections.abc import Callable, Iterable, Sequence
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from pathlib import Path
+from types import TracebackType
+from typing import Self, TypeVar
+
+from .errors import CodeBlockError
+from .processors import BaseProcessor
+
+__all__ = ("AsyncProcessor",)
+
+T = TypeVar("T")
+
+# Each worker, thread or process, formats with its own copy of the processor,
+# as processors keep the state of the document being processed.
+_worker = threading.local()
+
+
+def _init_worker(processor: BaseProcessor) -> None:
+    _worker.processor = copy.deepcopy(processor)
+
+
+def _process_str(
+    src: str,
+    python: bool,
+    rst_literal_blocks: bool,
+    line_ranges: Sequence[tuple[int, int]] | None,
+) -> tuple[str, Sequence[CodeBlockError]]:
+    processor: BaseProcessor = _worker.processor
+    process = processor.process_python_str if python else processor.process_str
+
+    new_src, errors = process(
+        src,
+        rst_literal_blocks=rst_literal_blocks,
+        line_ranges=line_ranges,
+    )
+
+    return new_src, list(errors)
+
+
+def _process_file(
+    filename: str,
+    rst_literal_blocks: bool,
+) -> tuple[str, Sequence[CodeBlockError]]:
+    with Path(filename).open(encoding="UTF-8") as f:
+        contents = f.read()
+
+    return _process_str(contents, filename.endswith(".py"), rst_literal_blocks, None)
+
+
+class AsyncProcessor:
+    # Formats documents in a pool of worker processes, or threads, so that
+    # the event loop isn't blocked. At most concurrency documents are handed
+    # to the pool at once. Cancelling a call that is waiting its turn, or
+    # queued in the pool, means the document is never formatted; one already
+    # being formatted runs to completion in its worker, but isn't waited for,
+    # and keeps its place among the concurrency until it is done.
+    def __init__(
+        self,
+        processor: BaseProcessor,
+        *,
+        max_workers: int | None = None,
+        concurrency: int | None = None,
+        use_processes: bool = True,
+    ) -> None:
+        self.executor: Executor
+        if use_processes:
+            # Not forked, as the event loop's process may be running threads.
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context("spawn")
+            self.executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(processor,),
+            )
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_worker,
+                initargs=(processor,),
+            )
+        self._semaphore = asyncio.Semaphore(
+            concurrency or max_workers or os.cpu_count() or 1
+        )
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, function: Callable[..., T], *args: object) -> T:
+        # The semaphore is released once the pool is done with the call,
+        # which, for a call cancelled while being formatted, is when its
+        # worker finishes rather than when it is cancelled.
+        await self._semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        def release(_: Future[T]) -> None:
+            # From the pool's thread, after which the loop may have closed.
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(self._semaphore.release)
+
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    async def aprocess_str(
+        self,
+        src: str,
+        *,
+        python: bool = False,
+        rst_literal_blocks: bool = False,
+        line_ranges: Sequence[tuple[int, int]] | None = None,
+    ) -> tuple[str, Sequence[CodeBlockError]]:
+        # With python, like process_python_str() rather than process_str().
+        return await self._run(
+            _process_str, src, python, rst_literal_blocks, line_ranges
+        )
+
+    async def aprocess_file(
+        self,
+        filename: str,
+        *,
+        rst_literal_blocks: bool = False,
+    ) -> tuple[str, Sequence[CodeBlockError]]:
+        # The formatted contents of the file, which is read in the worker and
+        # left unchanged.
+        return await self._run(_process_file, filename, rst_literal_blocks)
+
+    async def aprocess_files(
+        self,
+        filenames: Iterable[str],
+        *,
+        rst_literal_blocks: bool = False,
+    ) -> list[tuple[str, Sequence[CodeBlockError]]]:
+        # Results are in the order of filenames. Cancelling this cancels the
+        # files that haven't been formatted yet.
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(
+                    self.aprocess_file(filename, rst_literal_blocks=rst_literal_blocks)
+                )
+                for filename in filenames
+            ]
+
+        return [task.result() for task in tasks]
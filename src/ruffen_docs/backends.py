@@ -0,0 +1,439 @@
+import hashlib
+import json
+import re
+import subprocess
+import tempfile
+from abc import abstractmethod
+from collections.abc import Sequence
+from functools import cache
+from importlib.metadata import entry_points, version
+from pathlib import Path
+from typing import Any, Self
+
+from black.mode import TargetVersion
+from ruff.__main__ import find_ruff_bin
+
+from .cache import BlockCache
+from .config import RUFF_CONFIG_FILES, Config
+from .errors import LintError
+from .processors import BaseProcessor, BlackFormatter
+from .ruff_server import RuffServerError, get_server
+
+__all__ = (
+    "BACKENDS",
+    "BackendError",
+    "Chain",
+    "RuffChecker",
+    "RuffError",
+    "RuffFormatter",
+    "backend_names",
+    "create_processor",
+    "get_backend",
+)
+
+# Third-party backends are BaseProcessor subclasses registered under this
+# entry point group, by name.
+ENTRY_POINT_GROUP = "ruffen_docs.backends"
+
+# ruff reports code it can't parse as "<file>:<line>:<column>: <message>".
+RUFF_FORMAT_ERROR_RE = re.compile(
+    r"^error: Failed to parse (?P<path>.+?):(?P<location>\d+:\d+: .*)$", re.MULTILINE
+)
+RUFF_CHECK_ERROR_RE = re.compile(
+    r"^(?P<path>.+?):(?P<line>\d+):(?P<column>\d+): invalid-syntax: (?P<message>.*)$",
+    re.MULTILINE,
+)
+# And diagnostics of rules, fixable ones marked with "[*]".
+RUFF_CHECK_DIAGNOSTIC_RE = re.compile(
+    r"^(?P<path>.+?):(?P<line>\d+):(?P<column>\d+): "
+    r"(?P<code>[A-Z]+[0-9]+) (?:\[\*\] )?(?P<message>.*)$",
+    re.MULTILINE,
+)
+
+
+class BackendError(Exception):
+    pass
+
+
+class RuffError(Exception):
+    pass
+
+
+def _ruff_target_version(target_versions: frozenset[TargetVersion]) -> str | None:
+    # ruff takes the oldest version to support, and knows nothing older than
+    # Python 3.7.
+    if not target_versions:
+        return None
+
+    oldest = min(target_versions, key=lambda v: v.value)
+
+    return f"py3{max(oldest.value, 7)}"
+
+
+def _ruff_config_digest(directory: Path) -> str:
+    # The nearest ruff configuration file, found the way ruff finds it, as a
+    # digest of its contents, or "" if there is none. Files it extends
+    # aren't included.
+    for parent in (directory, *directory.parents):
+        for name in RUFF_CONFIG_FILES:
+            try:
+                data = (parent / name).read_bytes()
+            except OSError:
+                continue
+
+            if name == "pyproject.toml" and b"[tool.ruff" not in data:
+                continue
+
+            return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    return ""
+
+
+class _Ruff(BaseProcessor):
+    # Blocks are sent to a ruff server shared by every processor with the
+    # same settings, which runs in its own process, so they can be formatted
+    # from many threads at once. Without server, or if ruff can't run as one,
+    # ruff is run on the blocks of each document instead.
+    thread_safe = True
+    supports_batching = True
+    ruff_config = True
+    command = ""
+
+    def __init__(
+        self,
+        line_length: int | None = None,
+        target_version: str | None = None,
+        string_normalization: bool = True,
+        is_pyi: bool = False,
+        preview: bool = False,
+        server: bool = True,
+    ) -> None:
+        self.ruff = find_ruff_bin()
+        self.options = []
+        self.configuration: dict[str, Any] = {}
+        if line_length is not None:
+            self.options += ("--line-length", str(line_length))
+            self.configuration["line-length"] = line_length
+        if target_version is not None:
+            self.options += ("--target-version", target_version)
+            self.configuration["target-version"] = target_version
+        if not string_normalization:
+            self.options += ("--config", "format.quote-style = 'preserve'")
+            self.configuration["format"] = {"quote-style": "preserve"}
+        if preview:
+            self.options.append("--preview")
+            self.configuration["preview"] = True
+        self.suffix = ".pyi" if is_pyi else ".py"
+        self.server = server
+
+        super().__init__()
+
+    @classmethod
+    def from_config(cls, config: Config) -> Self:
+        return cls(
+            line_length=config.line_length,
+            target_version=_ruff_target_version(config.target_versions),
+            string_normalization=config.string_normalization,
+            is_pyi=config.is_pyi,
+            preview=config.preview,
+        )
+
+    @property
+    def cache_key(self) -> tuple[str, str, str]:
+        settings = {**self.configuration, "suffix": self.suffix}
+        return (
+            f"ruff-{self.command}",
+            version("ruff"),
+            json.dumps(settings, sort_keys=True),
+        )
+
+    def _run(
+        self, *args: str, code: str | None = None
+    ) -> subprocess.CompletedProcess[str]:
+        return subprocess.run(
+            (self.ruff, *args, *self.options),
+            input=code,
+            capture_output=True,
+            encoding="UTF-8",
+        )
+
+    @abstractmethod
+    def _serve(self, code_blocks: Sequence[str]) -> list[str | Exception]:
+        pass  # pragma: no cover
+
+    @abstractmethod
+    def _invoke(self, code_blocks: Sequence[str]) -> list[str | Exception]:
+        pass  # pragma: no cover
+
+    def process_code_block(self, code_block: str) -> str:
+        [output] = self.process_code_blocks([code_block])
+
+        if isinstance(output, Exception):
+            raise output
+
+        return output
+
+    def process_code_blocks(self, code_blocks: Sequence[str]) -> list[str | Exception]:
+        if self.server:
+            try:
+                return self._serve(code_blocks)
+            except RuffServerError:
+                pass
+
+        return self._invoke(code_blocks)
+
+
+class RuffFormatter(_Ruff):
+    # Settings come from the configuration, as for Black, and not from ruff's
+    # own discovery, so without a server blocks can be formatted as files in
+    # a temporary directory, with one ruff run per document.
+    command = "format"
+    normalizes_whitespace = True
+
+    def _serve(self, code_blocks: Sequence[str]) -> list[str | Exception]:
+        server = get_server(self.configuration, editor_only=True)
+        return server.format(code_blocks, self.suffix)
+
+    def _format(self, code_block: str) -> str:
+        result = self._run(
+            "format",
+            "--isolated",
+            f"--stdin-filename=block{self.suffix}",
+            "-",
+            code=code_block,
+        )
+
+        if result.returncode != 0:
+            error = RUFF_FORMAT_ERROR_RE.search(result.stderr)
+            if error is None:
+                raise RuffError(result.stderr.strip())
+            raise RuffError(f"Cannot parse: {error['location']}")
+
+        return result.stdout
+
+    def _invoke(self, code_blocks: Sequence[str]) -> list[str | Exception]:
+        if len(code_blocks) == 1:
+            try:
+                return [self._format(code_blocks[0])]
+            except RuffError as e:
+                return [e]
+
+        with tempfile.TemporaryDirectory(prefix="ruffen-docs-") as directory:
+            paths = [
+                Path(directory, f"{i}{self.suffix}") for i in range(len(code_blocks))
+            ]
+            for path, code_block in zip(paths, code_blocks, strict=True):
+                path.write_text(code_block, encoding="UTF-8")
+
+            result = self._run("format", "--isolated", "--no-cache", directory)
+            errors = {
+                Path(error["path"]).name: RuffError(
+                    f"Cannot parse: {error['location']}"
+                )
+                for error in RUFF_FORMAT_ERROR_RE.finditer(result.stderr)
+            }
+
+            if result.returncode != 0 and not errors:
+                raise RuffError(result.stderr.strip())
+
+            return [
+                errors.get(path.name) or path.read_text(encoding="UTF-8")
+                for path in paths
+            ]
+
+
+class RuffChecker(_Ruff):
+    # Applies ruff's fixes. The rules to apply come from ruff's configuration
+    # for the working directory, which files in a temporary directory
+    # wouldn't see, so without a server every block is checked on its own.
+    # A block with diagnostics ruff can't fix is left as it is, and they are
+    # all reported, where they are in it, as a LintError.
+    command = "check"
+
+    @property
+    def cache_key(self) -> tuple[str, str, str]:
+        # The rules come from the configuration ruff finds, which may change
+        # without ruff changing.
+        backend, ruff_version, settings = super().cache_key
+        return backend, ruff_version, settings + _ruff_config_digest(Path.cwd())
+
+    def _serve(self, code_blocks: Sequence[str]) -> list[str | Exception]:
+        server = get_server(self.configuration, editor_only=False)
+        return server.fix(code_blocks, self.suffix)
+
+    def check_code_block(self, code_block: str) -> None:
+        # Diagnostics are errors too.
+        self.process_code_block(code_block)
+
+    def _lint(self, code_block: str, fix: str) -> subprocess.CompletedProcess[str]:
+        result = self._run(
+            "check",
+            fix,
+            "--output-format=concise",
+            f"--stdin-filename=block{self.suffix}",
+            "-",
+            code=code_block,
+        )
+
+        error = RUFF_CHECK_ERROR_RE.search(result.stderr)
+        if error is not None:
+            raise RuffError(
+                f"Cannot parse: {error['line']}:{error['column']}: {error['message']}"
+            )
+
+        return result
+
+    def _check(self, code_block: str) -> str:
+        result = self._lint(code_block, "--fix")
+        if result.returncode == 0:
+            return result.stdout
+
+        # Diagnostics the fixes leave behind are found in the fixed code.
+        if result.returncode == 1 and result.stdout != code_block:
+            result = self._lint(code_block, "--no-fix")
+
+        # Without fixes, they are written to stdout.
+        diagnostics = list(
+            RUFF_CHECK_DIAGNOSTIC_RE.finditer(result.stderr + result.stdout)
+        )
+        if result.returncode != 1 or not diagnostics:
+            raise RuffError(result.stderr.strip())
+
+        raise LintError(
+            "\n".join(
+                f"{d['line']}:{d['column']}: {d['code']} {d['message']}"
+                for d in diagnostics
+            )
+        )
+
+    def _invoke(self, code_blocks: Sequence[str]) -> list[str | Exception]:
+        outputs: list[str | Exception] = []
+
+        for code_block in code_blocks:
+            try:
+                outputs.append(self._check(code_block))
+            except (LintError, RuffError) as e:
+                outputs.append(e)
+
+        return outputs
+
+
+class Chain(BaseProcessor):
+    # Runs backends over each code block in turn, each given the output of
+    # the last, so that a document is scanned, and written, once for all of
+    # them. A block one of them can't process is reported with its error.
+    backends: tuple[type[BaseProcessor], ...] = ()
+
+    def __init__(self, processors: Sequence[BaseProcessor]) -> None:
+        self.processors = list(processors)
+
+        super().__init__()
+
+    @classmethod
+    def from_config(cls, config: Config) -> Self:
+        return cls([backend.from_config(config) for backend in cls.backends])
+
+    @property
+    def cache_key(self) -> tuple[str, str, str] | None:
+        keys = [processor.cache_key for processor in self.processors]
+        if any(key is None for key in keys):
+            return None
+
+        backends, versions, settings = zip(*keys, strict=True)
+        return ",".join(backends), ",".join(versions), json.dumps(settings)
+
+    def process_code_block(self, code_block: str) -> str:
+        for processor in self.processors:
+            code_block = processor.process_code_block(code_block)
+
+        return code_block
+
+    def process_code_blocks(self, code_blocks: Sequence[str]) -> list[str | Exception]:
+        outputs: list[str | Exception] = list(code_blocks)
+
+        for processor in self.processors:
+            pending = [
+                (i, output)
+                for i, output in enumerate(outputs)
+                if isinstance(output, str)
+            ]
+            if not pending:
+                break
+
+            results = processor.process_code_blocks([code for _, code in pending])
+            for (i, _), result in zip(pending, results, strict=True):
+                outputs[i] = result
+
+        return outputs
+
+
+@cache
+def _chain(names: tuple[str, ...]) -> type[Chain]:
+    backends = tuple(get_backend(name) for name in names)
+
+    return type(
+        "Chain",
+        (Chain,),
+        {
+            "backends": backends,
+            "thread_safe": all(backend.thread_safe for backend in backends),
+            "process_safe": all(backend.process_safe for backend in backends),
+            "supports_batching": any(backend.supports_batching for backend in backends),
+            "normalizes_whitespace": all(
+                backend.normalizes_whitespace for backend in backends
+            ),
+            "ruff_config": all(backend.ruff_config for backend in backends),
+        },
+    )
+
+
+BACKENDS: dict[str, type[BaseProcessor]] = {
+    "black": BlackFormatter,
+    "ruff-format": RuffFormatter,
+    "ruff-check": RuffChecker,
+}
+
+
+def backend_names() -> list[str]:
+    return sorted({*BACKENDS, *entry_points(group=ENTRY_POINT_GROUP).names})
+
+
+def get_backend(name: str) -> type[BaseProcessor]:
+    # Names separated by commas are a Chain of those backends.
+    if "," in name:
+        return _chain(tuple(name.split(",")))
+
+    if name in BACKENDS:
+        return BACKENDS[name]
+
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP, name=name):
+        try:
+            backend = entry_point.load()
+        except Exception as e:
+            raise BackendError(f"can't load backend {name!r}: {e}") from e
+
+        if not (isinstance(backend, type) and issubclass(backend, BaseProcessor)):
+            raise BackendError(f"backend {name!r} is not a BaseProcessor subclass")
+
+        return backend
+
+    raise BackendError(f"unknown backend {name!r}, choose from {backend_names()}")
+
+
+def create_processor(
+    name: str,
+    config: Config,
+    cache_dir: str | None = None,
+) -> BaseProcessor:
+    # A processor of the named backend, with the limits of config, and the
+    # cache in cache_dir if the backend can be cached.
+    processor = get_backend(name).from_config(config)
+    processor.block_timeout = config.block_timeout
+    processor.max_block_lines = config.max_block_lines
+
+    if cache_dir is not None:
+        key = processor.cache_key
+        if key is not None:
+            processor.cache = BlockCache(cache_dir, key)
+
+    return processor
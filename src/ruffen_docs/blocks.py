@@ -0,0 +1,100 @@
+from typing import Self
+
+from .scanners import AnyMatch
+
+__all__ = ("CodeBlock",)
+
+
+class CodeBlock:
+    # A code block found in a document, as plain integers and an interned
+    # dialect name, so that many can be held in memory or sent to other
+    # processes cheaply. Offsets are into the original document, and the
+    # file id is whatever the caller uses to tell documents apart.
+    __slots__ = (
+        "code_end",
+        "code_start",
+        "dialect",
+        "end",
+        "file_id",
+        "indent",
+        "start",
+    )
+
+    def __init__(
+        self,
+        file_id: int,
+        dialect: str,
+        start: int,
+        end: int,
+        indent: int,
+        code_start: int,
+        code_end: int,
+    ) -> None:
+        self.file_id = file_id
+        self.dialect = dialect
+        self.start = start
+        self.end = end
+        self.indent = indent
+        self.code_start = code_start
+        self.code_end = code_end
+
+    @classmethod
+    def from_match(cls, match: AnyMatch, dialect: str, file_id: int = 0) -> Self:
+        indent_start, indent_end = match.span("indent")
+        code_start, code_end = match.span("code")
+
+        return cls(
+            file_id,
+            dialect,
+            match.start(),
+            match.end(),
+            indent_end - indent_start,
+            code_start,
+            code_end,
+        )
+
+    def shifted(self, offset: int) -> Self:
+        # The same block, in a document with offset more characters before it.
+        return type(self)(
+            self.file_id,
+            self.dialect,
+            self.start + offset,
+            self.end + offset,
+            self.indent,
+            self.code_start + offset,
+            self.code_end + offset,
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CodeBlock):
+            return NotImplemented
+
+        return self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def __repr__(self) -> str:
+        return (
+            f"CodeBlock(file_id={self.file_id!r}, dialect={self.dialect!r}, "
+            f"start={self.start!r}, end={self.end!r}, indent={self.indent!r}, "
+            f"code_start={self.code_start!r}, code_end={self.code_end!r})"
+        )
+
+    def _key(self) -> tuple[int, str, int, int, int, int, int]:
+        return (
+            self.file_id,
+            self.dialect,
+            self.start,
+            self.end,
+            self.indent,
+            self.code_start,
+            self.code_end,
+        )
+
+    @property
+    def span(self) -> tuple[int, int]:
+        return self.start, self.end
+
+    def code(self, src: str) -> str:
+        return src[self.code_start : self.code_end]
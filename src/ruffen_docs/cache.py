@@ -0,0 +1,380 @@
+import dataclasses
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any
+
+from .prechecks import fingerprint
+
+__all__ = (
+    "CACHE_DIR_VARIABLE",
+    "BlockCache",
+    "CacheError",
+    "CacheStats",
+    "cache_stats",
+    "merge_caches",
+    "prune_cache",
+)
+
+# The environment variable for the cache directory, when --cache-dir isn't
+# given.
+CACHE_DIR_VARIABLE = "RUFFEN_DOCS_CACHE_DIR"
+CACHE_FILE = "blocks.sqlite3"
+# Caches of other schema versions are emptied when they are opened.
+SCHEMA_VERSION = 1
+# Seconds to wait for other processes writing to the cache.
+LOCK_TIMEOUT = 30.0
+# How stale the time a block was last used may get before it is updated, so
+# that reading a block doesn't write to the cache every time.
+USED_RESOLUTION = 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE blocks (
+    backend TEXT NOT NULL,
+    version TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    input BLOB NOT NULL,
+    output TEXT,
+    checksum BLOB NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (backend, version, settings, input)
+) WITHOUT ROWID
+"""
+
+
+class CacheError(Exception):
+    pass
+
+
+def _schema_version(connection: sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    # Opens the cache, creating it if needed, and starting afresh if it isn't
+    # a database this version can use.
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        raise CacheError(f"can't create cache directory: {e}") from e
+
+    for attempt in range(2):
+        try:
+            connection = sqlite3.connect(
+                path,
+                timeout=LOCK_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+        except sqlite3.Error as e:
+            raise CacheError(f"{path}: {e}") from e
+
+        try:
+            # Writers append to a log, so that readers in other processes
+            # aren't blocked.
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            if _schema_version(connection) != SCHEMA_VERSION:
+                with connection:
+                    # Again, as another process may have just done this.
+                    connection.execute("BEGIN IMMEDIATE")
+                    if _schema_version(connection) != SCHEMA_VERSION:
+                        connection.execute("DROP TABLE IF EXISTS blocks")
+                        connection.execute(_SCHEMA)
+                        connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        except sqlite3.DatabaseError as e:
+            connection.close()
+            # A cache that is damaged, or isn't one, is thrown away once.
+            if attempt or isinstance(e, sqlite3.OperationalError):
+                raise CacheError(f"{path}: {e}") from e
+            for suffix in ("", "-wal", "-shm"):
+                Path(f"{path}{suffix}").unlink(missing_ok=True)
+            continue
+
+        return connection
+
+    raise AssertionError  # pragma: no cover
+
+
+def _open(path: Path) -> sqlite3.Connection:
+    # Opens a cache to read it as it is: unlike with _connect(), a cache that
+    # is missing, damaged, or isn't one, is left alone.
+    if not path.is_file():
+        raise CacheError(f"{path}: no such cache file")
+
+    try:
+        return sqlite3.connect(
+            f"{path.resolve().as_uri()}?mode=ro",
+            uri=True,
+            timeout=LOCK_TIMEOUT,
+            isolation_level=None,
+        )
+    except sqlite3.Error as e:
+        raise CacheError(f"{path}: {e}") from e
+
+
+class BlockCache:
+    # Outputs of a backend, with one cache_key, for the blocks it formatted,
+    # kept in an SQLite file in directory. Blocks are found by the
+    # fingerprint of their code, so that the same code anywhere, in any
+    # project using the same settings, is formatted once. The cache is one
+    # file, which CI can save and restore between runs; blocks formatted by
+    # other versions of the backend are dropped when it is first opened with
+    # a new one.
+    def __init__(
+        self,
+        directory: str | os.PathLike[str],
+        key: tuple[str, str, str],
+    ) -> None:
+        self.path = Path(directory) / CACHE_FILE
+        self.backend, self.version, self.settings = key
+        self._connection: sqlite3.Connection | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+        # Blocks read or written this run, so each is read once.
+        self._known: dict[bytes, str | None] = {}
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {**self.__dict__, "_connection": None, "_lock": None}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state, _lock=threading.Lock())
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections aren't used across fork(), which worker processes
+        # started by it would inherit.
+        if self._connection is None or self._pid != os.getpid():
+            connection = _connect(self.path)
+            try:
+                connection.execute(
+                    "DELETE FROM blocks WHERE backend = ? AND version != ?",
+                    (self.backend, self.version),
+                )
+            except sqlite3.Error as e:
+                raise CacheError(f"{self.path}: {e}") from e
+            self._connection = connection
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def open(self) -> None:
+        # Opens the cache ahead of first use, to find out if it can be.
+        with self._lock:
+            self._connect()
+
+    def get(self, code_block: str, key: bytes | None = None) -> str | None:
+        # The output for code_block, or None if it isn't in the cache. key is
+        # fingerprint(code_block), if already known.
+        key = fingerprint(code_block) if key is None else key
+        if key in self._known:
+            output = self._known[key]
+            return code_block if output is None else output
+
+        with self._lock:
+            connection = self._connect()
+            try:
+                row = connection.execute(
+                    "SELECT output, checksum, used FROM blocks "
+                    "WHERE backend = ? AND version = ? AND settings = ? AND input = ?",
+                    (self.backend, self.version, self.settings, key),
+                ).fetchone()
+            except sqlite3.Error as e:
+                raise CacheError(f"{self.path}: {e}") from e
+
+            if row is None:
+                return None
+
+            output, checksum, used = row
+            if fingerprint(code_block if output is None else output) != checksum:
+                # Damaged, so it is formatted again, and replaced.
+                self._delete(connection, key)
+                return None
+
+            now = int(time.time())
+            if now - used > USED_RESOLUTION:
+                self._execute(
+                    connection,
+                    "UPDATE blocks SET used = ? WHERE backend = ? AND version = ? "
+                    "AND settings = ? AND input = ?",
+                    (now, self.backend, self.version, self.settings, key),
+                )
+
+        self._known[key] = output
+        return code_block if output is None else output
+
+    def put(self, code_block: str, output: str, key: bytes | None = None) -> None:
+        key = fingerprint(code_block) if key is None else key
+        # Most blocks are already formatted, and aren't stored twice.
+        stored = None if output == code_block else output
+
+        with self._lock:
+            self._execute(
+                self._connect(),
+                "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.backend,
+                    self.version,
+                    self.settings,
+                    key,
+                    stored,
+                    fingerprint(output),
+                    int(time.time()),
+                ),
+            )
+
+        self._known[key] = stored
+
+    def _delete(self, connection: sqlite3.Connection, key: bytes) -> None:
+        self._execute(
+            connection,
+            "DELETE FROM blocks "
+            "WHERE backend = ? AND version = ? AND settings = ? AND input = ?",
+            (self.backend, self.version, self.settings, key),
+        )
+
+    def _execute(
+        self,
+        connection: sqlite3.Connection,
+        sql: str,
+        parameters: Sequence[Any],
+    ) -> None:
+        try:
+            connection.execute(sql, parameters)
+        except sqlite3.Error as e:
+            raise CacheError(f"{self.path}: {e}") from e
+
+    def close(self) -> None:
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+
+@dataclasses.dataclass
+class CacheStats:
+    path: Path
+    size: int
+    # Blocks by (backend, version).
+    blocks: dict[tuple[str, str], int]
+    # What SQLite's integrity check found, "ok" if nothing.
+    integrity: str
+
+    def summary(self) -> str:
+        lines = [f"{self.path}: {self.size} bytes, integrity {self.integrity}"]
+        lines += [
+            f"  {backend} {version}: {count} code blocks"
+            for (backend, version), count in sorted(self.blocks.items())
+        ]
+        return "\n".join(lines)
+
+
+def cache_stats(directory: str | os.PathLike[str]) -> CacheStats:
+    path = Path(directory) / CACHE_FILE
+    connection = _open(path)
+    blocks: dict[tuple[str, str], int] = {}
+
+    try:
+        try:
+            integrity = "; ".join(
+                message for (message,) in connection.execute("PRAGMA integrity_check")
+            )
+        except sqlite3.DatabaseError as e:
+            # A cache that is damaged, or isn't one, is reported as such.
+            if isinstance(e, sqlite3.OperationalError):
+                raise
+            integrity = str(e)
+
+        if integrity == "ok":
+            schema_version = _schema_version(connection)
+            if schema_version != SCHEMA_VERSION:
+                integrity = f"schema version {schema_version}, not {SCHEMA_VERSION}"
+            else:
+                blocks = {
+                    (backend, version): count
+                    for backend, version, count in connection.execute(
+                        "SELECT backend, version, count(*) FROM blocks "
+                        "GROUP BY backend, version"
+                    )
+                }
+    except sqlite3.Error as e:
+        raise CacheError(f"{path}: {e}") from e
+    finally:
+        connection.close()
+
+    # The database file and its log, which isn't written back to it here.
+    size = sum(
+        file.stat().st_size for file in (path, Path(f"{path}-wal")) if file.is_file()
+    )
+    return CacheStats(path, size, blocks, integrity)
+
+
+def prune_cache(directory: str | os.PathLike[str], max_age: float) -> int:
+    # Deletes blocks not used for max_age seconds, and shrinks the file to
+    # what is left. Returns how many were deleted.
+    path = Path(directory) / CACHE_FILE
+    connection = _connect(path)
+
+    try:
+        deleted = connection.execute(
+            "DELETE FROM blocks WHERE used < ?", (int(time.time() - max_age),)
+        ).rowcount
+        connection.execute("VACUUM")
+    except sqlite3.Error as e:
+        raise CacheError(f"{path}: {e}") from e
+    finally:
+        connection.close()
+
+    return deleted
+
+
+def merge_caches(
+    directory: str | os.PathLike[str],
+    others: Sequence[str | os.PathLike[str]],
+) -> int:
+    # Adds the blocks of other cache files, like those of the shards of a
+    # run, to the cache in directory. Returns how many were added. The other
+    # files are only read, and must be caches of this version.
+    path = Path(directory) / CACHE_FILE
+    sources = []
+    try:
+        for other in others:
+            source = _open(Path(other))
+            sources.append(source)
+            try:
+                version = _schema_version(source)
+            except sqlite3.Error as e:
+                raise CacheError(f"{other}: {e}") from e
+            if version != SCHEMA_VERSION:
+                raise CacheError(f"{other}: not a ruffen-docs cache of this version")
+
+        connection = _connect(path)
+        try:
+            [before] = connection.execute("SELECT count(*) FROM blocks").fetchone()
+
+            for other, source in zip(others, sources, strict=True):
+                try:
+                    rows = source.execute("SELECT * FROM blocks")
+                    with connection:
+                        connection.execute("BEGIN IMMEDIATE")
+                        connection.executemany(
+                            "INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?) "
+                            "ON CONFLICT DO UPDATE SET used = max(used, excluded.used)",
+                            rows,
+                        )
+                except sqlite3.DatabaseError as e:
+                    if isinstance(e, sqlite3.OperationalError):
+                        raise
+                    raise CacheError(f"{other}: {e}") from e
+
+            [after] = connection.execute("SELECT count(*) FROM blocks").fetchone()
+        except sqlite3.Error as e:
+            raise CacheError(f"{path}: {e}") from e
+        finally:
+            connection.close()
+    finally:
+        for source in sources:
+            source.close()
+
+    return after - before
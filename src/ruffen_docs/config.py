@@ -0,0 +1,188 @@
+import dataclasses
+import tomllib
+from functools import cache
+from pathlib import Path
+from typing import Any
+
+from black.const import DEFAULT_LINE_LENGTH
+from black.mode import TargetVersion
+
+__all__ = (
+    "Config",
+    "ConfigError",
+    "clear_config_cache",
+    "resolve_config",
+)
+
+RUFF_CONFIG_FILES = (".ruff.toml", "ruff.toml", "pyproject.toml")
+
+
+class ConfigError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+    line_length: int = DEFAULT_LINE_LENGTH
+    target_versions: frozenset[TargetVersion] = frozenset()
+    string_normalization: bool = True
+    is_pyi: bool = False
+    preview: bool = False
+    rst_literal_blocks: bool = False
+    skip_errors: bool = False
+    exclude: str | None = None
+    block_timeout: float | None = None
+    max_block_lines: int | None = None
+
+
+@cache
+def _load_toml(path: Path) -> dict[str, Any] | None:
+    try:
+        with path.open("rb") as f:
+            return tomllib.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        raise ConfigError(f"{path}: {e}") from e
+
+
+def _target_versions(path: Path, value: Any) -> frozenset[TargetVersion]:
+    if isinstance(value, str):
+        value = [value]
+
+    if not isinstance(value, list):
+        raise ConfigError(f"{path}: target-version must be a string or a list")
+
+    try:
+        return frozenset(TargetVersion[v.upper()] for v in value)
+    except (AttributeError, KeyError) as e:
+        raise ConfigError(f"{path}: unknown target-version {e}") from e
+
+
+def _check_type(path: Path, key: str, value: Any, type_: type) -> Any:
+    if not isinstance(value, type_) or (type_ is int and isinstance(value, bool)):
+        raise ConfigError(f"{path}: {key} must be of type {type_.__name__}")
+
+    return value
+
+
+def _ruff_settings(path: Path, data: dict[str, Any]) -> dict[str, Any]:
+    settings: dict[str, Any] = {}
+
+    if "line-length" in data:
+        settings["line_length"] = _check_type(
+            path, "line-length", data["line-length"], int
+        )
+
+    if "target-version" in data:
+        target_version = _check_type(
+            path, "target-version", data["target-version"], str
+        )
+        # Black may not know about the newest versions ruff supports, in which
+        # case it infers the target versions from the code, as by default.
+        if target_version.upper() in TargetVersion.__members__:
+            settings["target_versions"] = _target_versions(path, target_version)
+
+    preview = data.get("format", {}).get("preview", data.get("preview"))
+    if preview is not None:
+        settings["preview"] = _check_type(path, "preview", preview, bool)
+
+    if data.get("format", {}).get("quote-style") == "preserve":
+        settings["string_normalization"] = False
+
+    return settings
+
+
+def _ruffen_docs_settings(path: Path, data: dict[str, Any]) -> dict[str, Any]:
+    settings: dict[str, Any] = {}
+    types = {
+        "line-length": ("line_length", int),
+        "skip-string-normalization": ("string_normalization", bool),
+        "pyi": ("is_pyi", bool),
+        "preview": ("preview", bool),
+        "rst-literal-blocks": ("rst_literal_blocks", bool),
+        "skip-errors": ("skip_errors", bool),
+        "exclude": ("exclude", str),
+        "max-block-lines": ("max_block_lines", int),
+    }
+
+    for key, value in data.items():
+        if key == "target-version":
+            settings["target_versions"] = _target_versions(path, value)
+            continue
+
+        if key == "block-timeout":
+            # Whole numbers of seconds are read as integers.
+            if isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+            settings["block_timeout"] = _check_type(path, key, value, float)
+            continue
+
+        try:
+            name, type_ = types[key]
+        except KeyError:
+            raise ConfigError(f"{path}: unknown option {key!r}") from None
+
+        settings[name] = _check_type(path, key, value, type_)
+
+    if "string_normalization" in settings:
+        settings["string_normalization"] = not settings["string_normalization"]
+
+    return settings
+
+
+@cache
+def _ruff_config(directory: Path) -> dict[str, Any]:
+    # The nearest ruff configuration, found the way ruff finds it.
+    for name in RUFF_CONFIG_FILES:
+        path = directory / name
+        data = _load_toml(path)
+
+        if data is None:
+            continue
+
+        if name == "pyproject.toml":
+            if "ruff" not in data.get("tool", {}):
+                continue
+            data = data["tool"]["ruff"]
+
+        return _ruff_settings(path, data)
+
+    if directory.parent == directory:
+        return {}
+
+    return _ruff_config(directory.parent)
+
+
+@cache
+def _ruffen_docs_config(directory: Path) -> dict[str, Any]:
+    path = directory / "pyproject.toml"
+    data = _load_toml(path)
+
+    if data is not None and "ruffen-docs" in data.get("tool", {}):
+        return _ruffen_docs_settings(path, data["tool"]["ruffen-docs"])
+
+    if directory.parent == directory:
+        return {}
+
+    return _ruffen_docs_config(directory.parent)
+
+
+@cache
+def resolve_config(directory: Path, *, ruff: bool = False) -> Config:
+    # With ruff, for the ruff backends, ruff's own settings are used too, and
+    # those from [tool.ruffen-docs] take precedence. Every directory is
+    # resolved once, and every file read once, until clear_config_cache().
+    directory = directory.resolve()
+
+    return Config(**{
+        **(_ruff_config(directory) if ruff else {}),
+        **_ruffen_docs_config(directory),
+    })
+
+
+def clear_config_cache() -> None:
+    # For files that may have changed: runs clear it before they start, and
+    # --watch and the language server each time they format again.
+    for function in (_load_toml, _ruff_config, _ruffen_docs_config, resolve_config):
+        function.cache_clear()
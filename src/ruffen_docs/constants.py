@@ -1,10 +1,19 @@
 __all__ = (
+    "DOC_FILE_SUFFIXES",
     "ON_OFF",
     "PYCON_CONTINUATION_PREFIX",
     "PYGMENTS_PY_LANGS",
     "PYTHONTEX_LANG",
 )
 
+# Matches the `files` pattern of the pre-commit hooks.
+DOC_FILE_SUFFIXES = frozenset((
+    ".markdown",
+    ".md",
+    ".py",
+    ".rst",
+    ".tex",
+))
 ON_OFF = r"ruffen-docs:(on|off)"
 PYCON_CONTINUATION_PREFIX = "..."
 PYGMENTS_PY_LANGS = frozenset((
@@ -0,0 +1,233 @@
+from collections.abc import Iterator, Sequence
+from difflib import SequenceMatcher
+
+__all__ = (
+    "color_diff",
+    "unified_diff",
+)
+
+NO_NEWLINE_MARKER = "\\ No newline at end of file\n"
+
+# (tag, i1, i2, j1, j2) in whole-document line numbers, plus the lines of the
+# new document for j1:j2. Only changed chunks carry their own lines, the
+# unchanged stretches between them are read back from the original document.
+type Opcode = tuple[str, int, int, int, int, Sequence[str]]
+
+
+def _split_lines(text: str) -> list[str]:
+    # Like str.splitlines(keepends=True), but only splitting on "\n" so line
+    # numbers agree with the offsets used everywhere else.
+    lines = [f"{line}\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+
+    if not lines[-1]:
+        lines.pop()
+
+    return lines
+
+
+def _line_end(src: str, pos: int) -> int:
+    newline = src.find("\n", pos)
+    return len(src) if newline == -1 else newline + 1
+
+
+def _chunks(
+    src: str,
+    edits: Sequence[tuple[int, int, str]],
+) -> Iterator[tuple[int, str, str]]:
+    # Widen runs of edits to whole lines and yield the number of the first
+    # line with the old and new text of each run.
+    lineno = 0
+    pos = 0
+    index = 0
+
+    while index < len(edits):
+        chunk_start = src.rfind("\n", 0, edits[index][0]) + 1
+        chunk_end = cursor = chunk_start
+        parts: list[str] = []
+
+        while True:
+            # Take in edits on the same or directly following lines.
+            while (
+                index < len(edits)
+                and src.rfind("\n", 0, edits[index][0]) + 1 <= chunk_end
+            ):
+                start, end, replacement = edits[index]
+                parts += (src[cursor:start], replacement)
+                cursor = chunk_end = end
+                index += 1
+
+            new = "".join(parts) + src[cursor:chunk_end]
+
+            # Both texts have to end on a line boundary.
+            if chunk_end == len(src) or (
+                src[chunk_end - 1] == "\n" and (not new or new.endswith("\n"))
+            ):
+                break
+
+            chunk_end = _line_end(src, chunk_end)
+
+        lineno += src.count("\n", pos, chunk_start)
+        pos = chunk_start
+
+        yield lineno, src[chunk_start:chunk_end], new
+
+
+def _opcodes(
+    src: str,
+    edits: Sequence[tuple[int, int, str]],
+    a_len: int,
+) -> list[Opcode]:
+    opcodes: list[Opcode] = []
+    a_pos = 0
+    offset = 0
+
+    def add(opcode: Opcode) -> None:
+        tag, i1, i2, j1, j2, lines = opcode
+
+        if i1 == i2 and j1 == j2:
+            return
+
+        if tag == "equal" and opcodes and opcodes[-1][0] == "equal":
+            _, i1, _, j1, _, _ = opcodes.pop()
+
+        opcodes.append((tag, i1, i2, j1, j2, lines))
+
+    for lineno, old, new in _chunks(src, edits):
+        add(("equal", a_pos, lineno, a_pos + offset, lineno + offset, ()))
+
+        a_lines = _split_lines(old)
+        b_lines = _split_lines(new)
+        # Only the lines of the changed block are matched against each
+        # other, which keeps this cheap on large documents.
+        matcher = SequenceMatcher(None, a_lines, b_lines, autojunk=False)
+
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            add((
+                tag,
+                lineno + i1,
+                lineno + i2,
+                lineno + offset + j1,
+                lineno + offset + j2,
+                b_lines[j1:j2],
+            ))
+
+        a_pos = lineno + len(a_lines)
+        offset += len(b_lines) - len(a_lines)
+
+    add(("equal", a_pos, a_len, a_pos + offset, a_len + offset, ()))
+
+    return opcodes
+
+
+def _grouped_opcodes(
+    opcodes: list[Opcode],
+    n_lines: int,
+) -> Iterator[list[Opcode]]:
+    # Adapted from difflib.SequenceMatcher.get_grouped_opcodes().
+    if not opcodes:
+        return
+
+    tag, i1, i2, j1, j2, lines = opcodes[0]
+    if tag == "equal":
+        opcodes[0] = tag, max(i1, i2 - n_lines), i2, max(j1, j2 - n_lines), j2, lines
+
+    tag, i1, i2, j1, j2, lines = opcodes[-1]
+    if tag == "equal":
+        opcodes[-1] = tag, i1, min(i2, i1 + n_lines), j1, min(j2, j1 + n_lines), lines
+
+    nn = n_lines + n_lines
+    group: list[Opcode] = []
+
+    for tag, i1, i2, j1, j2, lines in opcodes:
+        if tag == "equal" and i2 - i1 > nn:
+            group.append((
+                tag,
+                i1,
+                min(i2, i1 + n_lines),
+                j1,
+                min(j2, j1 + n_lines),
+                (),
+            ))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n_lines), max(j1, j2 - n_lines)
+
+        group.append((tag, i1, i2, j1, j2, lines))
+
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range(start: int, stop: int) -> str:
+    # Adapted from difflib._format_range_unified().
+    beginning = start + 1
+    length = stop - start
+
+    if length == 1:
+        return f"{beginning}"
+
+    if not length:
+        beginning -= 1
+
+    return f"{beginning},{length}"
+
+
+def _diff_line(prefix: str, line: str) -> str:
+    if line.endswith("\n"):
+        return f"{prefix}{line}"
+
+    return f"{prefix}{line}\n{NO_NEWLINE_MARKER}"
+
+
+def unified_diff(
+    src: str,
+    edits: Sequence[tuple[int, int, str]],
+    filename: str,
+    n_lines: int = 3,
+) -> str:
+    # Diff src against src with edits applied. The edits are sorted,
+    # non-overlapping (start, end, replacement) tuples as collected by the
+    # processors, so there is no need to match the whole documents.
+    if not edits:
+        return ""
+
+    a_lines = _split_lines(src)
+    result = [f"--- {filename}\n", f"+++ {filename}\n"]
+
+    for group in _grouped_opcodes(_opcodes(src, edits, len(a_lines)), n_lines):
+        first, last = group[0], group[-1]
+        a_range = _format_range(first[1], last[2])
+        b_range = _format_range(first[3], last[4])
+        result.append(f"@@ -{a_range} +{b_range} @@\n")
+
+        for tag, i1, i2, _, _, lines in group:
+            if tag == "equal":
+                result += (_diff_line(" ", line) for line in a_lines[i1:i2])
+                continue
+
+            if tag in {"replace", "delete"}:
+                result += (_diff_line("-", line) for line in a_lines[i1:i2])
+
+            if tag in {"replace", "insert"}:
+                result += (_diff_line("+", line) for line in lines)
+
+    return "".join(result)
+
+
+def color_diff(contents: str) -> str:
+    # Inject ANSI color codes, the same way Black colors its diffs.
+    lines = contents.split("\n")
+
+    for i, line in enumerate(lines):
+        if line.startswith(("+++", "---")):
+            line = f"\033[1m{line}\033[0m"  # bold, reset
+        elif line.startswith("@@"):
+            line = f"\033[36m{line}\033[0m"  # cyan, reset
+        elif line.startswith("+"):
+            line = f"\033[32m{line}\033[0m"  # green, reset
+        elif line.startswith("-"):
+            line = f"\033[31m{line}\033[0m"  # red, reset
+        lines[i] = line
+
+    return "\n".join(lines)
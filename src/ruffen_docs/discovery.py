@@ -0,0 +1,195 @@
+import os
+import threading
+from collections.abc import Iterable, Iterator, Sequence
+from pathlib import Path
+from queue import SimpleQueue
+from re import Pattern
+
+from pathspec import GitIgnoreSpec
+
+from .constants import DOC_FILE_SUFFIXES
+
+__all__ = (
+    "is_included",
+    "iter_files",
+    "stream_files",
+)
+
+# (prefix, spec) pairs: a .gitignore spec with the path of the directory being
+# walked relative to the directory the .gitignore lives in.
+type Ignores = Sequence[tuple[str, GitIgnoreSpec]]
+
+
+def _read_gitignore(directory: Path) -> GitIgnoreSpec | None:
+    try:
+        lines = (directory / ".gitignore").read_text(encoding="UTF-8").splitlines()
+    except OSError:
+        return None
+
+    return GitIgnoreSpec.from_lines(lines)
+
+
+def _parent_ignores(root: Path) -> Ignores:
+    # .gitignore files above the walked directory apply to it as well, up to
+    # the root of the repository it belongs to.
+    root = root.resolve()
+
+    if (root / ".git").exists():
+        return ()
+
+    ignores = []
+    prefix = f"{root.name}/"
+
+    for parent in root.parents:
+        spec = _read_gitignore(parent)
+
+        if spec is not None:
+            ignores.append((prefix, spec))
+
+        if (parent / ".git").exists():
+            return ignores[::-1]
+
+        prefix = f"{parent.name}/{prefix}"
+
+    # Outside of a repository, .gitignore files in parents don't apply.
+    return ()
+
+
+def _skipped(
+    path: Path,
+    is_dir: bool,
+    root: Path,
+    ignores: Ignores,
+    exclude: Pattern[str] | None,
+) -> bool:
+    if path.name == ".git":
+        return True
+
+    name = f"{path.name}/" if is_dir else path.name
+
+    if any(spec.match_file(f"{prefix}{name}") for prefix, spec in ignores):
+        return True
+
+    if exclude is not None:
+        relative = f"/{path.relative_to(root).as_posix()}"
+        if exclude.search(f"{relative}/" if is_dir else relative):
+            return True
+
+    return False
+
+
+def _walk(
+    directory: Path,
+    root: Path,
+    ignores: Ignores,
+    exclude: Pattern[str] | None,
+) -> Iterator[str]:
+    spec = _read_gitignore(directory)
+
+    if spec is not None:
+        ignores = [*ignores, ("", spec)]
+
+    with os.scandir(directory) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+
+    for entry in entries:
+        # Don't follow symlinked directories, which could loop.
+        is_dir = entry.is_dir(follow_symlinks=False)
+        path = Path(entry.path)
+
+        if _skipped(path, is_dir, root, ignores, exclude):
+            continue
+
+        if is_dir:
+            yield from _walk(
+                path,
+                root,
+                [(f"{prefix}{entry.name}/", spec) for prefix, spec in ignores],
+                exclude,
+            )
+        elif path.suffix in DOC_FILE_SUFFIXES and entry.is_file():
+            yield entry.path
+
+
+def is_included(
+    path: str,
+    root: str,
+    exclude: Pattern[str] | None = None,
+) -> bool:
+    # Whether walking the root directory would yield the file at path, or
+    # walk into the directory at path, found by looking only at the
+    # directories in between.
+    directory = Path(root)
+    ignores = _parent_ignores(directory)
+
+    try:
+        parts = Path(path).relative_to(directory).parts
+    except ValueError:
+        return False
+
+    for i, part in enumerate(parts):
+        spec = _read_gitignore(directory)
+        if spec is not None:
+            ignores = [*ignores, ("", spec)]
+
+        is_dir = i < len(parts) - 1 or (directory / part).is_dir()
+        if _skipped(directory / part, is_dir, Path(root), ignores, exclude):
+            return False
+
+        # Don't follow symlinked directories, which could loop.
+        if is_dir and (directory / part).is_symlink():
+            return False
+
+        ignores = [(f"{prefix}{part}/", spec) for prefix, spec in ignores]
+        directory /= part
+
+    return directory.is_dir() or (
+        directory.suffix in DOC_FILE_SUFFIXES and directory.is_file()
+    )
+
+
+def iter_files(
+    paths: Iterable[str],
+    exclude: Pattern[str] | None = None,
+) -> Iterator[str]:
+    # Files are yielded as given. Directories are walked for documentation
+    # files, skipping anything matched by .gitignore files or by the exclude
+    # pattern, which is searched in the "/"-prefixed path relative to the
+    # directory, with a trailing "/" for directories.
+    for path in paths:
+        if Path(path).is_dir():
+            yield from _walk(
+                Path(path), Path(path), _parent_ignores(Path(path)), exclude
+            )
+        else:
+            yield path
+
+
+def stream_files(
+    paths: Sequence[str],
+    exclude: Pattern[str] | None = None,
+) -> Iterator[str]:
+    if not any(Path(path).is_dir() for path in paths):
+        yield from paths
+        return
+
+    # Walk in a background thread, so formatting starts with the first files
+    # found instead of waiting for the whole tree.
+    found: SimpleQueue[str | BaseException | None] = SimpleQueue()
+
+    def walk() -> None:
+        try:
+            for filename in iter_files(paths, exclude):
+                found.put(filename)
+        except BaseException as e:  # noqa: BLE001
+            found.put(e)
+        else:
+            found.put(None)
+
+    threading.Thread(target=walk, daemon=True).start()
+
+    while (item := found.get()) is not None:
+        if isinstance(item, BaseException):
+            raise item
+
+        yield item
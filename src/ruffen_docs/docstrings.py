@@ -0,0 +1,98 @@
+import ast
+import re
+
+__all__ = (
+    "escape_docstring",
+    "find_docstrings",
+)
+
+STRING_PREFIX_RE = re.compile(r"[rRuU]*")
+
+
+def _docstring_nodes(tree: ast.Module) -> list[ast.Constant]:
+    nodes = []
+
+    for node in ast.walk(tree):
+        if not isinstance(
+            node,
+            (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef),
+        ):
+            continue
+
+        if (
+            node.body
+            and isinstance(node.body[0], ast.Expr)
+            and isinstance(node.body[0].value, ast.Constant)
+            and isinstance(node.body[0].value.value, str)
+        ):
+            nodes.append(node.body[0].value)
+
+    return nodes
+
+
+def find_docstrings(src: str) -> list[tuple[int, int, str]] | None:
+    # Locate the contents of triple-quoted docstrings, as (start, end,
+    # opening) tuples where opening is the prefix and quotes the literal
+    # starts with. Returns None if the source can't be parsed.
+    try:
+        tree = ast.parse(src)
+    except (SyntaxError, ValueError):
+        return None
+
+    line_starts = [0, *(match.end() for match in re.finditer("\n", src))]
+    docstrings = []
+
+    def offset(lineno: int, col_offset: int) -> int:
+        # ast column offsets count UTF-8 bytes.
+        line_start = line_starts[lineno - 1]
+        line = src[line_start : line_start + col_offset]
+
+        if line.isascii():
+            return line_start + col_offset
+
+        return line_start + len(line.encode()[:col_offset].decode())
+
+    for node in _docstring_nodes(tree):
+        assert node.end_lineno is not None
+        assert node.end_col_offset is not None
+        start = offset(node.lineno, node.col_offset)
+        end = offset(node.end_lineno, node.end_col_offset)
+
+        prefix = STRING_PREFIX_RE.match(src, start)
+        assert prefix is not None
+        quotes = src[prefix.end() : prefix.end() + 3]
+
+        # Code blocks need more than one line, so only triple-quoted strings
+        # can hold them. A body containing the quotes is made of several
+        # implicitly concatenated literals, which are left alone.
+        if quotes not in {'"""', "'''"} or not src.endswith(quotes, start, end):
+            continue
+
+        body_start = prefix.end() + 3
+        body_end = end - 3
+
+        if body_start > body_end or quotes in src[body_start:body_end]:
+            continue
+
+        docstrings.append((body_start, body_end, src[start:body_start]))
+
+    docstrings.sort()
+
+    return docstrings
+
+
+def escape_docstring(code: str, opening: str) -> str:
+    # Escape quotes in formatted code that would otherwise end the docstring.
+    quotes = opening[-3:]
+
+    if quotes not in code:
+        return code
+
+    if "r" in opening.lower():
+        raise ValueError("formatted code would end the raw docstring")
+
+    return re.sub(
+        f"{quotes[0]}{{3,}}",
+        lambda match: f"\\{quotes[0]}" * len(match[0]),
+        code,
+    )
@@ -1,7 +1,53 @@
-__all__ = ("CodeBlockError",)
+from typing import Self
+
+__all__ = (
+    "CodeBlockError",
+    "LintError",
+)
+
+
+class LintError(Exception):
+    # Raised by backends for problems they found in a block, and couldn't
+    # fix, rather than for code they couldn't parse.
+    pass
 
 
 class CodeBlockError:
-    def __init__(self, offset: int, exc: Exception) -> None:
+    # Only the formatted message and the exception's type name are kept, not
+    # the exception with its traceback, so errors are small and picklable.
+    __slots__ = ("message", "offset", "type_name")
+
+    def __init__(self, offset: int, message: str, type_name: str) -> None:
         self.offset = offset
-        self.exc = exc
+        self.message = message
+        self.type_name = type_name
+
+    @classmethod
+    def from_exception(cls, offset: int, exc: BaseException) -> Self:
+        return cls(offset, str(exc), type(exc).__name__)
+
+    @property
+    def description(self) -> str:
+        # As it is shown to users, with errors other than a backend's
+        # diagnostics taken to be parse errors.
+        kind = "lint" if self.type_name == LintError.__name__ else "parse"
+        return f"code block {kind} error {self.message}"
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CodeBlockError):
+            return NotImplemented
+
+        return (self.offset, self.message, self.type_name) == (
+            other.offset,
+            other.message,
+            other.type_name,
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.offset, self.message, self.type_name))
+
+    def __repr__(self) -> str:
+        return (
+            f"CodeBlockError(offset={self.offset!r}, message={self.message!r}, "
+            f"type_name={self.type_name!r})"
+        )
@@ -0,0 +1,70 @@
+import re
+import subprocess
+from collections.abc import Sequence
+from pathlib import Path
+
+from .constants import DOC_FILE_SUFFIXES
+
+__all__ = (
+    "GitError",
+    "changed_files",
+    "changed_lines",
+)
+
+HUNK_HEADER_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@", re.MULTILINE)
+
+
+class GitError(Exception):
+    pass
+
+
+def _git(*args: str) -> str:
+    try:
+        result = subprocess.run(
+            ("git", *args),
+            capture_output=True,
+            check=True,
+            encoding="UTF-8",
+        )
+    except FileNotFoundError as e:
+        raise GitError("git is not installed") from e
+    except subprocess.CalledProcessError as e:
+        raise GitError(e.stderr.strip() or f"git {args[0]} failed") from e
+
+    return result.stdout
+
+
+def changed_files(since: str) -> list[str]:
+    # Files modified since the given revision, including untracked ones,
+    # relative to the current directory.
+    tracked = _git("diff", "--name-only", "--relative", "--diff-filter=d", "-z", since)
+    untracked = _git("ls-files", "--others", "--exclude-standard", "-z")
+
+    return sorted(
+        filename
+        for filename in {*tracked.split("\0"), *untracked.split("\0")}
+        if Path(filename).suffix in DOC_FILE_SUFFIXES
+    )
+
+
+def changed_lines(filename: str, since: str) -> Sequence[tuple[int, int]] | None:
+    # 1-based inclusive line ranges of the working tree file that differ from
+    # the given revision. None means the whole file is new.
+    if _git("ls-files", "--", filename) == "":
+        return None
+
+    diff = _git("diff", "--no-color", "--no-ext-diff", "-U0", since, "--", filename)
+    line_ranges = []
+
+    for match in HUNK_HEADER_RE.finditer(diff):
+        start = int(match[1])
+        length = 1 if match[2] is None else int(match[2])
+
+        if length:
+            line_ranges.append((start, start + length - 1))
+        else:
+            # A pure deletion after line ``start``: the blocks either side of
+            # it may have changed.
+            line_ranges.append((max(start, 1), start + 1))
+
+    return line_ranges
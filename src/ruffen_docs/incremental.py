@@ -0,0 +1,399 @@
+import re
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterator, Sequence
+from operator import itemgetter
+
+from . import regex_patterns
+from .blocks import CodeBlock
+from .constants import PYTHONTEX_LANG
+from .errors import CodeBlockError
+from .processors import BaseProcessor, apply_edits
+from .scanners import MD_SCANNER
+
+__all__ = ("DocumentIndex",)
+
+# Roughly how many characters are scanned again around an edit.
+SEGMENT_SIZE = 8192
+# How many characters of two versions are compared at once, to find where
+# they differ.
+CHUNK_SIZE = 4096
+
+# Lines starting with anything but whitespace. No rST block continues past
+# the start of one, and the trailing whitespace of a LaTeX block stops there.
+_BOUNDARY_RE = re.compile(r"^(?=\S)", re.MULTILINE)
+
+# The header lines from which a LaTeX pattern that doesn't match has looked
+# past the line, possibly to the end of the document, for the rest of it.
+_LATEX_HEADER_RES = {
+    "LATEX_RE": re.compile(r"^ *\\begin\{minted\}(?:\[|\{python\}\n)", re.MULTILINE),
+    "LATEX_PYCON_RE": re.compile(
+        r"^ *\\begin\{minted\}(?:\[|\{pycon\}\n)", re.MULTILINE
+    ),
+    "PYTHONTEX_RE": re.compile(rf"^ *\\begin\{{{PYTHONTEX_LANG}\}}\n", re.MULTILINE),
+}
+
+# For each segment: whether it starts off, whether its on and off comments
+# leave it off, if it has any, and what scanning it found, at offsets within
+# it.
+type _Segment = tuple[
+    bool,
+    bool | None,
+    tuple[list[tuple[int, int, str]], list[CodeBlockError], list[CodeBlock]],
+]
+
+_start = itemgetter(0)
+_end = itemgetter(1)
+
+
+def _common_length(a: str, b: str, limit: int, *, reverse: bool = False) -> int:
+    # How many characters, up to limit, a and b start with, or with reverse
+    # end with, in common. Slices are compared rather than characters, as
+    # that is done without running Python code for each.
+    length = 0
+    size = CHUNK_SIZE
+
+    while length < limit:
+        size = min(size, limit - length)
+        if reverse:
+            same = (
+                a[len(a) - length - size : len(a) - length]
+                == b[len(b) - length - size : len(b) - length]
+            )
+        else:
+            same = a[length : length + size] == b[length : length + size]
+
+        if same:
+            length += size
+        elif size == 1:
+            break
+        else:
+            size //= 2
+
+    return length
+
+
+def _edit(old: str, new: str) -> tuple[int, int, int]:
+    # (start, old_end, new_end) such that new is old with old[start:old_end]
+    # replaced by new[start:new_end].
+    limit = min(len(old), len(new))
+    start = _common_length(old, new, limit)
+    suffix = _common_length(old, new, limit - start, reverse=True)
+
+    return start, len(old) - suffix, len(new) - suffix
+
+
+def _pattern_spans(src: str, name: str, pos: int) -> Iterator[tuple[int, int]]:
+    # The spans of the blocks a pattern finds from pos. A Markdown fence that
+    # isn't closed ends the scan, so it runs to the end of the document.
+    if name == "MD_FENCED_BLOCK_RE":
+        return MD_SCANNER.fences(src, pos)
+
+    pattern = getattr(regex_patterns, name)
+    return (match.span() for match in pattern.finditer(src, pos))
+
+
+def _merge(spans: Sequence[list[tuple[int, int]]]) -> tuple[list[int], list[int]]:
+    # Merged spans that a block may run across, as (starts, ends), from those
+    # of each pattern, which are in order and don't overlap one another.
+    if len(spans) == 1:
+        [found] = spans
+        return [start for start, _ in found], [end for _, end in found]
+
+    starts: list[int] = []
+    ends: list[int] = []
+
+    for start, end in sorted(span for found in spans for span in found):
+        if ends and start < ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+
+    return starts, ends
+
+
+class DocumentIndex:
+    # The blocks of a document that is processed again after every change,
+    # as in an editor. The document is split into segments that are scanned
+    # on their own, and after a change, only the segments around it are
+    # scanned, and their blocks formatted, again. The rest keep their blocks
+    # and edits, shifted to where they now are. The regions that a block may
+    # run across, which segments can't split, are kept in the same way, and
+    # only found again from the last one before the change until they are
+    # where they were.
+    def __init__(
+        self,
+        processor: BaseProcessor,
+        *,
+        rst_literal_blocks: bool = False,
+        segment_size: int = SEGMENT_SIZE,
+    ) -> None:
+        self.processor = processor
+        self.rst_literal_blocks = rst_literal_blocks
+        self.segment_size = segment_size
+        # Like the processor's, for the whole of the last version.
+        self.errors: list[CodeBlockError] = []
+        self.edits: list[tuple[int, int, str]] = []
+        # How many segments the last update() scanned.
+        self.rescanned = 0
+        # The last version, and for it, the spans of the blocks each pattern
+        # found, the header lines the LaTeX patterns didn't match from, and
+        # the start of each segment, with what was found in it.
+        self._src = ""
+        self._spans: dict[str, list[tuple[int, int]]] = {}
+        self._headers: dict[str, list[int]] = {}
+        self._boundaries = [0]
+        self._segments: list[_Segment] = [(False, None, ([], [], []))]
+
+    @property
+    def blocks(self) -> list[CodeBlock]:
+        # Made when asked for, as only the segments that changed have to be.
+        return [
+            block.shifted(start)
+            for start, (_, _, (_, _, blocks)) in zip(
+                self._boundaries, self._segments, strict=True
+            )
+            for block in blocks
+        ]
+
+    def update(self, src: str) -> tuple[str, Sequence[CodeBlockError]]:
+        # Like process_str() on the new version of the document, src.
+        self.rescanned = 0
+
+        start, old_end, new_end = _edit(self._src, src)
+        if start == old_end == new_end:
+            return apply_edits(src, self.edits), self.errors
+
+        delta = new_end - old_end
+        # A match looks at the whitespace after it, up to the last character
+        # before the edit that isn't.
+        last = start - 1
+        while last >= 0 and src[last].isspace():
+            last -= 1
+
+        names = ["MD_FENCED_BLOCK_RE"]
+        # Every LaTeX block starts with \\begin, so without one the LaTeX
+        # patterns aren't needed, or compiled.
+        if "\\begin" in src:
+            names += _LATEX_HEADER_RES
+
+        # The regions between changed_start and changed_end changed, the
+        # rest only moved.
+        spans = {}
+        headers = {}
+        changed_start = start
+        changed_end = new_end
+        for name in names:
+            spans[name], headers[name], changed = self._rescan_pattern(
+                src, name, last, start, new_end, delta
+            )
+            if changed is not None:
+                changed_start = min(changed_start, changed[0])
+                changed_end = max(changed_end, changed[1])
+
+        boundaries, kept, synced = self._rescan_boundaries(
+            src, _merge(list(spans.values())), changed_start, changed_end, delta
+        )
+        segments = self._rescan_segments(src, boundaries, kept, synced)
+
+        self._src = src
+        self._spans = spans
+        self._headers = headers
+        self._boundaries = boundaries
+        self._segments = segments
+
+        self.errors = []
+        self.edits = []
+        for segment_start, (_, _, (edits, errors, _)) in zip(
+            boundaries, segments, strict=True
+        ):
+            self.edits += [
+                (s + segment_start, e + segment_start, code) for s, e, code in edits
+            ]
+            self.errors += [
+                CodeBlockError(
+                    error.offset + segment_start, error.message, error.type_name
+                )
+                for error in errors
+            ]
+
+        return apply_edits(src, self.edits), self.errors
+
+    def _rescan_pattern(
+        self,
+        src: str,
+        name: str,
+        last: int,
+        start: int,
+        new_end: int,
+        delta: int,
+    ) -> tuple[list[tuple[int, int]], list[int], tuple[int, int] | None]:
+        # The spans a pattern finds in src, the header lines it didn't match
+        # from, and the range of those that changed, if any did. It is run
+        # again from the end of the last block that didn't look at the edit,
+        # and before any header line that might have, until it finds a block
+        # after the edit where it was before, after which they are the same.
+        old_spans = self._spans.get(name, [])
+        old_headers = self._headers.get(name, [])
+
+        limit = last
+        if old_headers and old_headers[0] < start:
+            limit = min(limit, old_headers[0])
+        kept = bisect_right(old_spans, limit, key=_end)
+        pos = old_spans[kept - 1][1] if kept else 0
+
+        found = []
+        synced = len(old_spans)
+        for span in _pattern_spans(src, name, pos):
+            if span[0] > new_end:
+                index = bisect_left(old_spans, span[0] - delta, kept, key=_start)
+                if index < len(old_spans) and old_spans[index][0] == span[0] - delta:
+                    synced = index
+                    break
+            found.append(span)
+
+        scan_end = len(src)
+        if synced < len(old_spans):
+            scan_end = old_spans[synced][0] + delta
+
+        headers = []
+        if name in _LATEX_HEADER_RES:
+            for header in _LATEX_HEADER_RES[name].finditer(src, pos, scan_end):
+                index = bisect_right(found, header.start(), key=_start)
+                if not index or found[index - 1][1] <= header.start():
+                    headers.append(header.start())
+            headers += [
+                header + delta for header in old_headers if header + delta >= scan_end
+            ]
+
+        removed = old_spans[kept:synced]
+        changed = None
+        if found or removed:
+            changed = (
+                min(span[0] for span in found[:1] + removed[:1]),
+                max([
+                    *(end for _, end in found[-1:]),
+                    *(end + delta for _, end in removed[-1:]),
+                ]),
+            )
+
+        spans = [
+            *old_spans[:kept],
+            *found,
+            *((s + delta, e + delta) for s, e in old_spans[synced:]),
+        ]
+
+        return spans, headers, changed
+
+    def _rescan_boundaries(
+        self,
+        src: str,
+        regions: tuple[list[int], list[int]],
+        changed_start: int,
+        changed_end: int,
+        delta: int,
+    ) -> tuple[list[int], int, int | None]:
+        # The starts of the segments of src, each at a line beginning with
+        # non-whitespace outside every region, every segment_size characters
+        # or so, that every pass scans the same way on their own as within
+        # the whole document. Those before what changed are kept, and the
+        # rest found again until one is where it was, after which they are
+        # the same. Also returns how many were kept, and the index of that
+        # one in the last version.
+        starts, ends = regions
+        old_boundaries = self._boundaries
+        kept = max(1, bisect_left(old_boundaries, changed_start))
+        boundaries = old_boundaries[:kept]
+        pos = boundaries[-1] + self.segment_size
+
+        while pos < len(src):
+            boundary = _BOUNDARY_RE.search(src, pos)
+            if boundary is None:
+                break
+
+            segment_start = boundary.start()
+            index = bisect_left(starts, segment_start) - 1
+            if index >= 0 and ends[index] > segment_start:
+                pos = ends[index]
+                continue
+
+            if segment_start > changed_end:
+                synced = bisect_left(old_boundaries, segment_start - delta, kept)
+                if (
+                    synced < len(old_boundaries)
+                    and old_boundaries[synced] == segment_start - delta
+                ):
+                    boundaries += [b + delta for b in old_boundaries[synced:]]
+                    return boundaries, kept, synced
+
+            boundaries.append(segment_start)
+            pos = segment_start + self.segment_size
+
+        return boundaries, kept, None
+
+    def _rescan_segments(
+        self,
+        src: str,
+        boundaries: list[int],
+        kept: int,
+        synced: int | None,
+    ) -> list[_Segment]:
+        # The segments starting at boundaries. The first kept start where
+        # they did, and from synced on, where they did shifted, and are the
+        # same unless on and off comments that changed have them start in
+        # another state. The others are scanned again.
+        segments = self._segments[: kept - 1]
+
+        off = False
+        if segments:
+            initially_off, off_after, _ = segments[-1]
+            off = initially_off if off_after is None else off_after
+
+        ends = [*boundaries[1:], len(src)]
+        tail = len(boundaries)
+        if synced is not None:
+            tail -= len(self._segments) - synced
+
+        for i in range(len(segments), len(boundaries)):
+            if synced is not None and i >= tail:
+                rest = self._segments[synced + i - tail :]
+                if rest[0][0] == off:
+                    segments += rest
+                    break
+
+            segment = self._scan_segment(src, boundaries[i], ends[i], off)
+            segments.append(segment)
+            if segment[1] is not None:
+                off = segment[1]
+
+        return segments
+
+    def _scan_segment(
+        self,
+        src: str,
+        start: int,
+        end: int,
+        initially_off: bool,
+    ) -> _Segment:
+        # With the first character of the next segment, as the scanners look
+        # at it to tell where a block ends.
+        text = src[start : end + 1]
+        self.processor._process(
+            text,
+            [(0, len(text), None)],
+            rst_literal_blocks=self.rst_literal_blocks,
+            stop_on_change=False,
+            line_ranges=None,
+            initially_off=initially_off,
+        )
+        self.rescanned += 1
+
+        off_after = None
+        for comment in regex_patterns.ON_OFF_COMMENT_RE.finditer(src, start, end):
+            off_after = "off" in comment.groups()
+
+        return (
+            initially_off,
+            off_after,
+            (self.processor.edits, self.processor.errors, self.processor.blocks),
+        )
@@ -0,0 +1,59 @@
+__all__ = (
+    "common_indent",
+    "dedent",
+    "indent",
+)
+
+# Like textwrap.dedent() and textwrap.indent(), but for code blocks: lines are
+# only split on "\n", and each function goes over the lines once, instead of
+# running several regular expressions over the whole block.
+
+
+def _margin(lines: list[str]) -> str:
+    # The longest run of spaces and tabs that starts every line with other
+    # characters.
+    margin: str | None = None
+
+    for line in lines:
+        content = line.lstrip(" \t")
+
+        if not content or (margin is not None and line.startswith(margin)):
+            continue
+
+        line_indent = line[: len(line) - len(content)]
+
+        if margin is None or margin.startswith(line_indent):
+            margin = line_indent
+        else:
+            width = 0
+            while margin[width] == line_indent[width]:
+                width += 1
+            margin = margin[:width]
+
+    return margin or ""
+
+
+def common_indent(text: str) -> str:
+    return _margin(text.split("\n"))
+
+
+def dedent(text: str) -> tuple[str, str]:
+    # Returns the common indentation along with the dedented text. Lines of
+    # only spaces and tabs are emptied.
+    lines = text.split("\n")
+    margin = _margin(lines)
+    width = len(margin)
+
+    dedented = "\n".join(line[width:] if line.lstrip(" \t") else "" for line in lines)
+
+    return margin, dedented
+
+
+def indent(text: str, prefix: str) -> str:
+    # Whitespace-only lines are left alone.
+    if not prefix:
+        return text
+
+    return "\n".join(
+        prefix + line if line.strip() else line for line in text.split("\n")
+    )
@@ -0,0 +1,46 @@
+from bisect import bisect, insort
+from collections.abc import Iterable, Iterator
+
+__all__ = ("Intervals",)
+
+
+class Intervals:
+    # Sorted, non-overlapping (start, end) offsets, with starts and ends kept
+    # apart so that lookups are a single bisect of plain integers.
+    __slots__ = ("_ends", "_starts")
+
+    def __init__(self, intervals: Iterable[tuple[int, int]] = ()) -> None:
+        self._starts: list[int] = []
+        self._ends: list[int] = []
+
+        for start, end in sorted(intervals):
+            self._starts.append(start)
+            self._ends.append(end)
+
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        return zip(self._starts, self._ends, strict=True)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __repr__(self) -> str:
+        return f"Intervals({list(self)!r})"
+
+    def add(self, start: int, end: int) -> None:
+        # The interval must not overlap any already added.
+        insort(self._starts, start)
+        insort(self._ends, end)
+
+    def contains(self, span: tuple[int, int]) -> bool:
+        start, end = span
+        index = bisect(self._starts, start) - 1
+
+        return index >= 0 and self._ends[index] >= end
+
+    def overlaps(self, span: tuple[int, int]) -> bool:
+        # Ends are sorted too, so the first interval ending after start is the
+        # only one that can begin before end.
+        start, end = span
+        index = bisect(self._ends, start)
+
+        return index < len(self._starts) and self._starts[index] < end
@@ -0,0 +1,115 @@
+import multiprocessing
+import pickle
+from collections.abc import Callable
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+
+__all__ = (
+    "BlockSizeError",
+    "BlockTimeoutError",
+    "Sandbox",
+)
+
+
+class BlockSizeError(Exception):
+    pass
+
+
+class BlockTimeoutError(Exception):
+    pass
+
+
+def _serve(connection: Connection, function: Callable[[str], str]) -> None:
+    # Started, so that starting isn't timed as formatting the first block.
+    connection.send(None)
+
+    while True:
+        try:
+            code_block = connection.recv()
+        except EOFError:
+            return
+
+        try:
+            result: tuple[bool, object] = (
+                True,
+                function(code_block),
+            )
+        except Exception as e:  # noqa: BLE001
+            result = (False, e)
+
+        try:
+            connection.send(result)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            connection.send((False, RuntimeError(str(result[1]))))
+
+
+class Sandbox:
+    # Runs function, like a processor's process_code_block(), on code blocks
+    # in a child process, which is killed if a block takes longer than
+    # timeout seconds, and started again for the next block. Child processes
+    # are spawned, rather than forked, as their parents may be running
+    # threads.
+    def __init__(self, function: Callable[[str], str], timeout: float) -> None:
+        self.function = function
+        self.timeout = timeout
+        self._connection: Connection | None = None
+        self._process: BaseProcess | None = None
+
+    def _start(self) -> Connection:
+        context = multiprocessing.get_context("spawn")
+        connection, child_connection = context.Pipe()
+        self._process = context.Process(
+            target=_serve,
+            args=(child_connection, self.function),
+            daemon=True,
+        )
+        self._process.start()
+        child_connection.close()
+        self._connection = connection
+
+        try:
+            connection.recv()
+        except (EOFError, OSError):
+            self.close()
+            raise ChildProcessError("formatting process failed to start") from None
+
+        return connection
+
+    def close(self) -> None:
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._process = None
+
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def process_code_block(self, code_block: str) -> str:
+        connection = self._connection
+        if connection is None or self._process is None or not self._process.is_alive():
+            self.close()
+            connection = self._start()
+
+        try:
+            connection.send(code_block)
+            answered = connection.poll(self.timeout)
+        except OSError:
+            answered = False
+
+        if not answered:
+            self.close()
+            raise BlockTimeoutError(f"formatting took longer than {self.timeout:g}s")
+
+        try:
+            ok, result = connection.recv()
+        except (EOFError, OSError):
+            # The child died formatting the block, from a crash or because
+            # it ran out of memory.
+            self.close()
+            raise ChildProcessError("formatting process exited unexpectedly") from None
+
+        if not ok:
+            raise result
+
+        return result
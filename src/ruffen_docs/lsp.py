@@ -0,0 +1,448 @@
+import argparse
+import json
+import os
+import sys
+from bisect import bisect
+from collections.abc import Callable, Sequence
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Any, BinaryIO
+from urllib.parse import unquote, urlparse
+
+from .backends import BackendError, backend_names, create_processor, get_backend
+from .cache import CACHE_DIR_VARIABLE
+from .config import Config, ConfigError, clear_config_cache, resolve_config
+from .incremental import DocumentIndex
+from .processors import BaseProcessor
+
+__all__ = (
+    "LanguageServer",
+    "main",
+)
+
+# JSON-RPC and LSP error codes.
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+SERVER_NOT_INITIALIZED = -32002
+REQUEST_FAILED = -32803
+
+# TextDocumentSyncKind.Incremental, DiagnosticSeverity.Error, and
+# MessageType.Error.
+INCREMENTAL_SYNC = 2
+ERROR_SEVERITY = 1
+ERROR_MESSAGE = 1
+
+
+class ResponseError(Exception):
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+class Document:
+    # The text of an open document, with the offsets of its lines worked out
+    # when first needed after each change.
+    __slots__ = ("_line_starts", "text", "uri")
+
+    def __init__(self, uri: str, text: str) -> None:
+        self.uri = uri
+        self.text = text
+        self._line_starts: list[int] | None = None
+
+    def replace(self, start: int, end: int, text: str) -> None:
+        self.text = f"{self.text[:start]}{text}{self.text[end:]}"
+        self._line_starts = None
+
+    @property
+    def line_starts(self) -> list[int]:
+        if self._line_starts is None:
+            starts = [0]
+            newline = self.text.find("\n")
+            while newline != -1:
+                starts.append(newline + 1)
+                newline = self.text.find("\n", newline + 1)
+            self._line_starts = starts
+
+        return self._line_starts
+
+    def offset(self, position: dict[str, int], encoding: str) -> int:
+        # Positions past the end of a line or of the document are clamped,
+        # as LSP asks of servers.
+        line_starts = self.line_starts
+        line = position["line"]
+
+        if line >= len(line_starts):
+            return len(self.text)
+
+        start = line_starts[line]
+        end = (
+            line_starts[line + 1] - 1 if line + 1 < len(line_starts) else len(self.text)
+        )
+        character = position["character"]
+
+        if encoding == "utf-16" and not self.text[start:end].isascii():
+            # Characters outside the BMP are two UTF-16 code units.
+            offset = start
+            units = 0
+            while offset < end and units < character:
+                units += 2 if ord(self.text[offset]) > 0xFFFF else 1
+                offset += 1
+            return offset
+
+        return min(start + character, end)
+
+    def position(self, offset: int, encoding: str) -> dict[str, int]:
+        line = bisect(self.line_starts, offset) - 1
+        start = self.line_starts[line]
+        character = offset - start
+
+        if encoding == "utf-16" and not self.text[start:offset].isascii():
+            character += sum(ord(c) > 0xFFFF for c in self.text[start:offset])
+
+        return {"line": line, "character": character}
+
+    def range(self, start: int, end: int, encoding: str) -> dict[str, dict[str, int]]:
+        return {
+            "start": self.position(start, encoding),
+            "end": self.position(end, encoding),
+        }
+
+
+def _path(uri: str) -> Path | None:
+    parsed = urlparse(uri)
+
+    if parsed.scheme != "file":
+        return None
+
+    return Path(unquote(parsed.path))
+
+
+class LanguageServer:
+    # Formats open documents on textDocument/formatting and rangeFormatting
+    # requests, over JSON-RPC with Content-Length headers. Documents are kept
+    # in sync with the editor's incremental changes, and processors, with
+    # their caches, are kept for the life of the server. Whole documents are
+    # formatted through an index of their blocks, so that only the parts
+    # changed since the last request are scanned again. Code blocks are
+    # formatted by the named backend, as with the command line's --backend.
+    def __init__(
+        self,
+        reader: BinaryIO,
+        writer: BinaryIO,
+        backend: str = "black",
+        cache_dir: str | None = None,
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.documents: dict[str, Document] = {}
+        self.processors: dict[Config, BaseProcessor] = {}
+        self.indexes: dict[str, DocumentIndex] = {}
+        self.position_encoding = "utf-16"
+        self.initialized = False
+        self.shutting_down = False
+        self.requests: dict[str, Callable[[dict[str, Any]], Any]] = {
+            "initialize": self._initialize,
+            "shutdown": self._shutdown,
+            "textDocument/formatting": self._formatting,
+            "textDocument/rangeFormatting": self._range_formatting,
+        }
+        self.notifications: dict[str, Callable[[dict[str, Any]], None]] = {
+            "textDocument/didOpen": self._did_open,
+            "textDocument/didChange": self._did_change,
+            "textDocument/didClose": self._did_close,
+        }
+
+    def serve(self) -> int:
+        # Returns the exit code: 0 after shutdown and exit, 1 otherwise.
+        while True:
+            try:
+                message = self._read()
+            except ResponseError as e:
+                # Answered without an id, as none could be read.
+                self._send({
+                    "id": None,
+                    "error": {"code": e.code, "message": str(e)},
+                })
+                continue
+
+            if message is None:
+                return 1
+
+            if message.get("method") == "exit":
+                return 0 if self.shutting_down else 1
+
+            self._handle(message)
+
+    def _read(self) -> dict[str, Any] | None:
+        # None at the end of the input. A message that can't be parsed raises
+        # a ResponseError, once as much of it as can be found is read, so
+        # that the next one is read from its start.
+        length = None
+
+        while True:
+            header = self.reader.readline()
+
+            if not header:
+                return None
+
+            header = header.strip()
+            if not header:
+                break
+
+            name, _, value = header.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = value.strip()
+
+        if length is None or not length.isdigit():
+            raise ResponseError(PARSE_ERROR, "missing or invalid Content-Length header")
+
+        try:
+            message = json.loads(self.reader.read(int(length)))
+        except ValueError as e:
+            raise ResponseError(PARSE_ERROR, f"invalid JSON: {e}") from None
+
+        if not isinstance(message, dict):
+            raise ResponseError(INVALID_REQUEST, "message is not an object")
+
+        return message
+
+    def _send(self, message: dict[str, Any]) -> None:
+        body = json.dumps({"jsonrpc": "2.0", **message}).encode()
+        self.writer.write(b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+        self.writer.flush()
+
+    def _handle(self, message: dict[str, Any]) -> None:
+        method = message.get("method")
+        params = message.get("params") or {}
+
+        if "id" not in message:
+            # Notifications get no response, even when unknown, and errors
+            # handling them are logged, for the server to carry on.
+            if self.initialized and method in self.notifications:
+                try:
+                    self.notifications[method](params)
+                except Exception as e:  # noqa: BLE001
+                    self._send({
+                        "method": "window/logMessage",
+                        "params": {
+                            "type": ERROR_MESSAGE,
+                            "message": f"ruffen-docs: {method} failed: {e!r}",
+                        },
+                    })
+            return
+
+        try:
+            if method not in self.requests:
+                raise ResponseError(METHOD_NOT_FOUND, f"unknown method {method!r}")
+
+            if not self.initialized and method != "initialize":
+                raise ResponseError(SERVER_NOT_INITIALIZED, "server not initialized")
+
+            if self.shutting_down:
+                raise ResponseError(INVALID_REQUEST, "server is shutting down")
+
+            result = self.requests[method](params)
+        except ResponseError as e:
+            self._send({
+                "id": message["id"],
+                "error": {"code": e.code, "message": str(e)},
+            })
+        except Exception as e:  # noqa: BLE001
+            # Like malformed params, or a bug.
+            self._send({
+                "id": message["id"],
+                "error": {"code": INTERNAL_ERROR, "message": repr(e)},
+            })
+        else:
+            self._send({"id": message["id"], "result": result})
+
+    def _initialize(self, params: dict[str, Any]) -> dict[str, Any]:
+        # Offsets are in code points, so UTF-32 positions need no converting.
+        capabilities = params.get("capabilities", {})
+        encodings = capabilities.get("general", {}).get("positionEncodings", [])
+        if "utf-32" in encodings:
+            self.position_encoding = "utf-32"
+
+        self.initialized = True
+
+        try:
+            server_version = version("ruffen-docs")
+        except PackageNotFoundError:  # pragma: no cover
+            server_version = "unknown"
+
+        return {
+            "capabilities": {
+                "positionEncoding": self.position_encoding,
+                "textDocumentSync": {
+                    "openClose": True,
+                    "change": INCREMENTAL_SYNC,
+                },
+                "documentFormattingProvider": True,
+                "documentRangeFormattingProvider": True,
+            },
+            "serverInfo": {"name": "ruffen-docs", "version": server_version},
+        }
+
+    def _shutdown(self, params: dict[str, Any]) -> None:
+        self.shutting_down = True
+
+    def _did_open(self, params: dict[str, Any]) -> None:
+        document = params["textDocument"]
+        self.documents[document["uri"]] = Document(document["uri"], document["text"])
+
+    def _did_change(self, params: dict[str, Any]) -> None:
+        document = self.documents.get(params["textDocument"]["uri"])
+
+        if document is None:
+            return
+
+        for change in params["contentChanges"]:
+            if "range" in change:
+                start = document.offset(
+                    change["range"]["start"], self.position_encoding
+                )
+                end = document.offset(change["range"]["end"], self.position_encoding)
+                document.replace(start, end, change["text"])
+            else:
+                document.replace(0, len(document.text), change["text"])
+
+    def _did_close(self, params: dict[str, Any]) -> None:
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        self.indexes.pop(uri, None)
+
+    def _formatting(self, params: dict[str, Any]) -> list[dict[str, Any]]:
+        return self._format(self._document(params), None)
+
+    def _range_formatting(self, params: dict[str, Any]) -> list[dict[str, Any]]:
+        document = self._document(params)
+        start = params["range"]["start"]
+        end = params["range"]["end"]
+
+        # A range ending at the start of a line doesn't include that line.
+        last = end["line"]
+        if end["character"] == 0 and last > start["line"]:
+            last -= 1
+
+        return self._format(document, [(start["line"] + 1, last + 1)])
+
+    def _document(self, params: dict[str, Any]) -> Document:
+        uri = params["textDocument"]["uri"]
+
+        try:
+            return self.documents[uri]
+        except KeyError:
+            raise ResponseError(INVALID_PARAMS, f"document not open: {uri}") from None
+
+    def _processor(self, path: Path | None) -> tuple[Config, BaseProcessor]:
+        # Configuration files are read again for every request, as the
+        # editor may have changed them.
+        clear_config_cache()
+        ruff = get_backend(self.backend).ruff_config
+        try:
+            config = (
+                Config() if path is None else resolve_config(path.parent, ruff=ruff)
+            )
+        except ConfigError as e:
+            raise ResponseError(REQUEST_FAILED, str(e)) from None
+
+        if config not in self.processors:
+            self.processors[config] = create_processor(
+                self.backend, config, self.cache_dir
+            )
+
+        return config, self.processors[config]
+
+    def _format(
+        self,
+        document: Document,
+        line_ranges: Sequence[tuple[int, int]] | None,
+    ) -> list[dict[str, Any]]:
+        path = _path(document.uri)
+        config, processor = self._processor(path)
+        python = path is not None and path.suffix == ".py"
+
+        # Python files are parsed for their docstrings and processed whole,
+        # like documents formatted only in part.
+        if python or line_ranges is not None:
+            process = processor.process_python_str if python else processor.process_str
+            _, errors = process(
+                document.text,
+                rst_literal_blocks=config.rst_literal_blocks,
+                line_ranges=line_ranges,
+            )
+            edits = processor.edits
+        else:
+            index = self.indexes.get(document.uri)
+            if (
+                index is None
+                or index.processor is not processor
+                or index.rst_literal_blocks != config.rst_literal_blocks
+            ):
+                index = self.indexes[document.uri] = DocumentIndex(
+                    processor, rst_literal_blocks=config.rst_literal_blocks
+                )
+
+            _, errors = index.update(document.text)
+            edits = index.edits
+
+        encoding = self.position_encoding
+        self._send({
+            "method": "textDocument/publishDiagnostics",
+            "params": {
+                "uri": document.uri,
+                "diagnostics": [
+                    {
+                        "range": document.range(error.offset, error.offset, encoding),
+                        "severity": ERROR_SEVERITY,
+                        "source": "ruffen-docs",
+                        "message": error.description,
+                    }
+                    for error in errors
+                ],
+            },
+        })
+
+        return [
+            {"range": document.range(start, end, encoding), "newText": new_text}
+            for start, end, new_text in edits
+        ]
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="ruffen-docs language server")
+    parser.add_argument(
+        "--stdio",
+        action="store_true",
+        help="communicate over stdin and stdout (the default)",
+    )
+    parser.add_argument(
+        "--backend",
+        default="black",
+        help=f"formatter for code blocks, or several separated by commas to run "
+        f"in turn, default: black; choices: {backend_names()}",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get(CACHE_DIR_VARIABLE),
+        help="keep formatted code blocks in a cache in this directory, across "
+        f"runs; default: ${CACHE_DIR_VARIABLE}, or no cache",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        get_backend(args.backend)
+    except BackendError as e:
+        parser.error(str(e))
+
+    return LanguageServer(
+        sys.stdin.buffer,
+        sys.stdout.buffer,
+        backend=args.backend,
+        cache_dir=args.cache_dir,
+    ).serve()
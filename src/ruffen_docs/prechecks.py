@@ -0,0 +1,37 @@
+import hashlib
+
+__all__ = (
+    "fingerprint",
+    "trivial_output",
+)
+
+
+def fingerprint(code: str) -> bytes:
+    return hashlib.blake2b(code.encode(), digest_size=16).digest()
+
+
+def _is_formatted_comment(line: str) -> bool:
+    return (line == "#" or line.startswith("# ")) and (
+        line.isprintable() and line == line.rstrip()
+    )
+
+
+def trivial_output(code: str) -> str | None:
+    # The formatter's output for blocks simple enough to know it without
+    # parsing them, or None. Only spaces, tabs and newlines count as
+    # whitespace, and comments must be unindented, start with "# ", and be at
+    # most one blank line apart, which is how Black leaves them.
+    if not code.strip(" \t\n"):
+        return "\n" if "\n" in code else ""
+
+    if not code.endswith("\n"):
+        return None
+
+    lines = code[:-1].split("\n")
+    if not lines[0] or not lines[-1] or "\n\n\n" in code:
+        return None
+
+    if all(not line or _is_formatted_comment(line) for line in lines):
+        return code
+
+    return None
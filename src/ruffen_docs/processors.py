@@ -1,81 +1,341 @@
+import ast
 import contextlib
 import re
-import textwrap
 from abc import ABC, abstractmethod
-from bisect import bisect
-from collections.abc import Generator, Sequence
+from collections.abc import Callable, Generator, Sequence
 from pathlib import Path
-from re import Match
+from typing import Any, Self, TextIO
 
 import black
 from black import Mode
 from black.const import DEFAULT_LINE_LENGTH
 from black.mode import TargetVersion
+from black.parsing import lib2to3_parse
 
+from . import regex_patterns
+from .blocks import CodeBlock
+from .cache import BlockCache
+from .config import Config
 from .constants import PYGMENTS_PY_LANGS
+from .diff import color_diff, unified_diff
+from .docstrings import escape_docstring, find_docstrings
 from .errors import CodeBlockError
-from .regex_patterns import (
-    INDENT_RE,
-    LATEX_PYCON_RE,
-    LATEX_RE,
-    MD_PYCON_RE,
-    MD_RE,
-    ON_OFF_COMMENT_RE,
-    PYCON_CONTINUATION_PREFIX,
-    PYCON_CONTINUATION_RE,
-    PYCON_PREFIX,
-    PYTHONTEX_RE,
-    RST_LITERAL_BLOCKS_RE,
-    RST_PYCON_RE,
-    RST_RE,
-    TRAILING_NL_RE,
+from .indentation import common_indent, dedent, indent
+from .intervals import Intervals
+from .limits import BlockSizeError, Sandbox
+from .prechecks import fingerprint, trivial_output
+from .regex_patterns import PYCON_CONTINUATION_PREFIX, PYCON_PREFIX
+from .scanners import (
+    MD_PYCON_SCANNER,
+    MD_SCANNER,
+    RST_LITERAL_BLOCKS_SCANNER,
+    RST_PYCON_SCANNER,
+    RST_SCANNER,
+    AnyMatch,
+    Scanner,
 )
+from .stats import Stats
 
-__all__ = ("BlackFormatter",)
+__all__ = (
+    "BaseProcessor",
+    "BlackFormatter",
+)
+
+
+def apply_edits(src: str, edits: Sequence[tuple[int, int, str]]) -> str:
+    parts = []
+    pos = 0
+
+    for start, end, replacement in edits:
+        parts += (src[pos:start], replacement)
+        pos = end
+
+    parts.append(src[pos:])
+
+    return "".join(parts)
 
 
 class BaseProcessor(ABC):
+    # What the runner may do with a backend: call process_code_block() from
+    # several threads at once, use it in worker processes, and format all
+    # the blocks of a document with one process_code_blocks() call. With
+    # normalizes_whitespace, the backend formats whitespace and comments as
+    # Black does, so blocks of only those aren't given to it. With
+    # ruff_config, its settings come from ruff's configuration files too.
+    thread_safe = False
+    process_safe = True
+    supports_batching = False
+    normalizes_whitespace = False
+    ruff_config = False
+
     def __init__(self) -> None:
         self.errors: list[CodeBlockError] = []
-        self.off_ranges: list[tuple[int, int]] = []
+        # Everything is in the coordinates of the original document: the
+        # regions between off and on comments, (start, end, replacement) for
+        # each rewritten block and their spans, and the lines to format, or
+        # None to format every block.
+        self.off_ranges = Intervals()
+        self.edits: list[tuple[int, int, str]] = []
+        self.spans = Intervals()
+        # Every block that was formatted, or left alone within an off region.
+        self.blocks: list[CodeBlock] = []
+        self.line_ranges: Intervals | None = None
+        # With stop_on_change, whether a block has changed, after which the
+        # rest are only checked for errors.
+        self.stop_on_change = False
+        self._changed = False
+        # Unlike the rest, these are kept across documents: fingerprints of
+        # blocks the formatter left unchanged, and counts of formatter calls.
+        self.stable: set[bytes] = set()
+        self.stats = Stats()
+        # With supports_batching, the blocks of the document found by a
+        # first scan, and then their outputs, or the exceptions raised.
+        self._pending: list[str] | None = None
+        self._batched: dict[str, str | Exception] = {}
+        # And the outputs found in the cache for them, or None.
+        self._stored: dict[str, str | None] = {}
+        # Blocks longer than max_block_lines are reported as errors, and
+        # with block_timeout, each block is formatted in a child process
+        # that is given that many seconds.
+        self.max_block_lines: int | None = None
+        self.block_timeout: float | None = None
+        self._sandbox: Sandbox | None = None
+        # Outputs kept across runs, for backends with a cache_key.
+        self.cache: BlockCache | None = None
+
+    def __getstate__(self) -> dict[str, Any]:
+        # The child process is started again by copies that need one.
+        return {**self.__dict__, "_sandbox": None}
+
+    @classmethod
+    def from_config(cls, config: Config) -> Self:
+        # Backends without settings are made with no arguments.
+        return cls()
 
     @abstractmethod
     def process_code_block(self, code_block: str) -> str:
         pass  # pragma: no cover
 
-    def _within_off_range(self, code_range: tuple[int, int]) -> bool:
-        index = bisect(self.off_ranges, code_range)
-
+    @property
+    def cache_key(self) -> tuple[str, str, str] | None:
+        # (backend, version, settings) identifying the output of
+        # process_code_block() across runs, for it to be cached, or None if
+        # it can't be. The version is the formatter's, and outputs of other
+        # versions are dropped from the cache.
+        return None
+
+    def check_code_block(self, code_block: str) -> None:
+        # Raises for a block process_code_block() couldn't parse, without
+        # formatting it.
         try:
-            off_start, off_end = self.off_ranges[index - 1]
-        except IndexError:
-            return False
+            ast.parse(code_block)
+        except SyntaxError as e:
+            raise SyntaxError(f"Cannot parse: {e.lineno}:{e.offset}: {e.msg}") from None
+
+    def process_code_blocks(self, code_blocks: Sequence[str]) -> list[str | Exception]:
+        # The output for each block, or the exception formatting it raised.
+        outputs: list[str | Exception] = []
+
+        for code_block in code_blocks:
+            try:
+                outputs.append(self.process_code_block(code_block))
+            except Exception as e:  # noqa: BLE001
+                outputs.append(e)
+
+        return outputs
+
+    def _format_code_block(self, code_block: str) -> str:
+        # process_code_block(), skipped for blocks whose output is known
+        # without running the formatter.
+        if self._pending is not None:
+            self._pending.append(code_block)
+            return code_block
+
+        self.stats.blocks += 1
+
+        if self._oversized(code_block):
+            lines = code_block.count("\n")
+            raise BlockSizeError(
+                f"code block has {lines} lines, "
+                f"more than the maximum of {self.max_block_lines}"
+            )
+
+        output = self._trivial_output(code_block)
+        if output is not None:
+            self.stats.trivial += 1
+            return output
+
+        key = fingerprint(code_block)
+        if key in self.stable:
+            self.stats.cached += 1
+            return code_block
+
+        if self.cache is not None:
+            if code_block in self._stored:
+                output = self._stored[code_block]
+            else:
+                output = self.cache.get(code_block, key)
+            if output is not None:
+                self.stats.stored += 1
+                if output == code_block:
+                    self.stable.add(key)
+                return output
 
-        code_start, code_end = code_range
+        if self._changed and code_block not in self._batched:
+            self.check_code_block(code_block)
+            return code_block
 
-        return code_start >= off_start and code_end <= off_end
+        self.stats.formatted += 1
+        output = self._batched.get(code_block)
+
+        if output is None:
+            output = self._process_code_block(code_block)
+        elif isinstance(output, Exception):
+            raise output
+
+        if output == code_block:
+            self.stable.add(key)
+
+        if self.cache is not None:
+            self.cache.put(code_block, output, key)
+
+        return output
+
+    def _trivial_output(self, code_block: str) -> str | None:
+        if not self.normalizes_whitespace:
+            return None
+
+        return trivial_output(code_block)
+
+    def _oversized(self, code_block: str) -> bool:
+        return (
+            self.max_block_lines is not None
+            and code_block.count("\n") > self.max_block_lines
+        )
+
+    def _process_code_block(self, code_block: str) -> str:
+        if self.block_timeout is None:
+            return self.process_code_block(code_block)
+
+        if self._sandbox is None or self._sandbox.timeout != self.block_timeout:
+            if self._sandbox is not None:
+                self._sandbox.close()
+            self._sandbox = Sandbox(self.process_code_block, self.block_timeout)
+
+        return self._sandbox.process_code_block(code_block)
+
+    def _within_off_range(self, code_range: tuple[int, int]) -> bool:
+        return self.off_ranges.contains(code_range)
 
     @contextlib.contextmanager
-    def _collect_error(self, match: Match[str]) -> Generator[None]:
+    def _collect_error(self, match: AnyMatch) -> Generator[None]:
         try:
             yield
         except Exception as e:  # noqa: BLE001
-            self.errors.append(CodeBlockError(match.start(), e))
+            self.errors.append(CodeBlockError.from_exception(match.start(), e))
+
+    def _overlaps_edit(self, span: tuple[int, int]) -> bool:
+        # Blocks are found on the original document, one pass per dialect.
+        # A block overlapping one that an earlier pass rewrote is left alone,
+        # instead of formatting text that has already been replaced.
+        return self.spans.overlaps(span)
+
+    def _within_line_ranges(self, code_range: tuple[int, int]) -> bool:
+        return self.line_ranges is None or self.line_ranges.overlaps(code_range)
+
+    def _set_off_ranges(self, src: str, initially_off: bool) -> None:
+        # initially_off is for a document that starts after an off comment.
+        off_ranges = []
+        off_start = 0 if initially_off else None
+
+        for comment in regex_patterns.ON_OFF_COMMENT_RE.finditer(src):
+            # Check for the "off" value across the multiple (on|off) groups.
+            if "off" in comment.groups():
+                if off_start is None:
+                    off_start = comment.start()
+            else:
+                if off_start is not None:
+                    off_ranges.append((off_start, comment.end()))
+                    off_start = None
+
+        if off_start is not None:
+            off_ranges.append((off_start, len(src)))
+
+        self.off_ranges = Intervals(off_ranges)
+
+    def _set_line_ranges(
+        self,
+        src: str,
+        line_ranges: Sequence[tuple[int, int]] | None,
+    ) -> None:
+        if line_ranges is None:
+            self.line_ranges = None
+            return
+
+        line_starts = [0, *(match.end() for match in re.finditer("\n", src))]
+        merged: list[tuple[int, int]] = []
+
+        for first, last in sorted(line_ranges):
+            start = line_starts[min(first, len(line_starts)) - 1]
+            end = line_starts[last] if last < len(line_starts) else len(src)
+
+            if merged and merged[-1][1] >= start:
+                start = merged.pop()[0]
+
+            merged.append((start, end))
+
+        self.line_ranges = Intervals(merged)
+
+    def _collect_edits(
+        self,
+        dialect: str,
+        pattern: Scanner,
+        handler: Callable[[AnyMatch], str],
+        src: str,
+        region: tuple[int, int, str | None],
+    ) -> None:
+        # Only blocks within the region are formatted. In Python files these
+        # are docstrings, for which the opening of the literal is given.
+        start, end, opening = region
+
+        for match in pattern.finditer(src, start, end):
+            if self._overlaps_edit(match.span()):
+                continue
+
+            if not self._within_line_ranges(match.span()):
+                continue
 
-    def _md_match(self, match: Match[str]) -> str:
+            self.blocks.append(CodeBlock.from_match(match, dialect))
+            code = handler(match)
+
+            if self._changed:
+                continue
+
+            if code != match[0] and opening is not None:
+                escaped = match[0]
+                with self._collect_error(match):
+                    escaped = escape_docstring(code, opening)
+                code = escaped
+
+            if code != match[0]:
+                self.spans.add(*match.span())
+                self.edits.append((match.start(), match.end(), code))
+                self._changed = self.stop_on_change
+
+    def _md_match(self, match: AnyMatch) -> str:
         if self._within_off_range(match.span()):
             return match[0]
 
-        code = textwrap.dedent(match["code"])
+        _, code = dedent(match["code"])
 
         with self._collect_error(match):
-            code = self.process_code_block(code)
+            code = self._format_code_block(code)
 
-        code = textwrap.indent(code, match["indent"])
+        code = indent(code, match["indent"])
 
         return f"{match['before']}{code}{match['after']}"
 
-    def _rst_match(self, match: Match[str]) -> str:
+    def _rst_match(self, match: AnyMatch) -> str:
         if self._within_off_range(match.span()):
             return match[0]
         lang = match["lang"]
@@ -86,42 +346,34 @@ class BaseProcessor(ABC):
         if not match["code"].strip():
             return match[0]
 
-        min_indent = min(INDENT_RE.findall(match["code"]))
-        trailing_ws_match = TRAILING_NL_RE.search(match["code"])
-        assert trailing_ws_match
-
-        trailing_ws = trailing_ws_match.group()
-        code = textwrap.dedent(match["code"])
+        min_indent, code = dedent(match["code"])
+        trailing_ws = match["code"][len(match["code"].rstrip("\n")) :]
 
         with self._collect_error(match):
-            code = self.process_code_block(code)
+            code = self._format_code_block(code)
 
-        code = textwrap.indent(code, min_indent)
+        code = indent(code, min_indent)
 
         return f"{match['before']}{code.rstrip()}{trailing_ws}"
 
-    def _rst_literal_blocks_match(self, match: Match[str]) -> str:
+    def _rst_literal_blocks_match(self, match: AnyMatch) -> str:
         if self._within_off_range(match.span()):
             return match[0]
 
         if not match["code"].strip():
             return match[0]
 
-        min_indent = min(INDENT_RE.findall(match["code"]))
-        trailing_ws_match = TRAILING_NL_RE.search(match["code"])
-        assert trailing_ws_match
-
-        trailing_ws = trailing_ws_match.group()
-        code = textwrap.dedent(match["code"])
+        min_indent, code = dedent(match["code"])
+        trailing_ws = match["code"][len(match["code"].rstrip("\n")) :]
 
         with self._collect_error(match):
-            code = self.process_code_block(code)
+            code = self._format_code_block(code)
 
-        code = textwrap.indent(code, min_indent)
+        code = indent(code, min_indent)
 
         return f"{match['before']}{code.rstrip()}{trailing_ws}"
 
-    def _pycon_match(self, match: Match[str]) -> str:
+    def _pycon_match(self, match: AnyMatch) -> str:
         code = ""
         fragment: str | None = None
 
@@ -131,7 +383,7 @@ class BaseProcessor(ABC):
 
             if fragment is not None:
                 with self._collect_error(match):
-                    fragment = self.process_code_block(fragment)
+                    fragment = self._format_code_block(fragment)
 
                 fragment_lines = fragment.splitlines()
                 code += f"{PYCON_PREFIX}{fragment_lines[0]}\n"
@@ -161,7 +413,7 @@ class BaseProcessor(ABC):
             if indentation is None and line:
                 indentation = len(orig_line) - len(line)
 
-            continuation_match = PYCON_CONTINUATION_RE.match(line)
+            continuation_match = regex_patterns.PYCON_CONTINUATION_RE.match(line)
 
             if continuation_match and fragment is not None:
                 fragment += line[continuation_match.end() :] + "\n"
@@ -177,16 +429,16 @@ class BaseProcessor(ABC):
 
         return code
 
-    def _md_pycon_match(self, match: Match[str]) -> str:
+    def _md_pycon_match(self, match: AnyMatch) -> str:
         if self._within_off_range(match.span()):
             return match[0]
 
         code = self._pycon_match(match)
-        code = textwrap.indent(code, match["indent"])
+        code = indent(code, match["indent"])
 
         return f"{match['before']}{code}{match['after']}"
 
-    def _rst_pycon_match(self, match: Match[str]) -> str:
+    def _rst_pycon_match(self, match: AnyMatch) -> str:
         if self._within_off_range(match.span()):
             return match[0]
 
@@ -195,30 +447,29 @@ class BaseProcessor(ABC):
         if not code.strip():
             return match[0]
 
-        min_indent = min(INDENT_RE.findall(match["code"]))
-        code = textwrap.indent(code, min_indent)
+        code = indent(code, common_indent(match["code"]))
 
         return f"{match['before']}{code}"
 
-    def _latex_match(self, match: Match[str]) -> str:
+    def _latex_match(self, match: AnyMatch) -> str:
         if self._within_off_range(match.span()):
             return match[0]
 
-        code = textwrap.dedent(match["code"])
+        _, code = dedent(match["code"])
 
         with self._collect_error(match):
-            code = self.process_code_block(code)
+            code = self._format_code_block(code)
 
-        code = textwrap.indent(code, match["indent"])
+        code = indent(code, match["indent"])
 
         return f"{match['before']}{code}{match['after']}"
 
-    def _latex_pycon_match(self, match: Match[str]) -> str:
+    def _latex_pycon_match(self, match: AnyMatch) -> str:
         if self._within_off_range(match.span()):
             return match[0]
 
         code = self._pycon_match(match)
-        code = textwrap.indent(code, match["indent"])
+        code = indent(code, match["indent"])
 
         return f"{match['before']}{code}{match['after']}"
 
@@ -227,36 +478,175 @@ class BaseProcessor(ABC):
         src: str,
         *,
         rst_literal_blocks: bool = False,
+        stop_on_change: bool = False,
+        line_ranges: Sequence[tuple[int, int]] | None = None,
     ) -> tuple[str, Sequence[CodeBlockError]]:
-        off_start = None
+        # With stop_on_change, formatting ends at the first block whose
+        # formatted output differs. Only that block is rewritten in the
+        # returned text, which is enough to tell the document needs a rewrite,
+        # and the rest are only checked for errors.
+        # With line_ranges, a list of 1-based inclusive (first, last) line
+        # numbers, only blocks overlapping one of those lines are formatted.
+        return self._process(
+            src,
+            [(0, len(src), None)],
+            rst_literal_blocks=rst_literal_blocks,
+            stop_on_change=stop_on_change,
+            line_ranges=line_ranges,
+        )
 
-        for comment in re.finditer(ON_OFF_COMMENT_RE, src):
-            # Check for the "off" value across the multiple (on|off) groups.
-            if "off" in comment.groups():
-                if off_start is None:
-                    off_start = comment.start()
-            else:
-                if off_start is not None:
-                    self.off_ranges.append((off_start, comment.end()))
-                    off_start = None
+    def process_python_str(
+        self,
+        src: str,
+        *,
+        rst_literal_blocks: bool = False,
+        stop_on_change: bool = False,
+        line_ranges: Sequence[tuple[int, int]] | None = None,
+    ) -> tuple[str, Sequence[CodeBlockError]]:
+        # Like process_str(), but only for code blocks within docstrings,
+        # located by parsing the source once. Source that can't be parsed is
+        # scanned as a whole.
+        docstrings = find_docstrings(src)
+
+        return self._process(
+            src,
+            [(0, len(src), None)] if docstrings is None else docstrings,
+            rst_literal_blocks=rst_literal_blocks,
+            stop_on_change=stop_on_change,
+            line_ranges=line_ranges,
+        )
 
-        if off_start is not None:
-            self.off_ranges.append((off_start, len(src)))
+    def _process(
+        self,
+        src: str,
+        regions: Sequence[tuple[int, int, str | None]],
+        *,
+        rst_literal_blocks: bool,
+        stop_on_change: bool,
+        line_ranges: Sequence[tuple[int, int]] | None,
+        initially_off: bool = False,
+    ) -> tuple[str, Sequence[CodeBlockError]]:
+        # Blocks given a time limit are formatted one at a time, so that one
+        # that takes too long can be told apart from the rest.
+        if not self.supports_batching or self.block_timeout is not None:
+            return self._scan(
+                src,
+                regions,
+                rst_literal_blocks=rst_literal_blocks,
+                stop_on_change=stop_on_change,
+                line_ranges=line_ranges,
+                initially_off=initially_off,
+            )
 
-        src = MD_RE.sub(self._md_match, src)
-        src = MD_PYCON_RE.sub(self._md_pycon_match, src)
-        src = RST_RE.sub(self._rst_match, src)
-        src = RST_PYCON_RE.sub(self._rst_pycon_match, src)
-        if rst_literal_blocks:
-            src = RST_LITERAL_BLOCKS_RE.sub(
-                self._rst_literal_blocks_match,
+        # Scan twice: first to gather every block the formatter could be
+        # given, leaving them unchanged, and then to use their outputs. The
+        # first scan can also find blocks within blocks that turn out to be
+        # rewritten; any block it misses is formatted on its own.
+        self._pending = []
+        try:
+            self._scan(
                 src,
+                regions,
+                rst_literal_blocks=rst_literal_blocks,
+                stop_on_change=False,
+                line_ranges=line_ranges,
+                initially_off=initially_off,
+            )
+        finally:
+            pending, self._pending = self._pending, None
+
+        # Only blocks the formatter would be given: not those that are too
+        # long, have a known output, or are in the cache, whose outputs are
+        # kept for the second scan.
+        code_blocks = []
+        for code_block in dict.fromkeys(pending):
+            if (
+                self._oversized(code_block)
+                or self._trivial_output(code_block) is not None
+            ):
+                continue
+
+            key = fingerprint(code_block)
+            if key in self.stable:
+                continue
+
+            if self.cache is not None:
+                output = self.cache.get(code_block, key)
+                self._stored[code_block] = output
+                if output is not None:
+                    continue
+
+            code_blocks.append(code_block)
+
+        if code_blocks:
+            self._batched = dict(
+                zip(code_blocks, self.process_code_blocks(code_blocks), strict=True)
             )
-        src = LATEX_RE.sub(self._latex_match, src)
-        src = LATEX_PYCON_RE.sub(self._latex_pycon_match, src)
-        src = PYTHONTEX_RE.sub(self._latex_match, src)
 
-        return src, self.errors
+        try:
+            return self._scan(
+                src,
+                regions,
+                rst_literal_blocks=rst_literal_blocks,
+                stop_on_change=stop_on_change,
+                line_ranges=line_ranges,
+                initially_off=initially_off,
+            )
+        finally:
+            self._batched = {}
+            self._stored = {}
+
+    def _scan(
+        self,
+        src: str,
+        regions: Sequence[tuple[int, int, str | None]],
+        *,
+        rst_literal_blocks: bool,
+        stop_on_change: bool,
+        line_ranges: Sequence[tuple[int, int]] | None,
+        initially_off: bool,
+    ) -> tuple[str, Sequence[CodeBlockError]]:
+        self.stop_on_change = stop_on_change
+        self._changed = False
+        self.errors = []
+        self.edits = []
+        self.spans = Intervals()
+        self.blocks = []
+        self._set_off_ranges(src, initially_off)
+        self._set_line_ranges(src, line_ranges)
+
+        passes: list[tuple[str, Scanner, Callable[[AnyMatch], str]]] = [
+            ("markdown", MD_SCANNER, self._md_match),
+            ("markdown-pycon", MD_PYCON_SCANNER, self._md_pycon_match),
+            ("rst", RST_SCANNER, self._rst_match),
+            ("rst-pycon", RST_PYCON_SCANNER, self._rst_pycon_match),
+        ]
+        if rst_literal_blocks:
+            passes.append((
+                "rst-literal-block",
+                RST_LITERAL_BLOCKS_SCANNER,
+                self._rst_literal_blocks_match,
+            ))
+        # Every LaTeX block starts with \\begin, so without one the LaTeX
+        # patterns aren't needed, or compiled.
+        if "\\begin" in src:
+            passes += [
+                ("latex", regex_patterns.LATEX_RE, self._latex_match),
+                (
+                    "latex-pycon",
+                    regex_patterns.LATEX_PYCON_RE,
+                    self._latex_pycon_match,
+                ),
+                ("pythontex", regex_patterns.PYTHONTEX_RE, self._latex_match),
+            ]
+
+        for dialect, pattern, handler in passes:
+            for region in regions:
+                self._collect_edits(dialect, pattern, handler, src, region)
+
+        self.edits.sort()
+
+        return apply_edits(src, self.edits), self.errors
 
     def process_file(
         self,
@@ -264,18 +654,34 @@ class BaseProcessor(ABC):
         skip_errors: bool,
         rst_literal_blocks: bool,
         check_only: bool,
+        diff: bool = False,
+        color: bool = False,
+        line_ranges: Sequence[tuple[int, int]] | None = None,
+        output: TextIO | None = None,
     ) -> int:
+        # Messages are printed to output, by default sys.stdout.
         with Path(filename).open(encoding="UTF-8") as f:
             contents = f.read()
 
-        new_contents, errors = self.process_str(
+        # A check only needs to know whether any block changes, so there is
+        # no point formatting the rest of the file after the first one, only
+        # parsing it for errors.
+        process = (
+            self.process_python_str if filename.endswith(".py") else self.process_str
+        )
+        new_contents, errors = process(
             contents,
             rst_literal_blocks=rst_literal_blocks,
+            stop_on_change=check_only and not diff,
+            line_ranges=line_ranges,
         )
 
         for error in errors:
             lineno = contents[: error.offset].count("\n") + 1
-            print(f"{filename}:{lineno}: code block parse error {error.exc}")
+            print(
+                f"{filename}:{lineno}: {error.description}",
+                file=output,
+            )
 
         if errors and not skip_errors:
             return 2
@@ -283,11 +689,16 @@ class BaseProcessor(ABC):
         if contents == new_contents:
             return 0
 
+        if diff:
+            diff_text = unified_diff(contents, self.edits, filename)
+            print(color_diff(diff_text) if color else diff_text, end="", file=output)
+            return 1
+
         if check_only:
-            print(f"{filename}: Requires a rewrite.")
+            print(f"{filename}: Requires a rewrite.", file=output)
             return 1
 
-        print(f"{filename}: Rewriting...")
+        print(f"{filename}: Rewriting...", file=output)
 
         with Path(filename).open("w", encoding="UTF-8") as f:
             f.write(new_contents)
@@ -296,6 +707,8 @@ class BaseProcessor(ABC):
 
 
 class BlackFormatter(BaseProcessor):
+    normalizes_whitespace = True
+
     def __init__(
         self,
         # FIXME:
@@ -320,5 +733,23 @@ class BlackFormatter(BaseProcessor):
 
         super().__init__()
 
+    @classmethod
+    def from_config(cls, config: Config) -> Self:
+        return cls(
+            target_versions=set(config.target_versions),
+            line_length=config.line_length,
+            string_normalization=config.string_normalization,
+            is_pyi=config.is_pyi,
+            preview=config.preview,
+        )
+
+    @property
+    def cache_key(self) -> tuple[str, str, str]:
+        return ("black", black.__version__, self.mode.get_cache_key())
+
+    def check_code_block(self, code_block: str) -> None:
+        # Parsed as black.format_str() does.
+        lib2to3_parse(code_block.lstrip(), self.mode.target_versions)
+
     def process_code_block(self, code_block: str) -> str:
         return black.format_str(code_block, mode=self.mode)
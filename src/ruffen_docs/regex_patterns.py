@@ -1,109 +1,193 @@
+import os
 import re
+import threading
+from collections.abc import Callable
+from re import Pattern
+from types import ModuleType
+from typing import Any
 
 from .constants import (
     ON_OFF,
     PYCON_CONTINUATION_PREFIX,
-    PYGMENTS_PY_LANGS,
     PYTHONTEX_LANG,
 )
 
 __all__ = (
-    "INDENT_RE",
+    "ENGINE",
     "LATEX_PYCON_RE",
     "LATEX_RE",
-    "MD_PYCON_RE",
-    "MD_RE",
+    "MD_FENCED_BLOCK_RE",
+    "MD_FENCE_RE",
     "ON_OFF_COMMENT_RE",
     "PYCON_CONTINUATION_PREFIX",
     "PYCON_CONTINUATION_RE",
     "PYCON_PREFIX",
     "PYTHONTEX_RE",
-    "RST_LITERAL_BLOCKS_RE",
-    "RST_PYCON_RE",
-    "RST_RE",
-    "TRAILING_NL_RE",
+    "RST_DIRECTIVE_RE",
+    "RST_PYCON_DIRECTIVE_RE",
 )
 
 
-PYGMENTS_PY_LANGS_RE_FRAGMENT = f"({'|'.join(PYGMENTS_PY_LANGS)})"
-MD_RE = re.compile(
-    r"(?P<before>^(?P<indent> *)```[^\S\r\n]*"
-    + PYGMENTS_PY_LANGS_RE_FRAGMENT
-    + r"( .*?)?\n)"
-    r"(?P<code>.*?)"
-    r"(?P<after>^(?P=indent)```[^\S\r\n]*$)",
-    re.DOTALL | re.MULTILINE,
-)
-MD_PYCON_RE = re.compile(
-    r"(?P<before>^(?P<indent> *)```[^\S\r\n]*pycon( .*?)?\n)"
-    r"(?P<code>.*?)"
-    r"(?P<after>^(?P=indent)```[^\S\r\n]*$)",
-    re.DOTALL | re.MULTILINE,
-)
+# The environment variable that picks the engine for the LaTeX patterns, "re"
+# or "regex", instead of regex whenever it is installed.
+ENGINE_VARIABLE = "RUFFEN_DOCS_REGEX_ENGINE"
+
+PYCON_PREFIX = ">>> "
 BLOCK_TYPES = "(code|code-block|sourcecode|ipython)"
 DOCTEST_TYPES = "(testsetup|testcleanup|testcode)"
-RST_RE = re.compile(
-    rf"(?P<before>"
-    rf"^(?P<indent> *)\.\. ("
-    rf"jupyter-execute::|"
-    rf"{BLOCK_TYPES}:: (?P<lang>\w+)|"
-    rf"{DOCTEST_TYPES}::.*"
-    rf")\n"
-    rf"((?P=indent) +:.*\n)*"
-    rf"( *\n)*"
-    rf")"
-    rf"(?P<code>(^((?P=indent) +.*)?\n)+)",
-    re.MULTILINE,
-)
-RST_LITERAL_BLOCKS_RE = re.compile(
-    r"(?P<before>"
-    r"^(?! *\.\. )(?P<indent> *).*::\n"
-    r"((?P=indent) +:.*\n)*"
-    r"\n*"
-    r")"
-    r"(?P<code>(^((?P=indent) +.*)?\n)+)",
-    re.MULTILINE,
-)
-RST_PYCON_RE = re.compile(
-    r"(?P<before>"
-    r"(?P<indent> *)\.\. ((code|code-block):: pycon|doctest::.*)\n"
-    r"((?P=indent) +:.*\n)*"
-    r"\n*"
-    r")"
-    r"(?P<code>(^((?P=indent) +.*)?(\n|$))+)",
-    re.MULTILINE,
-)
-PYCON_CONTINUATION_RE = re.compile(
-    rf"^{re.escape(PYCON_CONTINUATION_PREFIX)}( |$)",
-)
-LATEX_RE = re.compile(
-    r"(?P<before>^(?P<indent> *)\\begin{minted}(\[.*?\])?{python}\n)"
-    r"(?P<code>.*?)"
-    r"(?P<after>^(?P=indent)\\end{minted}\s*$)",
-    re.DOTALL | re.MULTILINE,
-)
-LATEX_PYCON_RE = re.compile(
-    r"(?P<before>^(?P<indent> *)\\begin{minted}(\[.*?\])?{pycon}\n)"
-    r"(?P<code>.*?)"
-    r"(?P<after>^(?P=indent)\\end{minted}\s*$)",
-    re.DOTALL | re.MULTILINE,
-)
-PYCON_PREFIX = ">>> "
-PYTHONTEX_RE = re.compile(
-    rf"(?P<before>^(?P<indent> *)\\begin{{{PYTHONTEX_LANG}}}\n)"
-    rf"(?P<code>.*?)"
-    rf"(?P<after>^(?P=indent)\\end{{(?P=lang)}}\s*$)",
-    re.DOTALL | re.MULTILINE,
-)
-INDENT_RE = re.compile("^ +(?=[^ ])", re.MULTILINE)
-TRAILING_NL_RE = re.compile(r"\n+\Z", re.MULTILINE)
-
-ON_OFF_COMMENT_RE = re.compile(
-    # Markdown
-    rf"(?:^\s*<!-- {ON_OFF} -->$)|"
-    # rST
-    rf"(?:^\s*\.\. +{ON_OFF}$)|"
-    # LaTeX
-    rf"(?:^\s*% {ON_OFF}$)",
-    re.MULTILINE,
-)
+
+# The patterns, and ENGINE, are made on first use by __getattr__(), all the
+# patterns of a dialect at once, and kept as attributes of this module, so
+# that they are shared by every processor. Importing the package doesn't
+# compile them, or import regex, and a run over Markdown files never compiles
+# the LaTeX patterns.
+ENGINE: ModuleType
+MD_FENCE_RE: Pattern[str]
+MD_FENCED_BLOCK_RE: Pattern[str]
+RST_DIRECTIVE_RE: Pattern[str]
+RST_PYCON_DIRECTIVE_RE: Pattern[str]
+PYCON_CONTINUATION_RE: Pattern[str]
+LATEX_RE: Pattern[str]
+LATEX_PYCON_RE: Pattern[str]
+PYTHONTEX_RE: Pattern[str]
+ON_OFF_COMMENT_RE: Pattern[str]
+
+
+def _engine() -> dict[str, Any]:
+    # The LaTeX patterns use backreferences to match the end of a block,
+    # which the re module searches for from every line start of a document,
+    # and find the block with lazy DOTALL matching. The regex module finds
+    # them, and rules out documents without them, much faster; for the other
+    # patterns it is no faster, or slower, so they always use re.
+    name = os.environ.get(ENGINE_VARIABLE)
+
+    if name == "re":
+        return {"ENGINE": re}
+
+    try:
+        import regex
+    except ImportError:
+        if name == "regex":
+            raise
+        return {"ENGINE": re}
+
+    return {"ENGINE": regex}
+
+
+def _markdown() -> dict[str, Any]:
+    return {
+        # Lines that open or close fenced code blocks in Markdown, with the
+        # info string that follows an opening fence.
+        "MD_FENCE_RE": re.compile(
+            r"^(?P<indent> *)(?P<fence>`{3,}|~{3,})(?P<info>.*)$",
+            re.MULTILINE,
+        ),
+        # Whole fenced blocks: a closing fence is the next fence line with
+        # the same indent, or up to 3 spaces, of the same character, at least
+        # as long as the opening fence, and with no info string. Without one,
+        # only the opening fence is matched. This finds the same blocks as
+        # the Markdown scanner, when only their spans are needed.
+        "MD_FENCED_BLOCK_RE": re.compile(
+            r"^(?P<indent> *)(?:(?P<backticks>`{3,})[^`\n]*|(?P<tildes>~{3,})(?!~).*)$"
+            r"(?P<closing>\n(?:.*\n)*?"
+            r"(?:(?P=indent)| {0,3})(?:(?P=backticks)`*|(?P=tildes)~*)[^\S\n]*$)?",
+            re.MULTILINE,
+        ),
+    }
+
+
+def _rst() -> dict[str, Any]:
+    return {
+        # Header lines for the rST scanners, matched without the newline.
+        "RST_DIRECTIVE_RE": re.compile(
+            rf"(?P<indent> *)\.\. ("
+            rf"jupyter-execute::|"
+            rf"{BLOCK_TYPES}:: (?P<lang>\w+)|"
+            rf"{DOCTEST_TYPES}::.*"
+            rf")"
+        ),
+        "RST_PYCON_DIRECTIVE_RE": re.compile(
+            r"\.\. ((code|code-block):: pycon|doctest::.*)"
+        ),
+    }
+
+
+def _pycon() -> dict[str, Any]:
+    return {
+        "PYCON_CONTINUATION_RE": re.compile(
+            rf"^{re.escape(PYCON_CONTINUATION_PREFIX)}( |$)",
+        ),
+    }
+
+
+def _latex() -> dict[str, Any]:
+    engine = __getattr__("ENGINE")
+
+    return {
+        "LATEX_RE": engine.compile(
+            r"(?P<before>^(?P<indent> *)\\begin{minted}(\[.*?\])?{python}\n)"
+            r"(?P<code>.*?)"
+            r"(?P<after>^(?P=indent)\\end{minted}\s*$)",
+            engine.DOTALL | engine.MULTILINE,
+        ),
+        "LATEX_PYCON_RE": engine.compile(
+            r"(?P<before>^(?P<indent> *)\\begin{minted}(\[.*?\])?{pycon}\n)"
+            r"(?P<code>.*?)"
+            r"(?P<after>^(?P=indent)\\end{minted}\s*$)",
+            engine.DOTALL | engine.MULTILINE,
+        ),
+        "PYTHONTEX_RE": engine.compile(
+            rf"(?P<before>^(?P<indent> *)\\begin{{{PYTHONTEX_LANG}}}\n)"
+            rf"(?P<code>.*?)"
+            rf"(?P<after>^(?P=indent)\\end{{(?P=lang)}}\s*$)",
+            engine.DOTALL | engine.MULTILINE,
+        ),
+    }
+
+
+def _on_off() -> dict[str, Any]:
+    return {
+        # Leading whitespace doesn't include newlines, so that runs of blank
+        # lines aren't rescanned from every line.
+        "ON_OFF_COMMENT_RE": re.compile(
+            # Markdown
+            rf"(?:^[^\S\n]*<!-- {ON_OFF} -->$)|"
+            # rST
+            rf"(?:^[^\S\n]*\.\. +{ON_OFF}$)|"
+            # LaTeX
+            rf"(?:^[^\S\n]*% {ON_OFF}$)",
+            re.MULTILINE,
+        ),
+    }
+
+
+_BUILDERS: dict[str, Callable[[], dict[str, Any]]] = {
+    "ENGINE": _engine,
+    "MD_FENCE_RE": _markdown,
+    "MD_FENCED_BLOCK_RE": _markdown,
+    "RST_DIRECTIVE_RE": _rst,
+    "RST_PYCON_DIRECTIVE_RE": _rst,
+    "PYCON_CONTINUATION_RE": _pycon,
+    "LATEX_RE": _latex,
+    "LATEX_PYCON_RE": _latex,
+    "PYTHONTEX_RE": _latex,
+    "ON_OFF_COMMENT_RE": _on_off,
+}
+_lock = threading.RLock()
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _BUILDERS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    # Processors running in threads can ask for a dialect at the same time,
+    # and should share one set of patterns.
+    with _lock:
+        if name not in globals():
+            globals().update(_BUILDERS[name]())
+
+    return globals()[name]
+
+
+def __dir__() -> list[str]:
+    return sorted({*globals(), *_BUILDERS})
@@ -0,0 +1,112 @@
+import dataclasses
+import json
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Self
+
+from .stats import Stats
+
+__all__ = (
+    "FileResult",
+    "Report",
+    "ReportError",
+    "merge_reports",
+)
+
+REPORT_VERSION = 1
+
+
+class ReportError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class FileResult:
+    # What processing a file returned, nonzero if it was, or would be,
+    # rewritten or had errors, and how long it took.
+    retv: int
+    seconds: float
+
+
+@dataclasses.dataclass
+class Report:
+    # The outcome of a run, or of one --shard of it, written with --report.
+    # Reports of the shards of a run can be merged into one for the whole
+    # run, and the time taken by each file balances the shards of later runs.
+    files: dict[str, FileResult] = dataclasses.field(default_factory=dict)
+    stats: Stats = dataclasses.field(default_factory=Stats)
+    # (index, count) for a run of one shard.
+    shard: tuple[int, int] | None = None
+
+    @property
+    def retv(self) -> int:
+        retv = 0
+        for result in self.files.values():
+            retv |= result.retv
+        return retv
+
+    def costs(self) -> dict[str, float]:
+        return {filename: result.seconds for filename, result in self.files.items()}
+
+    def dump(self, path: Path) -> None:
+        data = {
+            "version": REPORT_VERSION,
+            "shard": None if self.shard is None else list(self.shard),
+            "stats": dataclasses.asdict(self.stats),
+            "files": {
+                filename: dataclasses.asdict(result)
+                for filename, result in sorted(self.files.items())
+            },
+        }
+        path.write_text(json.dumps(data, indent=2) + "\n", encoding="UTF-8")
+
+    @classmethod
+    def load(cls, path: Path) -> Self:
+        try:
+            data: Any = json.loads(path.read_text(encoding="UTF-8"))
+        except (OSError, ValueError) as e:
+            raise ReportError(f"{path}: {e}") from e
+
+        if not isinstance(data, dict) or data.get("version") != REPORT_VERSION:
+            raise ReportError(f"{path}: not a ruffen-docs report")
+
+        try:
+            shard = None
+            if data["shard"] is not None:
+                index, count = data["shard"]
+                shard = (int(index), int(count))
+
+            return cls(
+                files={
+                    filename: FileResult(int(result["retv"]), float(result["seconds"]))
+                    for filename, result in data["files"].items()
+                },
+                stats=Stats(**data["stats"]),
+                shard=shard,
+            )
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ReportError(f"{path}: malformed report: {e!r}") from e
+
+
+def merge_reports(reports: Sequence[Report]) -> Report:
+    # Reports of the shards of a run must cover every shard once, so that a
+    # runner whose report went missing isn't taken to have passed.
+    shards = [report.shard for report in reports if report.shard is not None]
+    if shards:
+        counts = {count for _, count in shards}
+        if len(counts) > 1:
+            raise ReportError(f"reports are of runs with {sorted(counts)} shards")
+
+        [count] = counts
+        indexes = sorted(index for index, _ in shards)
+        if len(shards) < len(reports) or indexes != list(range(1, count + 1)):
+            raise ReportError(
+                f"reports are of shards {indexes}, not of each of 1 to {count}"
+            )
+
+    merged = Report()
+    for report in reports:
+        merged.files.update(report.files)
+        merged.stats += report.stats
+
+    return merged
@@ -0,0 +1,500 @@
+import atexit
+import itertools
+import json
+import os
+import subprocess
+import threading
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from pathlib import Path
+from typing import IO, Any
+
+from ruff.__main__ import find_ruff_bin
+
+from .errors import LintError
+from .processors import apply_edits
+
+__all__ = (
+    "RuffServer",
+    "RuffServerError",
+    "get_server",
+)
+
+# Seconds to wait for an answer before ruff is taken to have hung, and is
+# restarted.
+TIMEOUT = 30.0
+
+_FORMATTING_OPTIONS = {"tabSize": 4, "insertSpaces": True}
+
+
+class RuffServerError(Exception):
+    pass
+
+
+def _read_message(stream: IO[bytes]) -> dict[str, Any] | None:
+    length = None
+
+    while True:
+        header = stream.readline()
+
+        if not header:
+            return None
+
+        header = header.strip()
+        if not header:
+            break
+
+        name, _, value = header.decode("ascii").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+
+    if length is None:
+        return None
+
+    return json.loads(stream.read(length))
+
+
+def _apply_text_edits(text: str, text_edits: Sequence[dict[str, Any]]) -> str:
+    # Positions are in code points, as negotiated on initialization.
+    line_starts = [0]
+    newline = text.find("\n")
+    while newline != -1:
+        line_starts.append(newline + 1)
+        newline = text.find("\n", newline + 1)
+
+    def offset(position: dict[str, int]) -> int:
+        if position["line"] >= len(line_starts):
+            return len(text)
+        return min(line_starts[position["line"]] + position["character"], len(text))
+
+    return apply_edits(
+        text,
+        sorted(
+            (
+                offset(edit["range"]["start"]),
+                offset(edit["range"]["end"]),
+                edit["newText"],
+            )
+            for edit in text_edits
+        ),
+    )
+
+
+def _syntax_error(diagnostics: dict[str, Any]) -> RuffServerError | None:
+    for item in diagnostics.get("items", ()):
+        if item.get("code") == "invalid-syntax":
+            start = item["range"]["start"]
+            return RuffServerError(
+                f"Cannot parse: {start['line'] + 1}:{start['character'] + 1}: "
+                f"{item['message']}"
+            )
+
+    return None
+
+
+def _lint_error(diagnostics: dict[str, Any]) -> LintError | None:
+    # The block's diagnostics, as one error, if it has any.
+    items = sorted(
+        (
+            item
+            for item in diagnostics.get("items", ())
+            if item.get("code") != "invalid-syntax"
+        ),
+        key=lambda item: (
+            item["range"]["start"]["line"],
+            item["range"]["start"]["character"],
+        ),
+    )
+    if not items:
+        return None
+
+    return LintError(
+        "\n".join(
+            f"{item['range']['start']['line'] + 1}:"
+            f"{item['range']['start']['character'] + 1}: "
+            f"{item.get('code')} {item['message'].partition('\n')[0]}"
+            for item in items
+        )
+    )
+
+
+class _Connection:
+    # One ruff server process. Requests are written as they are made, and
+    # answered through futures by a thread reading the process's output, so
+    # that many can be in flight, from any thread.
+    def __init__(self, cwd: str) -> None:
+        self.process = subprocess.Popen(
+            (find_ruff_bin(), "server"),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=cwd,
+        )
+        self.pid = os.getpid()
+        self.cwd = cwd
+        self._ids = itertools.count(1)
+        self._documents = itertools.count()
+        self._pending: dict[int, Future[Any]] = {}
+        self._write_lock = threading.Lock()
+        self._closed = False
+        threading.Thread(target=self._read, daemon=True).start()
+
+    @property
+    def alive(self) -> bool:
+        return (
+            not self._closed and self.pid == os.getpid() and self.process.poll() is None
+        )
+
+    def _read(self) -> None:
+        assert self.process.stdout is not None
+
+        try:
+            while (message := _read_message(self.process.stdout)) is not None:
+                # Notifications, like diagnostics pushed after changes, are
+                # ignored. No capabilities are declared that ruff would send
+                # requests for.
+                if "method" in message:
+                    continue
+
+                # Answers to requests this connection didn't make are
+                # ignored too.
+                request_id = message.get("id")
+                if not isinstance(request_id, int):
+                    continue
+
+                future = self._pending.pop(request_id, None)
+                if future is None:
+                    continue
+
+                if "error" in message:
+                    future.set_exception(RuffServerError(message["error"]["message"]))
+                else:
+                    future.set_result(message.get("result"))
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._closed = True
+            while self._pending:
+                _, future = self._pending.popitem()
+                future.set_exception(RuffServerError("ruff server exited"))
+
+    def _send(self, message: dict[str, Any]) -> None:
+        body = json.dumps({"jsonrpc": "2.0", **message}).encode()
+
+        with self._write_lock:
+            assert self.process.stdin is not None
+            try:
+                self.process.stdin.write(
+                    b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+                )
+                self.process.stdin.flush()
+            except (OSError, ValueError) as e:
+                raise RuffServerError(f"ruff server exited: {e}") from e
+
+    def notify(self, method: str, params: Any) -> None:
+        self._send({"method": method, "params": params})
+
+    def request(self, method: str, params: Any) -> Future[Any]:
+        request_id = next(self._ids)
+        future: Future[Any] = Future()
+        self._pending[request_id] = future
+
+        if self._closed:
+            self._pending.pop(request_id, None)
+            raise RuffServerError("ruff server exited")
+
+        try:
+            self._send({"id": request_id, "method": method, "params": params})
+        except RuffServerError:
+            self._pending.pop(request_id, None)
+            raise
+
+        return future
+
+    def result(self, future: Future[Any]) -> Any:
+        try:
+            return future.result(TIMEOUT)
+        except FutureTimeoutError:
+            self.kill()
+            raise RuffServerError("ruff server didn't answer") from None
+
+    def open(self, text: str, suffix: str) -> str:
+        # Documents are named after files in the working directory, so that
+        # ruff looks for its configuration where ruff check would.
+        uri = Path(self.cwd, f"ruffen-docs-{next(self._documents)}{suffix}").as_uri()
+        self.notify(
+            "textDocument/didOpen",
+            {
+                "textDocument": {
+                    "uri": uri,
+                    "languageId": "python",
+                    "version": 0,
+                    "text": text,
+                }
+            },
+        )
+        return uri
+
+    def close_documents(self, uris: Sequence[str]) -> None:
+        for uri in uris:
+            self.notify("textDocument/didClose", {"textDocument": {"uri": uri}})
+
+    def kill(self) -> None:
+        self._closed = True
+        if self.pid == os.getpid():
+            self.process.kill()
+            self.process.wait()
+
+    def shutdown(self) -> None:
+        if not self.alive:
+            return
+
+        try:
+            self.result(self.request("shutdown", None))
+            self.notify("exit", None)
+            self.process.wait(TIMEOUT)
+        except (RuffServerError, subprocess.TimeoutExpired):
+            self.kill()
+
+
+class RuffServer:
+    # A long-lived `ruff server`, spoken to over LSP on its standard input and
+    # output, that formats or fixes many code blocks without starting ruff
+    # for each. It is started on first use and started again if it exits;
+    # worker processes start their own.
+    def __init__(
+        self,
+        configuration: dict[str, Any],
+        *,
+        editor_only: bool,
+        cwd: str,
+    ) -> None:
+        # With editor_only, only configuration is used, as with --isolated;
+        # otherwise it overrides ruff's configuration files.
+        self.configuration = configuration
+        self.editor_only = editor_only
+        self.cwd = cwd
+        self._connection: _Connection | None = None
+        self._lock = threading.Lock()
+        self._failed = False
+
+    def _connect(self) -> _Connection:
+        with self._lock:
+            if self._connection is not None and self._connection.alive:
+                return self._connection
+
+            if self._failed:
+                raise RuffServerError("ruff server failed to start")
+
+            try:
+                connection = _Connection(self.cwd)
+            except OSError as e:
+                self._failed = True
+                raise RuffServerError(f"can't start ruff server: {e}") from e
+
+            try:
+                result = connection.result(
+                    connection.request(
+                        "initialize",
+                        {
+                            "processId": os.getpid(),
+                            "rootUri": None,
+                            "capabilities": {
+                                "general": {"positionEncodings": ["utf-32"]},
+                            },
+                            "initializationOptions": {
+                                "settings": {
+                                    "configurationPreference": (
+                                        "editorOnly"
+                                        if self.editor_only
+                                        else "editorFirst"
+                                    ),
+                                    "configuration": self.configuration,
+                                },
+                            },
+                        },
+                    )
+                )
+                if result["capabilities"].get("positionEncoding") != "utf-32":
+                    raise RuffServerError("ruff server doesn't support UTF-32")
+                connection.notify("initialized", {})
+            except RuffServerError:
+                self._failed = True
+                connection.kill()
+                raise
+
+            self._connection = connection
+            return connection
+
+    def _call(
+        self,
+        function: Callable[[_Connection], list[str | Exception]],
+    ) -> list[str | Exception]:
+        # A server that exits, or hangs, is restarted once per call.
+        try:
+            return function(self._connect())
+        except RuffServerError:
+            if self._connection is not None and self._connection.alive:
+                raise
+        return function(self._connect())
+
+    def format(
+        self,
+        code_blocks: Sequence[str],
+        suffix: str = ".py",
+    ) -> list[str | Exception]:
+        # The formatted code, or the error, for each block.
+        def function(connection: _Connection) -> list[str | Exception]:
+            uris = [connection.open(code_block, suffix) for code_block in code_blocks]
+
+            try:
+                formatted = [
+                    connection.request(
+                        "textDocument/formatting",
+                        {"textDocument": {"uri": uri}, "options": _FORMATTING_OPTIONS},
+                    )
+                    for uri in uris
+                ]
+                outputs: list[str | Exception] = []
+                unchanged: dict[int, Future[Any]] = {}
+
+                for i, (code_block, uri, future) in enumerate(
+                    zip(code_blocks, uris, formatted, strict=True)
+                ):
+                    text_edits = connection.result(future)
+                    outputs.append(_apply_text_edits(code_block, text_edits or ()))
+
+                    # Code ruff can't parse isn't formatted, as if it were
+                    # already, so those blocks are checked for syntax errors.
+                    if text_edits is None:
+                        unchanged[i] = connection.request(
+                            "textDocument/diagnostic", {"textDocument": {"uri": uri}}
+                        )
+
+                for i, future in unchanged.items():
+                    error = _syntax_error(connection.result(future))
+                    if error is not None:
+                        outputs[i] = error
+
+                return outputs
+            finally:
+                connection.close_documents(uris)
+
+        return self._call(function)
+
+    def fix(
+        self,
+        code_blocks: Sequence[str],
+        suffix: str = ".py",
+    ) -> list[str | Exception]:
+        # Each block with ruff's fixes applied, like ruff check --fix, or the
+        # error. A block with diagnostics that can't all be fixed is left as
+        # it is, and has them all as a LintError.
+        def function(connection: _Connection) -> list[str | Exception]:
+            uris = [connection.open(code_block, suffix) for code_block in code_blocks]
+            fixed_uris: list[str] = []
+
+            try:
+                requests = [
+                    (
+                        connection.request(
+                            "textDocument/codeAction",
+                            {
+                                "textDocument": {"uri": uri},
+                                "range": {
+                                    "start": {"line": 0, "character": 0},
+                                    "end": {"line": 0, "character": 0},
+                                },
+                                "context": {
+                                    "diagnostics": [],
+                                    "only": ["source.fixAll.ruff"],
+                                },
+                            },
+                        ),
+                        connection.request(
+                            "textDocument/diagnostic", {"textDocument": {"uri": uri}}
+                        ),
+                    )
+                    for uri in uris
+                ]
+                outputs: list[str | Exception] = []
+                lint_errors: dict[int, LintError] = {}
+                rechecks: dict[int, Future[Any]] = {}
+
+                for i, (code_block, uri, (actions, diagnostics)) in enumerate(
+                    zip(code_blocks, uris, requests, strict=True)
+                ):
+                    actions = connection.result(actions) or ()
+                    diagnostics = connection.result(diagnostics)
+                    error = _syntax_error(diagnostics)
+                    if error is not None:
+                        outputs.append(error)
+                        continue
+
+                    text_edits = [
+                        text_edit
+                        for action in actions
+                        if action.get("kind") == "source.fixAll.ruff"
+                        for text_edit in action
+                        .get("edit", {})
+                        .get("changes", {})
+                        .get(uri, ())
+                    ]
+                    output = _apply_text_edits(code_block, text_edits)
+                    outputs.append(output)
+
+                    lint_error = _lint_error(diagnostics)
+                    if lint_error is None:
+                        continue
+
+                    # Diagnostics the fixes leave behind are found in the
+                    # fixed code.
+                    lint_errors[i] = lint_error
+                    if output == code_block:
+                        outputs[i] = lint_error
+                    else:
+                        fixed_uris.append(connection.open(output, suffix))
+                        rechecks[i] = connection.request(
+                            "textDocument/diagnostic",
+                            {"textDocument": {"uri": fixed_uris[-1]}},
+                        )
+
+                for i, future in rechecks.items():
+                    if _lint_error(connection.result(future)) is not None:
+                        outputs[i] = lint_errors[i]
+
+                return outputs
+            finally:
+                connection.close_documents(uris + fixed_uris)
+
+        return self._call(function)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.shutdown()
+                self._connection = None
+
+
+# Servers are shared by every processor with the same settings in the same
+# working directory, for as long as the interpreter runs.
+_servers: dict[tuple[str, bool, str], RuffServer] = {}
+_servers_lock = threading.Lock()
+
+
+def get_server(configuration: dict[str, Any], *, editor_only: bool) -> RuffServer:
+    cwd = str(Path.cwd())
+    key = (json.dumps(configuration, sort_keys=True), editor_only, cwd)
+
+    with _servers_lock:
+        if key not in _servers:
+            _servers[key] = RuffServer(configuration, editor_only=editor_only, cwd=cwd)
+
+        return _servers[key]
+
+
+@atexit.register
+def _close_servers() -> None:
+    for server in _servers.values():
+        server.close()
@@ -0,0 +1,516 @@
+import re
+import sys
+from abc import ABC, abstractmethod
+from collections.abc import Iterator, Sequence
+from re import Match, Pattern
+from typing import Any, Protocol
+
+from . import regex_patterns
+from .constants import PYGMENTS_PY_LANGS
+
+__all__ = (
+    "MD_PYCON_SCANNER",
+    "MD_SCANNER",
+    "RST_LITERAL_BLOCKS_SCANNER",
+    "RST_PYCON_SCANNER",
+    "RST_SCANNER",
+    "AnyMatch",
+    "BlockMatch",
+    "Scanner",
+)
+
+
+class BlockMatch:
+    # The parts of the re.Match interface that the processors use, for blocks
+    # found by the line-based scanners.
+    __slots__ = ("_spans", "string")
+
+    def __init__(self, string: str, spans: dict[str, tuple[int, int] | None]) -> None:
+        self.string = string
+        self._spans = spans
+
+    def __getitem__(self, group: int | str) -> Any:
+        span = self._spans["0" if group == 0 else str(group)]
+        return None if span is None else self.string[span[0] : span[1]]
+
+    def __repr__(self) -> str:
+        return f"<BlockMatch span={self.span()!r} match={self[0]!r}>"
+
+    def span(self, group: int | str = 0) -> tuple[int, int]:
+        span = self._spans["0" if group == 0 else str(group)]
+        return (-1, -1) if span is None else span
+
+    def start(self, group: int | str = 0) -> int:
+        return self.span(group)[0]
+
+    def end(self, group: int | str = 0) -> int:
+        return self.span(group)[1]
+
+
+type AnyMatch = Match[str] | BlockMatch
+
+
+class Scanner(Protocol):
+    def finditer(
+        self,
+        string: str,
+        pos: int = 0,
+        endpos: int = sys.maxsize,
+    ) -> Iterator[AnyMatch]: ...
+
+
+def _closes(closing: Match[str], opening: Match[str]) -> bool:
+    # As in CommonMark, a closing fence may have up to 3 spaces of indent;
+    # one with the indent of the opening fence closes a more nested block.
+    return (
+        (closing["indent"] == opening["indent"] or len(closing["indent"]) <= 3)
+        and closing["fence"].startswith(opening["fence"])
+        and not closing["info"].strip()
+    )
+
+
+def _closed(fences: Sequence[Match[str]]) -> list[bool]:
+    # Whether a later fence closes each one, found in one pass from the end
+    # by keeping the longest closing fence of each character after it, with
+    # up to 3 spaces of indent, and with each indent.
+    closed = [False] * len(fences)
+    longest: dict[tuple[str, str | None], int] = {}
+
+    for i in range(len(fences) - 1, -1, -1):
+        fence = fences[i]
+        char, length, indent = fence["fence"][0], len(fence["fence"]), fence["indent"]
+        closed[i] = (
+            max(longest.get((char, indent), 0), longest.get((char, None), 0)) >= length
+        )
+
+        if not fence["info"].strip():
+            longest[char, indent] = max(longest.get((char, indent), 0), length)
+            if len(indent) <= 3:
+                longest[char, None] = max(longest.get((char, None), 0), length)
+
+    return closed
+
+
+class _MarkdownFenceScanner:
+    # Fenced code blocks, in one pass over the fence lines. As in CommonMark, a
+    # block is closed by a fence of the same character that is at least as
+    # long, and the lines inside it are never fences themselves. An opening
+    # fence that nothing closes is skipped, rather than running to the end of
+    # the document, so one stray fence doesn't hide the blocks after it.
+    def __init__(self, langs: frozenset[str]) -> None:
+        self.langs = langs
+
+    def fences(
+        self,
+        string: str,
+        pos: int = 0,
+        endpos: int = sys.maxsize,
+    ) -> Iterator[tuple[int, int]]:
+        # The spans of all fenced blocks, whatever their language. One that
+        # isn't closed may yet be by a later edit, so it is taken to run to
+        # the end, and ends the scan.
+        endpos = min(endpos, len(string))
+
+        for block in regex_patterns.MD_FENCED_BLOCK_RE.finditer(string, pos, endpos):
+            if block["closing"] is None:
+                yield block.start(), endpos
+                return
+
+            yield block.span()
+
+    def finditer(
+        self,
+        string: str,
+        pos: int = 0,
+        endpos: int = sys.maxsize,
+    ) -> Iterator[BlockMatch]:
+        endpos = min(endpos, len(string))
+        fences = list(regex_patterns.MD_FENCE_RE.finditer(string, pos, endpos))
+        closed = _closed(fences)
+        i = 0
+
+        while i < len(fences):
+            opening = fences[i]
+            fence = opening["fence"]
+            info = opening["info"]
+            i += 1
+
+            # The info string of a backtick fence can't have backticks.
+            if (fence[0] == "`" and "`" in info) or not closed[i - 1]:
+                continue
+
+            while not _closes(fences[i], opening):
+                i += 1
+            closing = fences[i]
+            i += 1
+
+            # The language is the first word of the info string.
+            words = info.split(maxsplit=1)
+            if not words or words[0] not in self.langs:
+                continue
+
+            code_start = opening.end() + 1
+            yield BlockMatch(
+                string,
+                {
+                    "0": (opening.start(), closing.end()),
+                    "before": (opening.start(), code_start),
+                    "indent": opening.span("indent"),
+                    "code": (code_start, closing.start()),
+                    "after": closing.span(),
+                },
+            )
+
+
+# rST blocks are a header line, option lines indented past the header, blank
+# lines, and then the code: lines indented past the header, or empty. The
+# scanners below find the same blocks as these regular expressions did, but
+# looking at every line a bounded number of times:
+#
+# RST_RE = re.compile(
+#     rf"(?P<before>"
+#     rf"^(?P<indent> *)\.\. ("
+#     rf"jupyter-execute::|"
+#     rf"{BLOCK_TYPES}:: (?P<lang>\w+)|"
+#     rf"{DOCTEST_TYPES}::.*"
+#     rf")\n"
+#     rf"((?P=indent) +:.*\n)*"
+#     rf"( *\n)*"
+#     rf")"
+#     rf"(?P<code>(^((?P=indent) +.*)?\n)+)",
+#     re.MULTILINE,
+# )
+# RST_LITERAL_BLOCKS_RE = re.compile(
+#     r"(?P<before>"
+#     r"^(?! *\.\. )(?P<indent> *).*::\n"
+#     r"((?P=indent) +:.*\n)*"
+#     r"\n*"
+#     r")"
+#     r"(?P<code>(^((?P=indent) +.*)?\n)+)",
+#     re.MULTILINE,
+# )
+# RST_PYCON_RE = re.compile(
+#     r"(?P<before>"
+#     r"(?P<indent> *)\.\. ((code|code-block):: pycon|doctest::.*)\n"
+#     r"((?P=indent) +:.*\n)*"
+#     r"\n*"
+#     r")"
+#     r"(?P<code>(^((?P=indent) +.*)?(\n|$))+)",
+#     re.MULTILINE,
+# )
+#
+# Unlike the regular expressions, they can't backtrack through every way of
+# splitting a long indented region between options, blank lines, and code.
+
+
+_SPACES_RE = re.compile(" *")
+
+
+class _Lines:
+    # Line-level predicates over string[:endpos]. Line ends include the
+    # newline, if any.
+    __slots__ = ("endpos", "string")
+
+    def __init__(self, string: str, endpos: int) -> None:
+        self.string = string
+        self.endpos = min(endpos, len(string))
+
+    def end(self, start: int) -> int:
+        newline = self.string.find("\n", start, self.endpos)
+        return self.endpos if newline == -1 else newline + 1
+
+    def has_newline(self, start: int, end: int) -> bool:
+        return end > start and self.string[end - 1] == "\n"
+
+    def spaces(self, start: int, end: int) -> int:
+        match = _SPACES_RE.match(self.string, start, end)
+        assert match is not None
+        return match.end() - start
+
+    def is_option(self, start: int, end: int, indent: int) -> bool:
+        # (?P=indent) +:.*\n
+        if not self.has_newline(start, end):
+            return False
+        spaces = self.spaces(start, end)
+        return spaces > indent and self.string[start + spaces] == ":"
+
+    def is_blank(self, start: int, end: int, *, spaces_only: bool) -> bool:
+        # ( *\n) or \n
+        if not self.has_newline(start, end):
+            return False
+        if not spaces_only:
+            return end - start == 1
+        return self.spaces(start, end) == end - start - 1
+
+    def is_code(self, start: int, end: int, indent: int, *, at_eof: bool) -> bool:
+        # ((?P=indent) +.*)?\n, or with at_eof ((?P=indent) +.*)?(\n|$)
+        if not self.has_newline(start, end) and not (at_eof and end == self.endpos):
+            return False
+        content = end - start - self.has_newline(start, end)
+        return content == 0 or self.spaces(start, end) > indent
+
+
+def _match_body(
+    lines: _Lines,
+    start: int,
+    indent: int,
+    *,
+    spaces_only_blanks: bool,
+    at_eof: bool,
+) -> tuple[int, int] | None:
+    # Match options, blank lines, and code from the line at start, returning
+    # the span of the code.
+    options_end = start
+    while options_end < lines.endpos:
+        end = lines.end(options_end)
+        if not lines.is_option(options_end, end, indent):
+            break
+        options_end = end
+
+    blanks = [options_end]
+    while blanks[-1] < lines.endpos:
+        end = lines.end(blanks[-1])
+        if not lines.is_blank(blanks[-1], end, spaces_only=spaces_only_blanks):
+            break
+        blanks.append(end)
+
+    def code_end(code_start: int) -> int:
+        pos = code_start
+        while True:
+            end = lines.end(pos)
+            if not lines.is_code(pos, end, indent, at_eof=at_eof):
+                return pos
+            if end == pos:
+                # An empty last line, the regular expression's $.
+                return pos
+            pos = end
+
+    code_start = blanks[-1]
+    end = code_end(code_start)
+
+    if end > code_start or (at_eof and code_start == lines.endpos):
+        return code_start, end
+
+    # Backtrack like the regular expressions would: give the last blank line
+    # that can be code to the code...
+    for line_start in reversed(blanks[:-1]):
+        line_end = lines.end(line_start)
+        if lines.is_code(line_start, line_end, indent, at_eof=at_eof):
+            return line_start, line_end
+
+    # ...or else the last option line, with everything after it that can be.
+    if options_end > start:
+        last_option = start
+        while (next_option := lines.end(last_option)) < options_end:
+            last_option = next_option
+        return last_option, code_end(last_option)
+
+    return None
+
+
+def _match_body_or_shrink(
+    lines: _Lines,
+    start: int,
+    indent: int,
+    *,
+    spaces_only_blanks: bool,
+    at_eof: bool,
+) -> tuple[int, int, int] | None:
+    # Where the indent is only spaces that an earlier part of the regular
+    # expression could match instead, it can also shrink. That is only tried
+    # when no option or blank lines follow the header, so the first indent
+    # that works is one less than the following line's. Returns the indent
+    # along with the span of the code.
+    code = _match_body(
+        lines,
+        start,
+        indent,
+        spaces_only_blanks=spaces_only_blanks,
+        at_eof=at_eof,
+    )
+    if code is not None:
+        return indent, *code
+
+    spaces = lines.spaces(start, lines.end(start))
+    if not 0 < spaces <= indent:
+        return None
+
+    code = _match_body(
+        lines,
+        start,
+        spaces - 1,
+        spaces_only_blanks=spaces_only_blanks,
+        at_eof=at_eof,
+    )
+    if code is None:
+        return None
+
+    return spaces - 1, *code
+
+
+class _RstScanner(ABC):
+    # Lines that could hold a header, found without looking at the others.
+    candidate_re: Pattern[str]
+    # Whether headers start at the beginning of a line, like ^.
+    anchored = True
+
+    @abstractmethod
+    def _match_at(self, lines: _Lines, start: int) -> BlockMatch | None:
+        pass  # pragma: no cover
+
+    def finditer(
+        self,
+        string: str,
+        pos: int = 0,
+        endpos: int = sys.maxsize,
+    ) -> Iterator[BlockMatch]:
+        lines = _Lines(string, endpos)
+
+        if self.anchored and pos > 0 and string[pos - 1 : pos] != "\n":
+            pos = lines.end(pos)
+
+        while pos < lines.endpos:
+            candidate = self.candidate_re.search(string, pos, lines.endpos)
+            if candidate is None:
+                return
+
+            start = max(pos, string.rfind("\n", pos, candidate.start()) + 1)
+            match = self._match_at(lines, start)
+
+            if match is None:
+                pos = lines.end(start)
+            else:
+                yield match
+                pos = match.end()
+
+
+class _RstDirectiveScanner(_RstScanner):
+    candidate_re = re.compile(r"^ *\.\. ", re.MULTILINE)
+
+    def _match_at(self, lines: _Lines, start: int) -> BlockMatch | None:
+        header_end = lines.end(start)
+
+        if not lines.has_newline(start, header_end):
+            return None
+
+        header = regex_patterns.RST_DIRECTIVE_RE.fullmatch(
+            lines.string, start, header_end - 1
+        )
+        if header is None:
+            return None
+
+        indent = header.end("indent") - start
+        code = _match_body(
+            lines,
+            header_end,
+            indent,
+            spaces_only_blanks=True,
+            at_eof=False,
+        )
+        if code is None:
+            return None
+
+        return BlockMatch(
+            lines.string,
+            {
+                "0": (start, code[1]),
+                "before": (start, code[0]),
+                "indent": (start, start + indent),
+                "lang": header.span("lang") if header["lang"] is not None else None,
+                "code": code,
+            },
+        )
+
+
+class _RstLiteralBlockScanner(_RstScanner):
+    candidate_re = re.compile(r"::\n")
+
+    def _match_at(self, lines: _Lines, start: int) -> BlockMatch | None:
+        header_end = lines.end(start)
+
+        if not lines.has_newline(start, header_end):
+            return None
+
+        string = lines.string
+        if not string.endswith("::", start, header_end - 1):
+            return None
+
+        spaces = lines.spaces(start, header_end)
+        if string.startswith(".. ", start + spaces, header_end):
+            return None
+
+        indent = min(spaces, header_end - 3 - start)
+        code = _match_body_or_shrink(
+            lines,
+            header_end,
+            indent,
+            spaces_only_blanks=False,
+            at_eof=False,
+        )
+        if code is None:
+            return None
+
+        return BlockMatch(
+            string,
+            {
+                "0": (start, code[2]),
+                "before": (start, code[1]),
+                "indent": (start, start + code[0]),
+                "code": code[1:],
+            },
+        )
+
+
+class _RstPyconScanner(_RstScanner):
+    # Without ^, headers can start anywhere in a line.
+    candidate_re = re.compile(r"\.\. ")
+    anchored = False
+
+    def _match_at(self, lines: _Lines, start: int) -> BlockMatch | None:
+        string = lines.string
+        header_end = lines.end(start)
+
+        if not lines.has_newline(start, header_end):
+            return None
+
+        dots = string.find(".. ", start, header_end)
+        while dots != -1:
+            if regex_patterns.RST_PYCON_DIRECTIVE_RE.fullmatch(
+                string, dots, header_end - 1
+            ):
+                break
+            dots = string.find(".. ", dots + 1, header_end)
+        else:
+            return None
+
+        # If the code can't follow the first header on the line, even with a
+        # shorter indent, it can't follow a later one either.
+        text_end = start + len(string[start:dots].rstrip(" "))
+
+        code = _match_body_or_shrink(
+            lines,
+            header_end,
+            dots - text_end,
+            spaces_only_blanks=False,
+            at_eof=True,
+        )
+        if code is None:
+            return None
+
+        block_start = dots - code[0]
+        return BlockMatch(
+            string,
+            {
+                "0": (block_start, code[2]),
+                "before": (block_start, code[1]),
+                "indent": (block_start, dots),
+                "code": code[1:],
+            },
+        )
+
+
+RST_SCANNER = _RstDirectiveScanner()
+RST_LITERAL_BLOCKS_SCANNER = _RstLiteralBlockScanner()
+RST_PYCON_SCANNER = _RstPyconScanner()
+MD_SCANNER = _MarkdownFenceScanner(PYGMENTS_PY_LANGS)
+MD_PYCON_SCANNER = _MarkdownFenceScanner(frozenset(("pycon",)))
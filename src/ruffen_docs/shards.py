@@ -0,0 +1,70 @@
+import heapq
+import re
+from collections.abc import Iterable, Mapping
+from pathlib import Path
+
+__all__ = (
+    "ShardError",
+    "parse_shard",
+    "shard_files",
+)
+
+SHARD_RE = re.compile(r"(?P<index>\d+)/(?P<count>\d+)")
+
+
+class ShardError(Exception):
+    pass
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    # "i/N", for the i-th of N shards, counting from 1.
+    match = SHARD_RE.fullmatch(value.strip())
+    if match is None:
+        raise ShardError(f"shard must be given as INDEX/COUNT, not {value!r}")
+
+    index, count = int(match["index"]), int(match["count"])
+    if not 1 <= index <= count:
+        raise ShardError(f"shard index must be from 1 to {count}, not {index}")
+
+    return index, count
+
+
+def _size(filename: str) -> float:
+    try:
+        return Path(filename).stat().st_size
+    except OSError:
+        return 0
+
+
+def shard_files(
+    filenames: Iterable[str],
+    index: int,
+    count: int,
+    costs: Mapping[str, float] | None = None,
+) -> list[str]:
+    # The files of one of count shards, of about the same cost, where every
+    # runner given the same files and costs picks the same files for each
+    # shard, whatever order they were found in. The cost of a file is the
+    # time it took in a previous run, from costs, or else its size. Files
+    # new since that run are taken to cost what the others did on average.
+    filenames = list(filenames)
+
+    if costs is not None and len(costs) > 0:
+        known = [costs[f] for f in filenames if f in costs]
+        default = sum(known) / len(known) if known else 0.0
+        cost = {f: costs.get(f, default) for f in filenames}
+    else:
+        cost = {f: _size(f) for f in filenames}
+
+    # The costliest files first, each to the shard with the least so far,
+    # which breaks ties by its index.
+    totals = [(0.0, i) for i in range(1, count + 1)]
+    chosen = set()
+
+    for filename in sorted(set(filenames), key=lambda f: (-cost[f], f)):
+        total, i = heapq.heappop(totals)
+        if i == index:
+            chosen.add(filename)
+        heapq.heappush(totals, (total + cost[filename], i))
+
+    return [f for f in filenames if f in chosen]
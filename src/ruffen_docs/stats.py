@@ -0,0 +1,35 @@
+import dataclasses
+from typing import Self
+
+__all__ = ("Stats",)
+
+
+@dataclasses.dataclass
+class Stats:
+    # Code blocks, and pycon fragments, passed to a processor, and how many of
+    # them were sent to the formatter or short-circuited, with stored for
+    # those found in the --cache-dir cache.
+    blocks: int = 0
+    formatted: int = 0
+    cached: int = 0
+    trivial: int = 0
+    stored: int = 0
+
+    def __add__(self, other: Self) -> Self:
+        return dataclasses.replace(
+            self,
+            **{
+                field.name: getattr(self, field.name) + getattr(other, field.name)
+                for field in dataclasses.fields(self)
+            },
+        )
+
+    def summary(self) -> str:
+        avoided = self.cached + self.trivial + self.stored
+        stored = f", {self.stored} from the cache" if self.stored else ""
+
+        return (
+            f"{self.blocks} code blocks, {self.formatted} formatted, "
+            f"{avoided} formatter calls avoided "
+            f"({self.cached} known stable, {self.trivial} trivial{stored})"
+        )
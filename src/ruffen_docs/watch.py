@@ -0,0 +1,253 @@
+import contextlib
+import ctypes
+import os
+import select
+import struct
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from re import Pattern
+from types import TracebackType
+from typing import Self
+
+from .discovery import is_included, iter_files
+
+__all__ = (
+    "InotifyWatcher",
+    "PollingWatcher",
+    "Watcher",
+    "open_watcher",
+)
+
+# Seconds without events after a change before the changed files are handed
+# over, so that an editor saving several files, or writing one in several
+# steps, is processed once.
+DEBOUNCE = 0.1
+POLL_INTERVAL = 1.0
+
+# From <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC
+_EVENT = struct.Struct("iIII")
+
+
+class Watcher(ABC):
+    # Reports documentation files under paths, walked like the command line
+    # walks them, that were written since the last call to wait().
+    def __init__(
+        self,
+        paths: Sequence[str],
+        exclude: Pattern[str] | None = None,
+    ) -> None:
+        self.paths = paths
+        self.exclude = exclude
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    @abstractmethod
+    def close(self) -> None:
+        pass  # pragma: no cover
+
+    @abstractmethod
+    def wait(self, timeout: float | None) -> set[str]:
+        # Blocks until files change, or timeout seconds pass.
+        pass  # pragma: no cover
+
+    def batches(self, debounce: float = DEBOUNCE) -> Iterator[list[str]]:
+        # Changed files, once they have been left alone for debounce seconds.
+        while True:
+            changed = self.wait(None)
+            while more := self.wait(debounce):
+                changed |= more
+
+            # Files can be gone by the time the burst is over.
+            batch = sorted(f for f in changed if Path(f).is_file())
+            if batch:
+                yield batch
+
+    def _included(self, path: str) -> bool:
+        # Whether path is a file, or a directory, that would be processed.
+        for root in self.paths:
+            if Path(root).is_dir():
+                if is_included(path, root, self.exclude):
+                    return True
+            elif Path(path) == Path(root):
+                return True
+
+        return False
+
+
+class InotifyWatcher(Watcher):
+    # Sleeps in the kernel until a watched directory changes. Every directory
+    # under paths is watched, and those created later as they appear; files
+    # given as paths are watched through their directory.
+    def __init__(
+        self,
+        paths: Sequence[str],
+        exclude: Pattern[str] | None = None,
+    ) -> None:
+        super().__init__(paths, exclude)
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._directories: dict[int, str] = {}
+
+        try:
+            for path in paths:
+                if Path(path).is_dir():
+                    self._watch_tree(path)
+                else:
+                    self._watch(str(Path(path).parent))
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _watch(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(
+            self._fd,
+            os.fsencode(directory),
+            IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR | IN_DONT_FOLLOW,
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"can't watch {directory}: {os.strerror(errno)}")
+
+        self._directories[wd] = directory
+
+    def _watch_tree(self, directory: str) -> None:
+        self._watch(directory)
+
+        # Only the directories that are walked for files, so that ignored
+        # trees don't use up watches.
+        for dirpath, dirnames, _ in os.walk(directory):
+            dirnames[:] = [
+                dirname
+                for dirname in dirnames
+                if self._included(str(Path(dirpath, dirname)))
+            ]
+            for dirname in dirnames:
+                self._watch(str(Path(dirpath, dirname)))
+
+    def wait(self, timeout: float | None) -> set[str]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = os.read(self._fd, 65536)
+        changed = set()
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, so every file may have changed.
+                changed.update(iter_files(self.paths, self.exclude))
+                continue
+
+            if wd not in self._directories:
+                continue
+
+            path = str(Path(self._directories[wd], os.fsdecode(name)))
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self._included(path):
+                    # Files can be written before the directory is watched,
+                    # which fails if it is already gone again.
+                    with contextlib.suppress(OSError):
+                        self._watch_tree(path)
+                        changed.update(iter_files([path]))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.add(path)
+
+        return {filename for filename in changed if self._included(filename)}
+
+
+class PollingWatcher(Watcher):
+    # Walks paths every interval seconds, comparing modification times and
+    # sizes, where inotify isn't available.
+    def __init__(
+        self,
+        paths: Sequence[str],
+        exclude: Pattern[str] | None = None,
+        interval: float = POLL_INTERVAL,
+    ) -> None:
+        super().__init__(paths, exclude)
+        self.interval = interval
+        self._stats = self._snapshot()
+
+    def close(self) -> None:
+        pass
+
+    def _snapshot(self) -> dict[str, tuple[int, int]]:
+        stats = {}
+
+        for filename in iter_files(self.paths, self.exclude):
+            try:
+                st = Path(filename).stat()
+            except OSError:
+                continue
+            stats[filename] = (st.st_mtime_ns, st.st_size)
+
+        return stats
+
+    def wait(self, timeout: float | None) -> set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+
+            stats = self._snapshot()
+            changed = {
+                filename
+                for filename, stat in stats.items()
+                if self._stats.get(filename) != stat
+            }
+            self._stats = stats
+
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+def open_watcher(
+    paths: Sequence[str],
+    exclude: Pattern[str] | None = None,
+) -> Watcher:
+    # inotify on Linux, unless it runs out of watches, and polling elsewhere.
+    if sys.platform == "linux":
+        try:
+            return InotifyWatcher(paths, exclude)
+        except (OSError, AttributeError):
+            pass
+
+    return PollingWatcher(paths, exclude)
@@ -1,12 +1,61 @@
-from textwrap import dedent
-
+import asyncio
+import difflib
+import io
+import json
+import os
+import pickle
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from textwrap import dedent, indent
+
+import black
+import pytest
 from black import Mode
+from black.mode import TargetVersion
 
 from ruffen_docs import (
     __main__,  # noqa: F401
+    incremental,
+    indentation,
     run_black,
+    run_check,
+    run_ruff,
+)
+from ruffen_docs.aio import AsyncProcessor
+from ruffen_docs.backends import (
+    BackendError,
+    RuffChecker,
+    RuffFormatter,
+    get_backend,
 )
+from ruffen_docs.blocks import CodeBlock
+from ruffen_docs.cache import BlockCache, CacheError, cache_stats, merge_caches
+from ruffen_docs.config import Config, clear_config_cache, resolve_config
+from ruffen_docs.diff import color_diff, unified_diff
+from ruffen_docs.discovery import is_included, iter_files, stream_files
+from ruffen_docs.errors import CodeBlockError
+from ruffen_docs.incremental import DocumentIndex
+from ruffen_docs.intervals import Intervals
+from ruffen_docs.lsp import LanguageServer
+from ruffen_docs.prechecks import trivial_output
+from ruffen_docs.processors import BaseProcessor
 from ruffen_docs.processors import BlackFormatter as Processor
+from ruffen_docs.regex_patterns import ENGINE, ENGINE_VARIABLE
+from ruffen_docs.ruff_server import get_server
+from ruffen_docs.scanners import (
+    RST_LITERAL_BLOCKS_SCANNER,
+    RST_PYCON_SCANNER,
+    RST_SCANNER,
+)
+from ruffen_docs.shards import ShardError, parse_shard, shard_files
+from ruffen_docs.stats import Stats
+from ruffen_docs.watch import InotifyWatcher, PollingWatcher
 
 BLACK_MODE = Mode()
 
@@ -118,6 +167,55 @@ def test_process_src_markdown_trailing_whitespace():
     )
 
 
+def test_process_src_markdown_tilde_fence():
+    before = "~~~python\nf(1,2,3)\n~~~\n"
+    after, _ = Processor().process_str(before)
+    assert after == "~~~python\nf(1, 2, 3)\n~~~\n"
+
+
+def test_process_src_markdown_longer_closing_fence():
+    before = "````python\nf(1,2,3)\n```\n`````\n"
+    after, errors = Processor().process_str(before)
+    assert after == before
+    assert len(errors) == 1
+
+
+def test_process_src_markdown_info_string():
+    before = "```python title='f.py'\nf(1,2,3)\n```\n"
+    after, _ = Processor().process_str(before)
+    assert after == "```python title='f.py'\nf(1, 2, 3)\n```\n"
+
+
+def test_process_src_markdown_fence_within_fence():
+    before = "````md\n```python\nf(1,2,3)\n```\n````\n"
+    after, _ = Processor().process_str(before)
+    assert after == before
+
+
+def test_process_src_markdown_unclosed_fences():
+    unclosed = "```python\nf(1,2,3)\n\n" * 1000
+    before = "```python\nf(1,2,3)\n```\n" + unclosed
+    after, _ = Processor().process_str(before)
+    assert after == "```python\nf(1, 2, 3)\n```\n" + unclosed
+
+
+def test_process_src_markdown_closing_fence_indent():
+    # A closing fence may have up to 3 spaces of indent, whatever the
+    # opening fence's.
+    before = "- item\n\n  ```python\n  f(1,2)\n```\n\n```python\nf(1,2)\n```\n"
+    after, _ = Processor().process_str(before)
+    assert after == (
+        "- item\n\n  ```python\n  f(1, 2)\n```\n\n```python\nf(1, 2)\n```\n"
+    )
+
+
+def test_process_src_markdown_unmatched_fence():
+    # Only the block that isn't closed is skipped.
+    before = "```python\nf(1,2)\n    ```\n\n~~~python\nf(1,2)\n~~~\n"
+    after, _ = Processor().process_str(before)
+    assert after == "```python\nf(1,2)\n    ```\n\n~~~python\nf(1, 2)\n~~~\n"
+
+
 def test_process_src_indented_markdown():
     before = dedent(
         """\
@@ -381,6 +479,32 @@ def test_process_src_markdown_comments_multiple():
     assert after == before
 
 
+def test_process_src_markdown_many_off_on_comments():
+    before = (
+        "<!-- ruffen-docs:off -->\n"
+        "```python\nf(1,2,3)\n```\n"
+        "<!-- ruffen-docs:on -->\n"
+        "```python\ng(1,2,3)\n```\n"
+    ) * 200
+    after, _ = Processor().process_str(before)
+    assert after == before.replace("g(1,2,3)", "g(1, 2, 3)")
+
+
+def test_intervals():
+    intervals = Intervals([(10, 20), (0, 5)])
+    intervals.add(30, 40)
+
+    assert list(intervals) == [(0, 5), (10, 20), (30, 40)]
+    assert intervals.contains((10, 20))
+    assert intervals.contains((10, 15))
+    assert not intervals.contains((5, 10))
+    assert not intervals.contains((15, 25))
+    assert intervals.overlaps((15, 25))
+    assert intervals.overlaps((4, 11))
+    assert not intervals.overlaps((5, 10))
+    assert not intervals.overlaps((40, 50))
+
+
 def test_on_off_comments_in_code_blocks():
     before = dedent(
         """\
@@ -876,6 +1000,61 @@ def test_process_src_rst_python_comments():
     assert after == before
 
 
+def test_regex_engines():
+    # The test_process_src_* tests again, with the patterns that the regex
+    # module can compile compiled by the engine not in use here.
+    other = "re" if ENGINE is not re else "regex"
+    if other == "regex":
+        pytest.importorskip("regex")
+
+    result = subprocess.run(
+        (
+            sys.executable,
+            "-m",
+            "pytest",
+            "-q",
+            "-p",
+            "no:randomly",
+            "-p",
+            "no:cacheprovider",
+            "-k",
+            "test_process_src",
+            __file__,
+        ),
+        env={**os.environ, ENGINE_VARIABLE: other},
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 0, result.stdout
+    assert " passed" in result.stdout
+
+
+def test_regex_patterns_compiled_on_first_use():
+    code = (
+        "import sys\n"
+        "from ruffen_docs import regex_patterns\n"
+        "from ruffen_docs.processors import BlackFormatter\n"
+        "def compiled():\n"
+        "    return sorted(n for n in vars(regex_patterns) if n.endswith('_RE'))\n"
+        "assert compiled() == [], compiled()\n"
+        "BlackFormatter().process_str('```python\\nf(1,2)\\n```\\n')\n"
+        "assert 'LATEX_RE' not in compiled(), compiled()\n"
+        "assert 'regex' not in sys.modules\n"
+        "assert regex_patterns.LATEX_RE is regex_patterns.LATEX_RE\n"
+        "assert 'PYTHONTEX_RE' in compiled(), compiled()\n"
+    )
+
+    result = subprocess.run(
+        (sys.executable, "-c", code),
+        env={**os.environ, ENGINE_VARIABLE: "re"},
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 0, result.stderr
+
+
 def test_integration_ok(tmp_path, capsys):
     f = tmp_path / "f.md"
     f.write_text(
@@ -943,6 +1122,20 @@ def test_integration_check(tmp_path):
     assert f.read_text() == text
 
 
+def test_integration_check_syntax_error(tmp_path, capsys):
+    # Blocks after the first that changes are still checked for errors.
+    f = tmp_path / "f.md"
+    text = "```python\nf( )\n```\n\n```python\nf(\n```\n"
+    f.write_text(text)
+
+    result = run_black((str(f), "--check"))
+
+    assert result == 2
+    out, _ = capsys.readouterr()
+    assert out.startswith(f"{f}:5: code block parse error cannot parse: 1:2\n")
+    assert f.read_text() == text
+
+
 def test_integration_preview(tmp_path):
     f = tmp_path / "f.md"
     f.write_text(
@@ -1540,3 +1733,1679 @@ def test_process_src_rst_pycon_empty():
     before = "some text\n\n.. code-block:: pycon\n\n\nsome other text\n"
     after, _ = Processor().process_str(before)
     assert after == before
+
+
+def test_process_src_stop_on_change():
+    before = dedent(
+        """\
+        ```python
+        f(1,2,3)
+        ```
+
+        ```python
+        g(1,2,3)
+        ```
+        """
+    )
+    after, errors = Processor().process_str(before, stop_on_change=True)
+    assert errors == []
+    assert after == dedent(
+        """\
+        ```python
+        f(1, 2, 3)
+        ```
+
+        ```python
+        g(1,2,3)
+        ```
+        """
+    )
+
+
+def test_integration_check_fail_fast(tmp_path, capsys):
+    f1 = tmp_path / "f1.md"
+    f1.write_text("```python\nf(1,2,3)\n```\n")
+    f2 = tmp_path / "f2.md"
+    f2.write_text("```python\ng(1,2,3)\n```\n")
+
+    result = run_black((str(f1), str(f2), "--check", "--fail-fast"))
+
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert out == f"{f1}: Requires a rewrite.\n"
+
+
+def test_process_src_error_offset_after_rewrite():
+    before = "```python\nf(1,2,3)\n```\n\n.. code-block:: python\n\n    f(\n"
+    _, errors = Processor().process_str(before)
+    assert [error.offset for error in errors] == [before.index(".. code-block")]
+
+
+def test_process_src_blocks():
+    before = "```python\nf(1,2,3)\n```\n\n.. code-block:: python\n\n    f(\n"
+    processor = Processor()
+    _, errors = processor.process_str(before)
+
+    assert processor.blocks == [
+        CodeBlock(0, "markdown", 0, 22, 0, 10, 19),
+        CodeBlock(0, "rst", 24, 55, 0, 48, 55),
+    ]
+    assert processor.blocks[1].code(before) == "    f(\n"
+    assert [(error.offset, error.type_name) for error in errors] == [
+        (24, "InvalidInput")
+    ]
+
+
+def test_blocks_and_errors_pickle():
+    block = CodeBlock(1, "rst", 2, 3, 4, 5, 6)
+    error = CodeBlockError.from_exception(7, ValueError("bad"))
+
+    assert pickle.loads(pickle.dumps(block)) == block
+    assert pickle.loads(pickle.dumps(error)) == CodeBlockError(7, "bad", "ValueError")
+
+
+def test_process_src_rst_whitespace_only_line():
+    before = ".. code-block:: python\n\n    f(1,2,3)\n  \n"
+    after, _ = Processor().process_str(before)
+    assert after == ".. code-block:: python\n\n    f(1, 2, 3)\n"
+
+
+def test_indentation_matches_textwrap():
+    rng = random.Random(0)
+
+    for _ in range(1000):
+        text = "".join(rng.choice((" ", " ", "\t", "\n", "x")) for _ in range(40))
+
+        margin, dedented = indentation.dedent(text)
+        assert dedented == dedent(text)
+        assert all(line.startswith(margin) for line in text.split("\n") if line.strip())
+        assert indentation.indent(text, "  ") == indent(text, "  ")
+
+
+@pytest.mark.parametrize(
+    "code",
+    (
+        "",
+        "   ",
+        "\n",
+        " \t\n\n",
+        "# a\n",
+        "#\n# b\n\n# c\n",
+        "#a\n",
+        "# a \n",
+        "    # a\n",
+        "\n# a\n",
+        "# a\n\n",
+        "# a\n\n\n# b\n",
+        "#!a\n",
+        "# a",
+        "x = 1\n",
+    ),
+)
+def test_trivial_output_matches_black(code):
+    output = trivial_output(code)
+    assert output is None or output == black.format_str(code, mode=BLACK_MODE)
+
+
+def test_process_src_stats():
+    before = (
+        "```python\nf(1,2,3)\n```\n"
+        "```python\nf(1, 2, 3)\n```\n"
+        "```python\nf(1, 2, 3)\n```\n"
+        "```python\n# comment\n```\n"
+    )
+    processor = Processor()
+    after, _ = processor.process_str(before)
+
+    assert after == before.replace("f(1,2,3)", "f(1, 2, 3)")
+    assert processor.stats == Stats(blocks=4, formatted=2, cached=1, trivial=1)
+
+
+def test_integration_stats(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1, 2, 3)\n```\n```python\nf(1, 2, 3)\n```\n")
+
+    result = run_black(("--stats", str(f)))
+
+    assert result == 0
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert err == (
+        "2 code blocks, 1 formatted, 1 formatter calls avoided "
+        "(1 known stable, 0 trivial)\n"
+    )
+
+
+def test_unified_diff_matches_difflib():
+    rng = random.Random(0)
+
+    for _ in range(200):
+        src = "".join(f"line {i}\n" for i in range(rng.randint(1, 40)))
+        edits = []
+        pos = 0
+        for k in range(rng.randint(1, 4)):
+            if pos >= len(src):
+                break
+            start = rng.randint(pos, len(src) - 1)
+            end = rng.randint(start + 1, min(len(src), start + 40))
+            lines = rng.randint(0, 3)
+            replacement = "".join(f"new {k} {j}\n" for j in range(lines))
+            edits.append((start, end, replacement))
+            pos = end + rng.randint(0, 30)
+
+        after = src
+        for start, end, replacement in reversed(edits):
+            after = after[:start] + replacement + after[end:]
+
+        expected = difflib.unified_diff(
+            src.splitlines(keepends=True),
+            after.splitlines(keepends=True),
+            "f.md",
+            "f.md",
+        )
+        # difflib runs a line missing its newline into the next one instead
+        # of adding a marker.
+        result = unified_diff(src, edits, "f.md")
+        result = result.replace("\n\\ No newline at end of file\n", "")
+        assert result == "".join(expected)
+
+
+def test_unified_diff_no_newline_at_end_of_file():
+    assert unified_diff("a\nb", [(2, 3, "c")], "f.md") == dedent(
+        """\
+        --- f.md
+        +++ f.md
+        @@ -1,2 +1,2 @@
+         a
+        -b
+        \\ No newline at end of file
+        +c
+        \\ No newline at end of file
+        """
+    )
+
+
+def test_integration_diff(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    text = "# Title\n\n```python\nf(1,2,3)\n```\n\nText\n"
+    f.write_text(text)
+
+    result = run_black((str(f), "--diff"))
+
+    assert result == 1
+    assert f.read_text() == text
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == [
+        f"--- {f}",
+        f"+++ {f}",
+        "@@ -1,7 +1,7 @@",
+        " # Title",
+        " ",
+        " ```python",
+        "-f(1,2,3)",
+        "+f(1, 2, 3)",
+        " ```",
+        " ",
+        " Text",
+    ]
+
+
+def test_integration_diff_color(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    result = run_black((str(f), "--diff", "--color"))
+
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert out == color_diff(
+        unified_diff(f.read_text(), [(10, 19, "f(1, 2, 3)\n")], str(f))
+    )
+    assert "\033[32m+f(1, 2, 3)\033[0m" in out
+
+
+def test_process_src_line_ranges():
+    before = dedent(
+        """\
+        ```python
+        f(1,2,3)
+        ```
+
+        ```python
+        g(1,2,3)
+        ```
+        """
+    )
+    after, _ = Processor().process_str(before, line_ranges=[(6, 6)])
+    assert after == dedent(
+        """\
+        ```python
+        f(1,2,3)
+        ```
+
+        ```python
+        g(1, 2, 3)
+        ```
+        """
+    )
+
+
+def git(*args):
+    subprocess.run(
+        (
+            "git",
+            "-c",
+            "user.name=ruffen-docs",
+            "-c",
+            "user.email=ruffen-docs@example.com",
+            *args,
+        ),
+        check=True,
+        capture_output=True,
+    )
+
+
+def test_integration_since(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    git("init")
+    (tmp_path / "a.md").write_text("```python\nf(1,2,3)\n```\n")
+    (tmp_path / "b.md").write_text("```python\ng(1,2,3)\n```\n")
+    git("add", ".")
+    git("commit", "-m", "initial")
+    (tmp_path / "b.md").write_text("```python\ng(1,2,3,4)\n```\n")
+    (tmp_path / "c.md").write_text("```python\nh(1,2,3)\n```\n")
+    (tmp_path / "c.txt").write_text("```python\nh(1,2,3)\n```\n")
+
+    result = run_black(("--since", "HEAD"))
+
+    assert result == 1
+    assert (tmp_path / "a.md").read_text() == "```python\nf(1,2,3)\n```\n"
+    assert (tmp_path / "b.md").read_text() == "```python\ng(1, 2, 3, 4)\n```\n"
+    assert (tmp_path / "c.md").read_text() == "```python\nh(1, 2, 3)\n```\n"
+    assert (tmp_path / "c.txt").read_text() == "```python\nh(1,2,3)\n```\n"
+
+
+def test_integration_changed_only(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    git("init")
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n\n```python\ng(1,2,3)\n```\n")
+    git("add", ".")
+    git("commit", "-m", "initial")
+    f.write_text("```python\nf(1,2,3)\n```\n\n```python\ng(1,2,3,4)\n```\n")
+
+    result = run_black(("--changed-only", "f.md"))
+
+    assert result == 1
+    assert (
+        f.read_text() == "```python\nf(1,2,3)\n```\n\n```python\ng(1, 2, 3, 4)\n```\n"
+    )
+
+
+def test_integration_since_bad_revision(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    git("init")
+
+    with pytest.raises(SystemExit) as excinfo:
+        run_black(("--since", "nope"))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "nope" in err
+
+
+def test_iter_files(tmp_path):
+    (tmp_path / ".gitignore").write_text("build/\n*.tmp.md\n")
+    (tmp_path / "a.md").touch()
+    (tmp_path / "a.tmp.md").touch()
+    (tmp_path / "b.txt").touch()
+    (tmp_path / "build").mkdir()
+    (tmp_path / "build" / "c.rst").touch()
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / ".gitignore").write_text("/skip.py\n")
+    (tmp_path / "docs" / "d.py").touch()
+    (tmp_path / "docs" / "skip.py").touch()
+    (tmp_path / "docs" / "e.tex").touch()
+    (tmp_path / "vendor").mkdir()
+    (tmp_path / "vendor" / "f.markdown").touch()
+
+    assert [
+        Path(f).relative_to(tmp_path).as_posix()
+        for f in iter_files([str(tmp_path)], re.compile("^/vendor/"))
+    ] == ["a.md", "docs/d.py", "docs/e.tex"]
+    assert sorted(
+        path.relative_to(tmp_path).as_posix()
+        for path in tmp_path.rglob("*")
+        if is_included(str(path), str(tmp_path), re.compile("^/vendor/"))
+    ) == ["a.md", "docs", "docs/d.py", "docs/e.tex"]
+
+
+def test_iter_files_parent_gitignore(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    git("init")
+    (tmp_path / ".gitignore").write_text("docs/generated/\n")
+    (tmp_path / "docs" / "generated").mkdir(parents=True)
+    (tmp_path / "docs" / "generated" / "a.md").touch()
+    (tmp_path / "docs" / "b.md").touch()
+
+    assert list(iter_files(["docs"])) == [str(Path("docs", "b.md"))]
+
+
+def test_stream_files_keeps_order(tmp_path):
+    for name in ("b.md", "a.md", "c.rst"):
+        (tmp_path / name).touch()
+
+    assert list(stream_files(["x.md", str(tmp_path), "y.md"])) == [
+        "x.md",
+        str(tmp_path / "a.md"),
+        str(tmp_path / "b.md"),
+        str(tmp_path / "c.rst"),
+        "y.md",
+    ]
+
+
+def watched_tree(tmp_path):
+    (tmp_path / ".gitignore").write_text("build/\n")
+    (tmp_path / "build").mkdir()
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "a.md").write_text("a")
+    (tmp_path / "docs" / "b.md").write_text("b")
+
+
+def test_inotify_watcher(tmp_path):
+    watched_tree(tmp_path)
+
+    with InotifyWatcher([str(tmp_path)]) as watcher:
+        assert watcher.wait(0) == set()
+
+        (tmp_path / "docs" / "a.md").write_text("changed")
+        (tmp_path / "docs" / "a.txt").write_text("not documentation")
+        (tmp_path / "build" / "c.md").write_text("ignored")
+        (tmp_path / "new").mkdir()
+        (tmp_path / "new" / "d.rst").write_text("in a new directory")
+
+        changed = set()
+        while more := watcher.wait(0.5):
+            changed |= more
+
+        (tmp_path / "new" / "d.rst").write_text("watched now")
+        changed_again = watcher.wait(0.5)
+
+    assert changed == {
+        str(tmp_path / "docs" / "a.md"),
+        str(tmp_path / "new" / "d.rst"),
+    }
+    assert changed_again == {str(tmp_path / "new" / "d.rst")}
+
+
+def test_polling_watcher_batches(tmp_path):
+    watched_tree(tmp_path)
+    watcher = PollingWatcher([str(tmp_path)], interval=0.01)
+    (tmp_path / "docs" / "a.md").write_text("changed")
+    (tmp_path / "docs" / "b.md").unlink()
+    (tmp_path / "build" / "c.md").write_text("ignored")
+
+    with watcher:
+        batch = next(watcher.batches(debounce=0.05))
+
+    assert batch == [str(tmp_path / "docs" / "a.md")]
+
+
+def test_integration_watch(tmp_path, monkeypatch, capsys):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    class Watcher:
+        def __init__(self, paths, exclude):
+            assert paths == [str(tmp_path)]
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+        def batches(self):
+            f.write_text("```python\ng(1,2,3)\n```\n")
+            yield [str(f)]
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr("ruffen_docs.open_watcher", Watcher)
+
+    assert run_black(("--watch", str(tmp_path))) == 1
+    assert f.read_text() == "```python\ng(1, 2, 3)\n```\n"
+    out, _ = capsys.readouterr()
+    assert out.count("Rewriting...") == 2
+
+
+def test_integration_watch_since(capsys):
+    with pytest.raises(SystemExit):
+        run_black(("--watch", "--changed-only", "."))
+
+    _, err = capsys.readouterr()
+    assert "--watch" in err
+
+
+def test_integration_directory(tmp_path):
+    (tmp_path / "docs").mkdir()
+    f = tmp_path / "docs" / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    result = run_black((str(tmp_path),))
+
+    assert result == 1
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+LONG_CALL = "foo(very_very_very_very_very_very_very, long_long_long_long_long)\n"
+
+
+def test_resolve_config(tmp_path):
+    (tmp_path / "pyproject.toml").write_text(
+        "[tool.ruffen-docs]\n"
+        'target-version = ["py311"]\n'
+        "skip-string-normalization = true\n"
+    )
+    (tmp_path / "ruff.toml").write_text("line-length = 60\npreview = true\n")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / ".ruff.toml").write_text("line-length = 70\n")
+
+    assert resolve_config(tmp_path, ruff=True) == Config(
+        line_length=60,
+        target_versions=frozenset({TargetVersion.PY311}),
+        string_normalization=False,
+        preview=True,
+    )
+    assert resolve_config(tmp_path / "sub", ruff=True) == Config(
+        line_length=70,
+        target_versions=frozenset({TargetVersion.PY311}),
+        string_normalization=False,
+    )
+    assert resolve_config(tmp_path / "sub") is resolve_config(tmp_path / "sub")
+
+    # ruff's settings are only for the ruff backends.
+    assert resolve_config(tmp_path) == Config(
+        target_versions=frozenset({TargetVersion.PY311}),
+        string_normalization=False,
+    )
+
+    # And files are read again once the cache is cleared.
+    (tmp_path / "sub" / ".ruff.toml").write_text("line-length = 80\n")
+    assert resolve_config(tmp_path / "sub", ruff=True).line_length == 70
+    clear_config_cache()
+    assert resolve_config(tmp_path / "sub", ruff=True).line_length == 80
+
+
+def test_integration_black_ignores_ruff_config(tmp_path):
+    (tmp_path / "ruff.toml").write_text("line-length = 40\n")
+    f = tmp_path / "f.md"
+    f.write_text("```python\nfoo(long_long_long_long, long_long_long_long)\n```\n")
+
+    assert run_black((str(f),)) == 0
+    assert run_ruff(("--backend=ruff-format", str(f))) == 1
+
+
+def test_integration_config(tmp_path):
+    (tmp_path / "pyproject.toml").write_text("[tool.ruffen-docs]\nline-length = 50\n")
+    f = tmp_path / "f.md"
+    f.write_text(f"```python\n{LONG_CALL}```\n")
+
+    result = run_black((str(f), "--line-length=80"))
+    assert result == 0
+
+    result2 = run_black((str(f),))
+    assert result2 == 1
+    assert f.read_text() == (
+        "```python\n"
+        "foo(\n"
+        "    very_very_very_very_very_very_very,\n"
+        "    long_long_long_long_long,\n"
+        ")\n"
+        "```\n"
+    )
+
+
+def test_integration_config_unknown_option(tmp_path, capsys):
+    (tmp_path / "pyproject.toml").write_text("[tool.ruffen-docs]\nnope = 1\n")
+    f = tmp_path / "f.md"
+    f.touch()
+
+    with pytest.raises(SystemExit) as excinfo:
+        run_black((str(f),))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "unknown option 'nope'" in err
+
+
+def test_process_python_src_docstrings_only():
+    before = dedent(
+        '''\
+        def f():
+            """
+            ```python
+            f(1,2,3)
+            ```
+            """
+            return """
+            ```python
+            f(1,2,3)
+            ```
+            """
+        '''
+    )
+    after, _ = Processor().process_python_str(before)
+    assert after == dedent(
+        '''\
+        def f():
+            """
+            ```python
+            f(1, 2, 3)
+            ```
+            """
+            return """
+            ```python
+            f(1,2,3)
+            ```
+            """
+        '''
+    )
+
+
+def test_process_python_src_class_docstring_non_ascii():
+    before = dedent(
+        '''\
+        class Ünïcode:
+            r"""Ünïcode
+
+            .. code-block:: python
+
+                f(1,2,3)
+            """
+        '''
+    )
+    after, _ = Processor().process_python_str(before)
+    assert after == before.replace("f(1,2,3)", "f(1, 2, 3)")
+
+
+def test_process_python_src_escapes_quotes():
+    before = dedent(
+        '''\
+        """
+        ```python
+        x = \'\'\'a\'\'\'
+        ```
+        """
+        '''
+    )
+    after, errors = Processor().process_python_str(before)
+    assert errors == []
+    assert after == dedent(
+        '''\
+        """
+        ```python
+        x = \\"\\"\\"a\\"\\"\\"
+        ```
+        """
+        '''
+    )
+
+
+def test_process_python_src_raw_docstring_quotes():
+    before = dedent(
+        '''\
+        r"""
+        ```python
+        x = \'\'\'a\'\'\'
+        ```
+        """
+        '''
+    )
+    after, errors = Processor().process_python_str(before)
+    assert after == before
+    assert [error.message for error in errors] == [
+        "formatted code would end the raw docstring"
+    ]
+
+
+def test_process_python_src_syntax_error():
+    before = dedent(
+        '''\
+        def f(:
+            """
+            ```python
+            f(1,2,3)
+            ```
+            """
+        '''
+    )
+    after, _ = Processor().process_python_str(before)
+    assert after == before.replace("f(1,2,3)", "f(1, 2, 3)")
+
+
+def test_integration_python_file(tmp_path):
+    f = tmp_path / "f.py"
+    f.write_text('x = """\n```python\nf(1,2,3)\n```\n"""\n')
+
+    result = run_black((str(f),))
+
+    assert result == 0
+
+
+# The regular expressions the rST scanners replaced.
+RST_RE = re.compile(
+    r"(?P<before>"
+    r"^(?P<indent> *)\.\. ("
+    r"jupyter-execute::|"
+    r"(code|code-block|sourcecode|ipython):: (?P<lang>\w+)|"
+    r"(testsetup|testcleanup|testcode)::.*"
+    r")\n"
+    r"((?P=indent) +:.*\n)*"
+    r"( *\n)*"
+    r")"
+    r"(?P<code>(^((?P=indent) +.*)?\n)+)",
+    re.MULTILINE,
+)
+RST_LITERAL_BLOCKS_RE = re.compile(
+    r"(?P<before>"
+    r"^(?! *\.\. )(?P<indent> *).*::\n"
+    r"((?P=indent) +:.*\n)*"
+    r"\n*"
+    r")"
+    r"(?P<code>(^((?P=indent) +.*)?\n)+)",
+    re.MULTILINE,
+)
+RST_PYCON_RE = re.compile(
+    r"(?P<before>"
+    r"(?P<indent> *)\.\. ((code|code-block):: pycon|doctest::.*)\n"
+    r"((?P=indent) +:.*\n)*"
+    r"\n*"
+    r")"
+    r"(?P<code>(^((?P=indent) +.*)?(\n|$))+)",
+    re.MULTILINE,
+)
+RST_LINES = (
+    ".. code-block:: python",
+    ".. code-block:: python ",
+    ".. code:: pycon",
+    "..  code:: pycon",
+    ".. doctest::",
+    ".. testcode::",
+    ".. jupyter-execute::",
+    ".. note::",
+    "text::",
+    "text ::",
+    "x .. doctest::",
+    ".. doctest:: .. doctest::",
+    ":option:",
+    ":",
+    ">>> f(1,2,3)",
+    "x",
+    "",
+)
+
+
+@pytest.mark.parametrize(
+    ("scanner", "regex", "groups"),
+    (
+        (RST_SCANNER, RST_RE, (0, "before", "indent", "lang", "code")),
+        (
+            RST_LITERAL_BLOCKS_SCANNER,
+            RST_LITERAL_BLOCKS_RE,
+            (0, "before", "indent", "code"),
+        ),
+        (RST_PYCON_SCANNER, RST_PYCON_RE, (0, "before", "indent", "code")),
+    ),
+    ids=("rst", "rst_literal_blocks", "rst_pycon"),
+)
+def test_rst_scanner_matches_regex(scanner, regex, groups):
+    rng = random.Random(0)
+
+    def spans(matches):
+        return [[(group, m.span(group), m[group]) for group in groups] for m in matches]
+
+    for _ in range(5000):
+        src = "\n".join(
+            " " * rng.choice((0, 0, 1, 2, 3, 4, 8)) + rng.choice(RST_LINES)
+            for _ in range(rng.randrange(12))
+        )
+        if rng.random() < 0.7:
+            src += "\n"
+        pos = rng.randint(0, len(src)) if rng.random() < 0.3 else 0
+        endpos = rng.randint(pos, len(src)) if rng.random() < 0.3 else len(src)
+
+        expected = spans(regex.finditer(src, pos, endpos))
+        assert spans(scanner.finditer(src, pos, endpos)) == expected, src
+
+
+def test_async_process_str():
+    async def main():
+        async with AsyncProcessor(Processor(), use_processes=False) as processor:
+            return await asyncio.gather(
+                processor.aprocess_str("```python\nf(1,2,3)\n```\n"),
+                processor.aprocess_str(
+                    '"""\n```python\nf(1,2,3)\n```\n"""\n', python=True
+                ),
+            )
+
+    assert asyncio.run(main()) == [
+        ("```python\nf(1, 2, 3)\n```\n", []),
+        ('"""\n```python\nf(1, 2, 3)\n```\n"""\n', []),
+    ]
+
+
+def test_async_process_files_in_processes(tmp_path):
+    filenames = []
+    for i in range(3):
+        f = tmp_path / f"f{i}.md"
+        f.write_text(f"```python\nf({i},2,3)\n```\n")
+        filenames.append(str(f))
+
+    async def main():
+        async with AsyncProcessor(Processor(), max_workers=2) as processor:
+            return await processor.aprocess_files(filenames)
+
+    assert asyncio.run(main()) == [
+        (f"```python\nf({i}, 2, 3)\n```\n", []) for i in range(3)
+    ]
+    assert (tmp_path / "f0.md").read_text() == "```python\nf(0,2,3)\n```\n"
+
+
+_release = threading.Event()
+_formatted = []
+
+
+class BlockingProcessor(Processor):
+    def process_code_block(self, code_block):
+        _formatted.append(code_block)
+        _release.wait()
+        return super().process_code_block(code_block)
+
+
+def test_async_process_str_cancelled():
+    async def main():
+        async with AsyncProcessor(
+            BlockingProcessor(), max_workers=1, use_processes=False
+        ) as processor:
+            first = asyncio.create_task(
+                processor.aprocess_str("```python\nf(1,2,3)\n```\n")
+            )
+            second = asyncio.create_task(
+                processor.aprocess_str("```python\ng(1,2,3)\n```\n")
+            )
+            while not _formatted:
+                await asyncio.sleep(0.01)
+
+            second.cancel()
+            _release.set()
+
+            with pytest.raises(asyncio.CancelledError):
+                await second
+            return await first
+
+    assert asyncio.run(main()) == ("```python\nf(1, 2, 3)\n```\n", [])
+    assert _formatted == ["f(1,2,3)\n"]
+
+
+def test_async_process_str_cancelled_while_formatting():
+    # Its worker is still busy, so the next document waits for it.
+    release = threading.Event()
+    formatted = []
+
+    class SlowProcessor(Processor):
+        def process_code_block(self, code_block):
+            formatted.append(code_block)
+            release.wait()
+            return super().process_code_block(code_block)
+
+    async def main():
+        async with AsyncProcessor(
+            SlowProcessor(), max_workers=2, concurrency=1, use_processes=False
+        ) as processor:
+            first = asyncio.create_task(
+                processor.aprocess_str("```python\nf(1,2,3)\n```\n")
+            )
+            while not formatted:
+                await asyncio.sleep(0.01)
+
+            first.cancel()
+            second = asyncio.create_task(
+                processor.aprocess_str("```python\ng(1,2,3)\n```\n")
+            )
+            try:
+                await asyncio.sleep(0.1)
+                assert formatted == ["f(1,2,3)\n"]
+            finally:
+                release.set()
+            return await second
+
+    assert asyncio.run(main()) == ("```python\ng(1, 2, 3)\n```\n", [])
+    assert formatted == ["f(1,2,3)\n", "g(1,2,3)\n"]
+
+
+def lsp_session(*messages, **options):
+    stdin = io.BytesIO()
+    for message in messages:
+        # Bytes are sent as they are.
+        if isinstance(message, bytes):
+            stdin.write(message)
+            continue
+        body = json.dumps({"jsonrpc": "2.0", **message}).encode()
+        stdin.write(b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+    stdin.seek(0)
+    stdout = io.BytesIO()
+
+    result = LanguageServer(stdin, stdout, **options).serve()
+
+    responses = []
+    output = stdout.getvalue()
+    while output:
+        header, _, output = output.partition(b"\r\n\r\n")
+        length = int(header.split(b":")[1])
+        responses.append(json.loads(output[:length]))
+        output = output[length:]
+
+    return result, responses
+
+
+LSP_URI = "file:///tmp/ruffen-docs-lsp/doc.md"
+LSP_INITIALIZE = {"id": 0, "method": "initialize", "params": {"capabilities": {}}}
+LSP_SHUTDOWN = ({"id": 99, "method": "shutdown"}, {"method": "exit"})
+
+
+def lsp_open(text):
+    return {
+        "method": "textDocument/didOpen",
+        "params": {
+            "textDocument": {
+                "uri": LSP_URI,
+                "languageId": "markdown",
+                "version": 1,
+                "text": text,
+            },
+        },
+    }
+
+
+def test_lsp_formatting():
+    result, responses = lsp_session(
+        LSP_INITIALIZE,
+        lsp_open("```python\nf(1,2,3)\n```\n"),
+        {
+            "method": "textDocument/didChange",
+            "params": {
+                "textDocument": {"uri": LSP_URI, "version": 2},
+                "contentChanges": [
+                    {
+                        "range": {
+                            "start": {"line": 1, "character": 0},
+                            "end": {"line": 1, "character": 1},
+                        },
+                        "text": "😀 = g",
+                    },
+                ],
+            },
+        },
+        {
+            "id": 1,
+            "method": "textDocument/formatting",
+            "params": {"textDocument": {"uri": LSP_URI}, "options": {}},
+        },
+        *LSP_SHUTDOWN,
+    )
+
+    assert result == 0
+    assert responses[0]["result"]["capabilities"]["positionEncoding"] == "utf-16"
+    assert responses[1]["method"] == "textDocument/publishDiagnostics"
+    assert responses[1]["params"]["diagnostics"] == []
+    assert responses[2] == {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "result": [
+            {
+                "range": {
+                    "start": {"line": 0, "character": 0},
+                    "end": {"line": 2, "character": 3},
+                },
+                "newText": "```python\n😀 = g(1, 2, 3)\n```",
+            },
+        ],
+    }
+    assert responses[3] == {"jsonrpc": "2.0", "id": 99, "result": None}
+
+
+def test_lsp_range_formatting():
+    text = "```python\nf(1,2,3)\n```\n\n```python\ng(1,2,3)\n```\n"
+    _, responses = lsp_session(
+        {
+            "id": 0,
+            "method": "initialize",
+            "params": {"capabilities": {"general": {"positionEncodings": ["utf-32"]}}},
+        },
+        lsp_open(text),
+        {
+            "id": 1,
+            "method": "textDocument/rangeFormatting",
+            "params": {
+                "textDocument": {"uri": LSP_URI},
+                "range": {
+                    "start": {"line": 5, "character": 0},
+                    "end": {"line": 6, "character": 0},
+                },
+                "options": {},
+            },
+        },
+        *LSP_SHUTDOWN,
+    )
+
+    assert responses[0]["result"]["capabilities"]["positionEncoding"] == "utf-32"
+    assert responses[2]["result"] == [
+        {
+            "range": {
+                "start": {"line": 4, "character": 0},
+                "end": {"line": 6, "character": 3},
+            },
+            "newText": "```python\ng(1, 2, 3)\n```",
+        },
+    ]
+
+
+def test_lsp_errors():
+    result, responses = lsp_session(
+        {"id": 0, "method": "textDocument/formatting", "params": {}},
+        LSP_INITIALIZE,
+        lsp_open("```python\nf(\n```\n"),
+        {
+            "id": 1,
+            "method": "textDocument/formatting",
+            "params": {"textDocument": {"uri": LSP_URI}, "options": {}},
+        },
+        {"id": 2, "method": "textDocument/hover", "params": {}},
+        {"method": "exit"},
+    )
+
+    assert result == 1
+    assert responses[0]["error"]["code"] == -32002
+    [diagnostic] = responses[2]["params"]["diagnostics"]
+    assert diagnostic["range"]["start"] == {"line": 0, "character": 0}
+    assert diagnostic["message"].startswith("code block parse error")
+    assert responses[3]["result"] == []
+    assert responses[4]["error"]["code"] == -32601
+
+
+def test_lsp_parse_errors():
+    result, responses = lsp_session(
+        b"Content-Length: 5\r\n\r\n{nope",
+        b"Content-Length: five\r\n\r\n",
+        b"Content-Length: 2\r\n\r\n[]",
+        LSP_INITIALIZE,
+        *LSP_SHUTDOWN,
+    )
+
+    assert result == 0
+    assert [(r["id"], r.get("error", {}).get("code")) for r in responses] == [
+        (None, -32700),
+        (None, -32700),
+        (None, -32600),
+        (0, None),
+        (99, None),
+    ]
+
+
+def test_lsp_internal_errors():
+    result, responses = lsp_session(
+        LSP_INITIALIZE,
+        {"method": "textDocument/didOpen", "params": {}},
+        {"id": 1, "method": "textDocument/formatting", "params": {"textDocument": {}}},
+        lsp_open("```python\nf(1,2,3)\n```\n"),
+        {
+            "id": 2,
+            "method": "textDocument/formatting",
+            "params": {"textDocument": {"uri": LSP_URI}, "options": {}},
+        },
+        *LSP_SHUTDOWN,
+    )
+
+    assert result == 0
+    assert responses[1]["method"] == "window/logMessage"
+    assert "KeyError" in responses[1]["params"]["message"]
+    assert responses[2]["error"]["code"] == -32603
+    assert "f(1, 2, 3)\n" in responses[4]["result"][0]["newText"]
+
+
+def test_lsp_backend(tmp_path):
+    _, responses = lsp_session(
+        LSP_INITIALIZE,
+        lsp_open("```python\nf('a',2)\n```\n"),
+        {
+            "id": 1,
+            "method": "textDocument/formatting",
+            "params": {"textDocument": {"uri": LSP_URI}, "options": {}},
+        },
+        *LSP_SHUTDOWN,
+        backend="ruff-format",
+        cache_dir=str(tmp_path),
+    )
+
+    assert 'f("a", 2)\n' in responses[2]["result"][0]["newText"]
+    assert (tmp_path / "blocks.sqlite3").exists()
+
+
+class ReplacingProcessor(Processor):
+    # Fast and easy to predict, for comparing many documents.
+    def process_code_block(self, code_block):
+        if "!" in code_block:
+            raise ValueError(code_block)
+        return code_block.replace("x", "y")
+
+
+INCREMENTAL_LINES = (
+    "```python\n",
+    "```pycon\n",
+    "```text\n",
+    "```\n",
+    "~~~\n",
+    ">>> x\n",
+    "... x\n",
+    "x = 1\n",
+    "x!\n",
+    "text\n",
+    "\n",
+    "  \n",
+    "    x\n",
+    "   :linenos:\n",
+    ".. code-block:: python\n",
+    "  .. doctest::\n",
+    "Example::\n",
+    "\\begin{minted}{python}\n",
+    "\\begin{minted}[a]{pycon}\n",
+    "\\end{minted}\n",
+    "\\begin{pycode}\n",
+    "  \\end{pycode}\n",
+    "<!-- ruffen-docs:off -->\n",
+    "<!-- ruffen-docs:on -->\n",
+    ".. ruffen-docs:off\n",
+)
+
+
+def test_document_index_matches_process_str():
+    rng = random.Random(0)
+
+    def lines():
+        return "".join(rng.choice(INCREMENTAL_LINES) for _ in range(rng.randrange(4)))
+
+    def error_offsets(errors):
+        return sorted(error.offset for error in errors)
+
+    for _ in range(300):
+        rst_literal_blocks = rng.random() < 0.5
+        index = DocumentIndex(
+            ReplacingProcessor(),
+            rst_literal_blocks=rst_literal_blocks,
+            segment_size=rng.choice((1, 10, 100)),
+        )
+        src = "".join(lines() for _ in range(10))
+
+        for _ in range(5):
+            processor = ReplacingProcessor()
+            expected, errors = processor.process_str(
+                src, rst_literal_blocks=rst_literal_blocks
+            )
+            new_src, index_errors = index.update(src)
+
+            assert new_src == expected, src
+            assert index.edits == processor.edits, src
+            assert error_offsets(index_errors) == error_offsets(errors), src
+            assert set(index.blocks) == set(processor.blocks), src
+
+            start = rng.randint(0, len(src))
+            end = min(len(src), start + rng.randrange(30))
+            src = f"{src[:start]}{lines() or rng.choice('x`! ')}{src[end:]}"
+
+
+def test_document_index_rescans_around_edit(monkeypatch):
+    blocks = [f"Paragraph {i}.\n\n```python\nf({i},2)\n```\n\n" for i in range(300)]
+    processor = Processor()
+    index = DocumentIndex(processor, segment_size=1000)
+    index.update("".join(blocks))
+
+    # Fences are found again only from the one before the edit.
+    found = []
+    pattern_spans = incremental._pattern_spans
+
+    def counted_spans(*args):
+        for span in pattern_spans(*args):
+            found.append(span)
+            yield span
+
+    monkeypatch.setattr(incremental, "_pattern_spans", counted_spans)
+    blocks[150] = blocks[150].replace(",2)", ",3)")
+    formatted = processor.stats.formatted
+    new_src, errors = index.update("".join(blocks))
+
+    assert new_src == Processor().process_str("".join(blocks))[0]
+    assert not errors
+    assert index.rescanned == 1
+    assert len(found) <= 3
+    assert len(index.blocks) == 300
+    assert processor.stats.formatted - formatted <= 25
+
+
+class BatchingProcessor(Processor):
+    supports_batching = True
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def process_code_block(self, code_block):
+        raise AssertionError("formatted outside a batch")
+
+    def process_code_blocks(self, code_blocks):
+        self.batches.append(list(code_blocks))
+        outputs = []
+        for code_block in code_blocks:
+            try:
+                outputs.append(black.format_str(code_block, mode=self.mode))
+            except black.InvalidInput as e:
+                outputs.append(e)
+        return outputs
+
+
+def test_process_src_batched():
+    before = dedent(
+        """\
+        ```python
+        f(1,2,3)
+        ```
+
+        ```python
+        f(1,2,3)
+        ```
+
+        ```python
+        pass
+        ```
+
+        ```python
+        f(
+        ```
+
+        .. code-block:: python
+
+            g(4,5)
+        """
+    )
+    processor = BatchingProcessor()
+
+    after, errors = processor.process_str(before)
+
+    assert (after, errors) == Processor().process_str(before)
+    assert processor.batches == [["f(1,2,3)\n", "pass\n", "f(\n", "g(4,5)\n"]]
+    assert len(errors) == 1
+
+    # Blocks known to be stable aren't batched again.
+    processor.process_str(after)
+
+    assert processor.batches[1:] == [["f(1, 2, 3)\n", "f(\n", "g(4, 5)\n"]]
+
+
+class UpperProcessor(BaseProcessor):
+    def process_code_block(self, code_block):
+        return code_block.upper()
+
+
+def test_base_processor_from_config():
+    processor = UpperProcessor.from_config(Config())
+
+    assert processor.process_str("```python\nx = 1\n```\n") == (
+        "```python\nX = 1\n```\n",
+        [],
+    )
+
+
+def test_base_processor_stop_on_change():
+    processor = UpperProcessor()
+    before = "```python\nx = 1\n```\n```python\ny = 2\n```\n```python\nf(\n```\n"
+
+    after, errors = processor.process_str(before, stop_on_change=True)
+
+    assert after == before.replace("x", "X")
+    assert errors == [
+        CodeBlockError(40, "Cannot parse: 1:2: '(' was never closed", "SyntaxError")
+    ]
+
+
+def test_get_backend():
+    assert get_backend("black") is Processor
+    assert get_backend("ruff-format") is RuffFormatter
+
+    with pytest.raises(BackendError, match="unknown backend 'blue'"):
+        get_backend("blue")
+
+
+@pytest.mark.parametrize("server", [True, False])
+def test_ruff_formatter(server):
+    processor = RuffFormatter(line_length=20, server=server)
+    before = "```python\nf(1,2,3)\n```\n```python\nf(1,)\n```\n```python\nf(\n```\n"
+
+    after, errors = processor.process_str(before)
+
+    assert after == (
+        "```python\nf(1, 2, 3)\n```\n```python\nf(\n    1,\n)\n```\n"
+        "```python\nf(\n```\n"
+    )
+    assert [error.message for error in errors] == [
+        "Cannot parse: 2:1: unexpected EOF while parsing"
+    ]
+    assert processor.process_code_block("x  =  1\n") == "x = 1\n"
+
+
+@pytest.mark.parametrize("server", [True, False])
+def test_ruff_checker(tmp_path, monkeypatch, server):
+    (tmp_path / "ruff.toml").write_text('lint.select = ["F401"]\n')
+    monkeypatch.chdir(tmp_path)
+    processor = RuffChecker(server=server)
+
+    after, errors = processor.process_str(
+        "```python\nimport os\nx  =  1\n```\n```python\nf(\n```\n"
+    )
+
+    assert after == "```python\nx  =  1\n```\n```python\nf(\n```\n"
+    assert [error.message for error in errors] == [
+        "Cannot parse: 2:1: unexpected EOF while parsing"
+    ]
+
+
+@pytest.mark.parametrize("server", [True, False])
+def test_ruff_checker_diagnostics(tmp_path, monkeypatch, server):
+    # A block with diagnostics ruff can't fix is left as it is.
+    (tmp_path / "ruff.toml").write_text('lint.select = ["F401", "F821"]\n')
+    monkeypatch.chdir(tmp_path)
+    processor = RuffChecker(server=server)
+    before = (
+        "```python\nimport os\nprint(undefined_name)\n```\n"
+        "```python\nimport sys\nx = 1\n```\n"
+    )
+
+    after, errors = processor.process_str(before)
+
+    assert after == before.replace("import sys\n", "")
+    assert errors == [
+        CodeBlockError(
+            0,
+            "1:8: F401 `os` imported but unused\n"
+            "2:7: F821 Undefined name `undefined_name`",
+            "LintError",
+        )
+    ]
+
+
+def test_integration_check_diagnostics(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    f = tmp_path / "f.md"
+    f.write_text("# f\n\n```python\nprint(undefined_name)\n```\n")
+
+    assert run_check(("--check", str(f))) == 2
+    assert capsys.readouterr().out == (
+        f"{f}:3: code block lint error 1:7: F821 Undefined name `undefined_name`\n"
+    )
+
+
+@pytest.mark.parametrize("server", [True, False])
+def test_ruff_checker_whitespace(tmp_path, monkeypatch, server):
+    # ruff check leaves whitespace alone, unlike the formatters.
+    monkeypatch.chdir(tmp_path)
+    processor = RuffChecker(server=server)
+
+    assert processor.process_str("```python\n\n\n```\n") == ("```python\n\n\n```\n", [])
+    assert processor.stats.trivial == 0
+
+
+def test_chain(tmp_path, monkeypatch):
+    (tmp_path / "ruff.toml").write_text('lint.select = ["F401"]\n')
+    monkeypatch.chdir(tmp_path)
+    backend = get_backend("ruff-check,ruff-format")
+    before = "```python\nimport os\nx  =  1\n```\n```python\nf(\n```\n"
+
+    after, errors = backend.from_config(Config()).process_str(before)
+
+    assert backend.supports_batching
+    assert backend.thread_safe
+    assert after == "```python\nx = 1\n```\n```python\nf(\n```\n"
+    assert [error.message for error in errors] == [
+        "Cannot parse: 2:1: unexpected EOF while parsing"
+    ]
+    assert get_backend("ruff-check,ruff-format") is backend
+    assert not get_backend("black,ruff-check").thread_safe
+
+
+def test_integration_chain(tmp_path, monkeypatch, capsys):
+    (tmp_path / "ruff.toml").write_text('lint.select = ["F401"]\n')
+    monkeypatch.chdir(tmp_path)
+    f = tmp_path / "f.md"
+    f.write_text("```python\nimport os\nx  =  1\n```\n")
+
+    result = run_ruff((str(f),))
+
+    assert result == 1
+    assert capsys.readouterr().out == f"{f}: Rewriting...\n"
+    assert f.read_text() == "```python\nx = 1\n```\n"
+
+
+def test_ruff_server_restarts():
+    server = get_server({"line-length": 30}, editor_only=True)
+
+    assert server.format(["f(1,2)\n"]) == ["f(1, 2)\n"]
+
+    assert server._connection is not None
+    server._connection.process.kill()
+
+    assert server.format(["g(1,2)\n", "g(\n"])[0] == "g(1, 2)\n"
+
+
+@pytest.mark.parametrize("backend", ["black", "ruff-format"])
+def test_integration_jobs(tmp_path, capsys, backend):
+    for i in range(6):
+        (tmp_path / f"{i}.md").write_text("```python\nf(1,2,3)\n```\n")
+    (tmp_path / "6.md").write_text("```python\nf(1, 2, 3)\n```\n")
+
+    result = run_black(("--backend", backend, "--jobs=3", "--stats", str(tmp_path)))
+
+    assert result == 1
+    out, err = capsys.readouterr()
+    assert out == "".join(f"{tmp_path / f'{i}.md'}: Rewriting...\n" for i in range(6))
+    assert err.startswith("7 code blocks, 7 formatted")
+    for i in range(7):
+        assert (tmp_path / f"{i}.md").read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+def test_integration_profile(tmp_path, capsys, recwarn):
+    for i in range(3):
+        (tmp_path / f"{i}.md").write_text("```python\nf(1, 2, 3)\n```\n")
+    done = threading.Event()
+    thread = threading.Thread(target=done.wait)
+    thread.start()
+
+    try:
+        result = run_black(("--profile", "--jobs=2", str(tmp_path)))
+    finally:
+        done.set()
+        thread.join()
+
+    # Worker processes aren't forked from a process with threads running.
+    assert not [w for w in recwarn if "fork()" in str(w.message)]
+
+    assert result == 0
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert re.fullmatch(
+        r"startup \d+\.\d{3}s CPU, warm-up \d+\.\d{3}s, "
+        r"3 files in \d+\.\d{3}s \(2 processes\)\n",
+        err,
+    )
+
+
+def test_integration_unknown_backend(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        run_black(("--backend", "blue", str(tmp_path)))
+
+    assert "unknown backend 'blue'" in capsys.readouterr().err
+
+
+def test_parse_shard():
+    assert parse_shard("2/3") == (2, 3)
+
+    for value in ("0/3", "4/3", "1", "a/b"):
+        with pytest.raises(ShardError):
+            parse_shard(value)
+
+
+def test_shard_files():
+    costs = {"a": 5.0, "b": 4.0, "c": 3.0, "d": 3.0, "e": 1.0}
+    filenames = ["e", "d", "c", "b", "a", "f"]
+
+    shards = [shard_files(filenames, i, 2, costs) for i in (1, 2)]
+
+    # f, new since costs were taken, costs the average.
+    assert shards == [["e", "c", "a"], ["d", "b", "f"]]
+    assert shards == [shard_files(filenames[::-1], i, 2, costs)[::-1] for i in (1, 2)]
+
+
+def test_integration_shard_reports(tmp_path, capsys):
+    for i in range(5):
+        (tmp_path / f"{i}.md").write_text("```python\nf(1,2,3)\n```\n" * (i + 1))
+    (tmp_path / "5.md").write_text("```python\nf(1, 2, 3)\n```\n")
+
+    results = [
+        run_black((
+            "--check",
+            f"--shard={i}/2",
+            f"--report={tmp_path / f'report{i}.json'}",
+            str(tmp_path),
+        ))
+        for i in (1, 2)
+    ]
+
+    assert results == [1, 1]
+    reports = [json.loads((tmp_path / f"report{i}.json").read_text()) for i in (1, 2)]
+    assert [report["shard"] for report in reports] == [[1, 2], [2, 2]]
+    assert sorted(reports[0]["files"]) == [str(tmp_path / f"{i}.md") for i in (1, 4, 5)]
+    assert sorted(reports[1]["files"]) == [str(tmp_path / f"{i}.md") for i in (0, 2, 3)]
+
+    merged = tmp_path / "merged.json"
+    result = run_black((
+        "--merge-reports",
+        str(tmp_path / "report1.json"),
+        str(tmp_path / "report2.json"),
+        f"--report={merged}",
+    ))
+
+    assert result == 1
+    report = json.loads(merged.read_text())
+    assert report["shard"] is None
+    assert report["stats"]["blocks"] == 16
+    assert {f: r["retv"] for f, r in report["files"].items()} == {
+        str(tmp_path / f"{i}.md"): int(i < 5) for i in range(6)
+    }
+
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        run_black((
+            "--merge-reports",
+            str(tmp_path / "report1.json"),
+            f"--report={merged}",
+        ))
+
+    assert "not of each of 1 to 2" in capsys.readouterr().err
+
+
+def test_block_cache(tmp_path):
+    cache = BlockCache(tmp_path, ("black", "1.0", "mode"))
+    cache.put("f(1,2)\n", "f(1, 2)\n")
+    cache.put("x = 1\n", "x = 1\n")
+    cache.close()
+
+    cache = BlockCache(tmp_path, ("black", "1.0", "mode"))
+    assert cache.get("f(1,2)\n") == "f(1, 2)\n"
+    assert cache.get("x = 1\n") == "x = 1\n"
+    assert cache.get("y = 1\n") is None
+    assert BlockCache(tmp_path, ("black", "1.0", "other")).get("x = 1\n") is None
+    cache.close()
+
+    # Outputs that don't match their checksum are dropped.
+    connection = sqlite3.connect(tmp_path / "blocks.sqlite3")
+    with connection:
+        connection.execute("UPDATE blocks SET output = 'g(1, 2)\n'")
+    connection.close()
+    assert BlockCache(tmp_path, ("black", "1.0", "mode")).get("f(1,2)\n") is None
+
+    # As are outputs of other versions.
+    BlockCache(tmp_path, ("black", "2.0", "mode")).open()
+    assert cache_stats(tmp_path).blocks == {}
+
+    # A cache that isn't a database is started afresh.
+    (tmp_path / "blocks.sqlite3").write_text("not a database")
+    cache = BlockCache(tmp_path, ("black", "2.0", "mode"))
+    cache.put("x = 1\n", "x = 1\n")
+    assert cache_stats(tmp_path).blocks == {("black", "2.0"): 1}
+
+
+def test_cache_stats_damaged(tmp_path):
+    # A damaged cache is reported, and left as it is.
+    damaged = random.Random(0).randbytes(8192)
+    (tmp_path / "blocks.sqlite3").write_bytes(damaged)
+
+    stats = cache_stats(tmp_path)
+
+    assert stats.integrity == "file is not a database"
+    assert stats.blocks == {}
+    assert (tmp_path / "blocks.sqlite3").read_bytes() == damaged
+
+    with pytest.raises(CacheError, match="no such cache file"):
+        cache_stats(tmp_path / "missing")
+    assert not (tmp_path / "missing").exists()
+
+
+def test_merge_caches_not_a_cache(tmp_path):
+    notes = tmp_path / "notes.txt"
+    notes.write_text("not a cache\n")
+
+    with pytest.raises(CacheError, match=r"notes\.txt: file is not a database"):
+        merge_caches(tmp_path / "cache", [notes])
+
+    assert notes.read_text() == "not a cache\n"
+
+
+def test_integration_cache_dir(tmp_path, capsys):
+    (tmp_path / "docs").mkdir()
+    for i in range(3):
+        (tmp_path / "docs" / f"{i}.md").write_text(f"```python\nf(1,2,{i})\n```\n")
+    cache_dir = tmp_path / "cache"
+
+    assert (
+        run_black((
+            "--cache-dir",
+            str(cache_dir),
+            "--stats",
+            "--check",
+            str(tmp_path / "docs"),
+        ))
+        == 1
+    )
+    assert capsys.readouterr().err.startswith("3 code blocks, 3 formatted")
+
+    assert (
+        run_black(("--cache-dir", str(cache_dir), "--stats", str(tmp_path / "docs")))
+        == 1
+    )
+    assert capsys.readouterr().err == (
+        "3 code blocks, 0 formatted, 3 formatter calls avoided "
+        "(0 known stable, 0 trivial, 3 from the cache)\n"
+    )
+    assert (tmp_path / "docs" / "2.md").read_text() == "```python\nf(1, 2, 2)\n```\n"
+
+    assert run_black(("cache", "stats", "--cache-dir", str(cache_dir))) == 0
+    out = capsys.readouterr().out
+    assert "integrity ok" in out
+    assert f"black {black.__version__}: 3 code blocks" in out
+
+    other = tmp_path / "other"
+    run_black((
+        "--cache-dir",
+        str(other),
+        "--backend",
+        "ruff-format",
+        str(tmp_path / "docs"),
+    ))
+    assert (
+        run_black((
+            "cache",
+            "merge",
+            "--cache-dir",
+            str(cache_dir),
+            str(other / "blocks.sqlite3"),
+        ))
+        == 0
+    )
+    assert capsys.readouterr().out == "3 code blocks added\n"
+
+    assert (
+        run_black(("cache", "prune", "--cache-dir", str(cache_dir), "--max-age", "1"))
+        == 0
+    )
+    assert capsys.readouterr().out == "0 code blocks deleted\n"
+
+
+def test_process_src_max_block_lines():
+    before = "```python\nf(1,2)\n```\n```python\nf(1,2)\ng(1,2)\nh(1,2)\n```\n"
+    processor = Processor()
+    processor.max_block_lines = 2
+
+    after, errors = processor.process_str(before)
+
+    assert after == "```python\nf(1, 2)\n```\n```python\nf(1,2)\ng(1,2)\nh(1,2)\n```\n"
+    assert errors == [
+        CodeBlockError(
+            21, "code block has 3 lines, more than the maximum of 2", "BlockSizeError"
+        )
+    ]
+
+
+def test_process_src_batched_max_block_lines():
+    before = "```python\nf(1,2)\n```\n```python\n" + "f(1,2)\n" * 10 + "```\n"
+    processor = BatchingProcessor()
+    processor.max_block_lines = 3
+
+    after, errors = processor.process_str(before)
+
+    assert processor.batches == [["f(1,2)\n"]]
+    assert after == "```python\nf(1, 2)\n```\n```python\n" + "f(1,2)\n" * 10 + "```\n"
+    assert [error.type_name for error in errors] == ["BlockSizeError"]
+
+
+class SlowProcessor(Processor):
+    def process_code_block(self, code_block):
+        if "slow" in code_block:
+            time.sleep(60)
+        return super().process_code_block(code_block)
+
+
+def test_process_src_block_timeout():
+    before = "```python\nslow(1,2)\n```\n```python\nf(1,2)\n```\n```python\nf(\n```\n"
+    processor = SlowProcessor()
+    processor.block_timeout = 1
+
+    start = time.monotonic()
+    after, errors = processor.process_str(before)
+
+    assert time.monotonic() - start < 30
+    assert after == (
+        "```python\nslow(1,2)\n```\n```python\nf(1, 2)\n```\n```python\nf(\n```\n"
+    )
+    assert [(error.offset, error.type_name) for error in errors] == [
+        (0, "BlockTimeoutError"),
+        (45, "InvalidInput"),
+    ]
+    assert errors[0].message == "formatting took longer than 1s"
+
+
+def test_integration_block_limits(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2)\n```\n\n```python\nf(1,2)\ng(1,2)\n```\n")
+
+    result = run_black((str(f), "--block-timeout=30", "--max-block-lines=1"))
+
+    assert result == 2
+    assert capsys.readouterr().out == (
+        f"{f}:5: code block parse error code block has 2 lines, "
+        "more than the maximum of 1\n"
+    )
+    assert f.read_text() == "```python\nf(1,2)\n```\n\n```python\nf(1,2)\ng(1,2)\n```\n"
+
+    result = run_black((str(f), "--block-timeout=30", "--max-block-lines=1", "-E"))
+
+    assert result == 1
+    assert (
+        f.read_text() == "```python\nf(1, 2)\n```\n\n```python\nf(1,2)\ng(1,2)\n```\n"
+    )